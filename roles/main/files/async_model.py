@@ -0,0 +1,70 @@
+"""
+async_model.py
+
+An asyncio facade over FlashmarkModel, for the async serving mode in async_view.py.
+
+Every model method can be awaited.  The call itself runs on a small thread pool sized to the connection pool, so a
+slow query ties up one of those threads while the event loop goes on serving every other request.  Requests waiting
+on the database queue up as coroutines rather than as whole worker processes.
+
+The queries themselves are FlashmarkModel's, unchanged, on the same engine and backend.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncFlashmarkModel(object):
+    def __init__(self, fm, max_threads=None, call_context=None):
+        """
+        :param fm: The FlashmarkModel to run calls on.
+        :param max_threads: How many model calls may run at once.  Defaults to what the connection pool can hand out.
+        :param call_context: Optional callable, called on the event loop for every model call, that returns a context
+                             manager to run the call inside of on its thread.
+        """
+        self.fm = fm
+        if max_threads is None:
+            options = fm.backend.engine_options()
+            max_threads = options.get("pool_size", 5) + options.get("max_overflow", 0)
+        self.executor = ThreadPoolExecutor(max_workers=max_threads)
+        self.call_context = call_context
+
+    def __getattr__(self, name):
+        # Looked up on the model at call time, so anything swapped onto the model afterwards is what gets called.
+        if not callable(getattr(self.fm, name)):
+            raise AttributeError("FlashmarkModel.{} is not a method".format(name))
+
+        async def call(*args, **kwargs):
+            return await self.run(getattr(self.fm, name), *args, **kwargs)
+        call.__name__ = name
+        return call
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run any blocking function on the model's thread pool.
+        :param func: The function.
+        :return: Whatever the function returns.
+        """
+        context = self.call_context() if self.call_context is not None else None
+
+        def in_thread():
+            if context is None:
+                return func(*args, **kwargs)
+            with context:
+                return func(*args, **kwargs)
+
+        return await asyncio.get_event_loop().run_in_executor(self.executor, in_thread)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def make_async_model(fm, config_section, call_context=None):
+    """
+    :param fm: The FlashmarkModel.
+    :param config_section: The learningmachine section of config.ini.  async_db_threads caps how many model calls run
+                           at once.
+    :param call_context: See AsyncFlashmarkModel.
+    :return: An AsyncFlashmarkModel.
+    """
+    max_threads = int(config_section.get("async_db_threads") or 0) or None
+    return AsyncFlashmarkModel(fm, max_threads, call_context)
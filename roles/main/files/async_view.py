@@ -0,0 +1,469 @@
+"""
+async_view.py
+
+The Flashmark API served asynchronously: the same routes, arguments and JSON as view.py, on Quart under an ASGI
+server instead of Flask under uwsgi.
+
+    hypercorn async_view:app --bind 127.0.0.1:3032 --workers 1
+
+In view.py a slow query or a slow /suggestname fetch holds up a whole uwsgi worker.  Here the database and outbound
+fetches go through AsyncFlashmarkModel's thread pool, so one process keeps serving every other request in the meantime.
+Sessions are signed the same way as view.py's, so the two modes can be switched between without logging anybody out.
+
+Compression is left to nginx in this mode (gzip on), since responses.py works on Flask responses.
+
+Needs Python 3.7 or later with quart and hypercorn (async_requirements.txt).  Deploying with async_mode set to true
+installs those into a venv of their own, runs this under the learningmachine-async service, and points nginx at it.
+uwsgi keeps running alongside for its maintenance crons.  Run a single worker: the uwsgi cache isn't there to share, so
+the model falls back to a local cache, which is only safe in one process.
+"""
+from configparser import ConfigParser
+from functools import wraps
+import hashlib
+import inspect
+import io
+import logging
+import sys
+from quart import Quart, Response, abort, g, redirect, request, session
+from login import LoginHandler, make_client as make_oauth_client
+import async_model
+import exercise_import
+import metrics
+import model
+import responses
+import slow_queries
+
+parser = ConfigParser()
+dir_path = __file__.rsplit("/", maxsplit=1)[0]
+config_file_name = "{}/{}".format(dir_path, "config.ini")
+parser.read(config_file_name)
+
+debug_mode = parser.getboolean("learningmachine", "debug_mode")
+log_level = logging.DEBUG if debug_mode else logging.INFO
+
+app = Quart(__name__)
+app.debug = debug_mode
+app.logger.setLevel(log_level)
+app.logger.addHandler(logging.StreamHandler(stream=sys.stdout))
+app.secret_key = parser["learningmachine"]["session_key"]
+
+# The model keeps a Flask app of its own to hold the engine.  Calls run outside of any Flask request, each on its own
+# connection from the pool.
+fm = model.FlashmarkModel()
+with fm.app.app_context():
+    app_metrics = metrics.Metrics(fm, metrics.buckets_from_config(parser["learningmachine"])).init_engine(fm.db.engine)
+slow_query_log = slow_queries.init_app(app, fm, parser["learningmachine"])
+afm = async_model.make_async_model(fm, parser["learningmachine"],
+                                   call_context=lambda: app_metrics.bound(g.get("metrics_request")))
+oauth_client = make_oauth_client(parser["learningmachine"], "{}/{}".format(dir_path, "client_secret.json"))
+
+
+def json_response(obj, status=200):
+    return Response(responses.dumps(obj) + "\n", status=status, mimetype="application/json")
+
+
+def error_response(message, status=400):
+    return Response(message, status=status)
+
+
+@app.before_request
+async def start_metrics():
+    g.metrics_request = app_metrics.new_request()
+
+
+@app.after_request
+async def finish_metrics(response):
+    request_stats = g.get("metrics_request")
+    if request_stats is not None:
+        # Error pages from werkzeug exceptions come through as werkzeug responses, whose get_data isn't async.
+        body = response.get_data()
+        if inspect.isawaitable(body):
+            body = await body
+        app_metrics.finish_request(request_stats, app_metrics.route_of(request), request.method, response.status_code,
+                                   len(body))
+    return response
+
+
+def validate_json(*expected_args):
+    """
+    Decorator that sends back a 400 when any of the expected keys is missing from the JSON body.  See view.py.
+    :param expected_args: Individual strings representing keys that are expected to exist in the passed in JSON.
+    :return: A decorator for async view functions.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            json_ob = await request.get_json()
+            for expected_arg in expected_args:
+                if expected_arg not in json_ob or json_ob.get(expected_arg) is None:
+                    print("{} expected the JSON argument {} and didn't find it.".format(func.__name__, expected_arg))
+                    abort(400)
+            return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def conditional_get(func):
+    """
+    Decorator for read routes whose output only changes when the user's data does.  See view.py.
+    :param func: The async view function to wrap.
+    :return: The wrapped view function.
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        user_id = session.get("email")
+        if not user_id:
+            return await func(*args, **kwargs)
+
+        user_hash = hashlib.sha1(user_id.encode("utf8")).hexdigest()[:16]
+        etag = "{}-{}".format(user_hash, await afm.get_data_version(user_id))
+
+        if request.if_none_match.contains_weak(etag):
+            res = Response("", 304)
+        else:
+            res = await app.make_response(await func(*args, **kwargs))
+            if res.status_code != 200:
+                return res
+
+        res.set_etag(etag, weak=True)
+        res.headers["Cache-Control"] = "private, no-cache"
+        return res
+    return wrapper
+
+
+@app.route("/")
+async def welcome_page():
+    return redirect("/static/welcome.html")
+
+
+@app.route("/login")
+async def login():
+    """
+    Log in the user to the system using Google oauth login.  See view.py.
+    """
+    login_handler = LoginHandler(oauth_client)
+
+    if "code" in request.args:
+        await afm.run(login_handler.setup_user_info, request.args["code"])
+        session["email"] = login_handler.email
+        session["display_name"] = login_handler.display_name
+
+        with login_handler.timed("user"):
+            if await afm.upsert_user(login_handler.email, login_handler.display_name):
+                app.logger.info("Added user: {} with display name {} to the database."
+                                .format(login_handler.email, login_handler.display_name))
+
+        app.logger.info("Sending user: {} to main page".format(login_handler.email))
+        app.logger.info("Login timings for {}: {}".format(login_handler.email, login_handler.describe_timings()))
+        return redirect("/static/main.html")
+
+    with login_handler.timed("authorize_url"):
+        auth_url = await afm.run(lambda: login_handler.auth_url)
+    app.logger.info("No login code yet.  Letting Google handle the login process at: {}".format(auth_url))
+    app.logger.debug("Login timings: {}".format(login_handler.describe_timings()))
+    return redirect(auth_url)
+
+
+@app.route("/userinfo")
+async def get_user_info():
+    if session and session.get("email") and session.get("display_name"):
+        return json_response(dict(email=session.get("email"), displayName=session.get("display_name")))
+    return json_response(dict(email="error", display_name="Could not get info for this user"))
+
+
+@app.route("/exercises")
+@conditional_get
+async def get_exercises():
+    """
+    Get a list of exercises for a specific user, either all at once or a page at a time.  See view.py.
+    """
+    email = session.get("email")
+    tags = request.args["tags"].split(",") if request.args.get("tags") else request.args.get("tag")
+    mode = request.args.get("mode", "any")
+
+    if not any(arg in request.args for arg in ("limit", "after", "fields")):
+        try:
+            exercises = await afm.get_all_exercises(email, tags, mode)
+        except Exception as e:
+            reason, *_ = e.args
+            return error_response("/exercises failed. reason: {}".format(reason))
+        app.logger.info("Found {} exercises for {}".format(len(exercises), email))
+        return json_response(dict(exercises=exercises))
+
+    try:
+        limit = int(request.args.get("limit", model.DEFAULT_PAGE_SIZE))
+        after = int(request.args["after"]) if request.args.get("after") else None
+        fields = request.args["fields"].split(",") if request.args.get("fields") else None
+        exercises, next_after = await afm.get_exercise_page(email, tags, after, limit, fields, mode)
+    except Exception as e:
+        reason, *_ = e.args
+        return error_response("/exercises paging failed. reason: {}".format(reason))
+
+    app.logger.info("Found {} exercises for {} after exercise {}".format(len(exercises), email, after))
+    return json_response(dict(exercises=exercises, next_after=next_after))
+
+
+@app.route("/tags")
+@conditional_get
+async def get_tags():
+    tags = await afm.get_tag_counts(session.get("email"))
+    return json_response(dict(tags=tags))
+
+
+@app.route("/search")
+@conditional_get
+async def search_documents():
+    user_id = session.get("email")
+    try:
+        offset = int(request.args.get("offset", 0))
+        limit = int(request.args.get("limit", model.DEFAULT_SEARCH_LIMIT))
+        results, next_offset = await afm.search(user_id, request.args.get("q", ""), offset, limit)
+    except Exception as e:
+        reason, *_ = e.args
+        return error_response("/search failed. reason: {}".format(reason))
+    return json_response(dict(results=results, next_offset=next_offset))
+
+
+@app.route("/nextexercises")
+async def get_next_exercises():
+    email = session.get("email")
+    try:
+        count = int(request.args.get("n", model.DEFAULT_NEXT_EXERCISES))
+        exercises = await afm.get_next_exercises(email, count)
+    except Exception as e:
+        reason, *_ = e.args
+        return error_response("/nextexercises failed. reason: {}".format(reason))
+
+    app.logger.info("Found {} due exercises for {}".format(len(exercises), email))
+    return json_response(dict(exercises=exercises))
+
+
+@app.route("/addscore", methods=["POST"])
+@validate_json("exercise_id", "score")
+async def add_score():
+    json_data = await request.get_json()
+    exercise_id, score = json_data.get("exercise_id"), json_data.get("score")
+    await afm.add_attempt(exercise_id, score, session.get("email"))
+    app.logger.info("Attempt added.  Exercise ID: {} Score: {}".format(exercise_id, score))
+    return json_response(dict(result="success"))
+
+
+@app.route("/addscores", methods=["POST"])
+@validate_json("scores")
+async def add_scores():
+    from datetime import datetime
+    user_id = session.get("email")
+    try:
+        scores = []
+        for entry in (await request.get_json()).get("scores"):
+            client_timestamp = entry.get("client_timestamp")
+            when_attempted = datetime.fromtimestamp(client_timestamp / 1000.0) if client_timestamp else None
+            scores.append((entry["exercise_id"], entry["score"], when_attempted))
+
+        applied, skipped = await afm.add_attempts(user_id, scores)
+    except Exception as e:
+        reason, *_ = e.args
+        return error_response("/addscores failed. reason: {}".format(reason))
+
+    app.logger.info("{} attempts added for user: {}.  {} skipped.".format(applied, user_id, len(skipped)))
+    return json_response(dict(result="success", applied=applied, skipped=skipped))
+
+
+@app.route("/addexercise", methods=["POST"])
+@validate_json("new_question", "new_answer")
+async def add_exercise():
+    json_data = await request.get_json()
+    user_id = session.get("email")
+    try:
+        await afm.add_exercise(json_data.get("new_question"), json_data.get("new_answer"), user_id)
+    except Exception:
+        app.logger.error("The question or the answer to be added has exceeded the max char limit")
+        abort(400)
+    app.logger.info("Exercise added for user: {}".format(user_id))
+    return json_response({"message": "add exercise call completed"})
+
+
+@app.route("/importexercises", methods=["POST"])
+async def import_exercises():
+    """
+    Bulk add exercises from a CSV or JSON lines body.  See view.py.  The body is read in full before parsing starts;
+    nginx caps it at 20MB.
+    """
+    user_id = session.get("email")
+    import_format = request.args.get("format")
+    if import_format is None:
+        import_format = "jsonl" if "json" in (request.content_type or "") else "csv"
+
+    reader = exercise_import.READERS.get(import_format)
+    if reader is None:
+        return error_response("Unknown import format: {}".format(import_format))
+
+    lines = io.TextIOWrapper(io.BytesIO(await request.get_data()), encoding="utf-8", newline="")
+    try:
+        imported, errors = await afm.import_exercises(user_id, reader(lines))
+    except Exception as e:
+        reason, *_ = e.args
+        return error_response("/importexercises failed. reason: {}".format(reason))
+
+    app.logger.info("Imported {} exercises for user: {}.  {} rows rejected.".format(imported, user_id, len(errors)))
+    return json_response(dict(imported=imported, errors=errors))
+
+
+@app.route("/deleteexercise", methods=["POST"])
+async def delete_exercise():
+    json_ob = await request.get_json()
+    msg = await afm.delete_exercise(session.get("email"), json_ob.get("exercise_id"))
+    app.logger.info(msg)
+    return ""
+
+
+@app.route("/deleteexercises", methods=["POST"])
+@validate_json("exercise_ids")
+async def delete_exercises():
+    """
+    Delete a batch of the user's exercises.  See view.py.
+    """
+    user_id = session.get("email")
+    try:
+        exercise_ids = [int(exercise_id) for exercise_id in (await request.get_json()).get("exercise_ids")]
+        deleted = await afm.delete_exercises(user_id, exercise_ids)
+    except Exception as e:
+        reason, *_ = e.args
+        return error_response("/deleteexercises failed. reason: {}".format(reason))
+
+    app.logger.info("Deleted {} exercises for user: {}".format(deleted, user_id))
+    return json_response(dict(deleted=deleted))
+
+
+@app.route("/linkresource", methods=["POST"])
+@validate_json("resource_id")
+async def link_resource():
+    """
+    Link one of the user's resources to a batch of exercises and unlink it from others.  See view.py.
+    """
+    user_id = session.get("email")
+    try:
+        json_ob = await request.get_json()
+        link_ids = [int(exercise_id) for exercise_id in json_ob.get("link") or []]
+        unlink_ids = [int(exercise_id) for exercise_id in json_ob.get("unlink") or []]
+        linked, unlinked = await afm.link_resource(user_id, int(json_ob.get("resource_id")), link_ids, unlink_ids)
+    except Exception as e:
+        reason, *_ = e.args
+        return error_response("/linkresource failed. reason: {}".format(reason))
+
+    return json_response(dict(linked=linked, unlinked=unlinked))
+
+
+@app.route("/deleteresource", methods=["POST"])
+async def delete_resource():
+    json_ob = await request.get_json()
+    exercise_id = json_ob.get("exercise_id")
+    try:
+        exercise_id = int(exercise_id) if exercise_id is not None else None
+        await afm.delete_resource(session.get("email"), json_ob.get("resource_id"), exercise_id)
+    except Exception as e:
+        reason, *_ = e.args
+        return error_response("/deleteresource failed. reason: {}".format(reason))
+    return ""
+
+
+@app.route("/exercisehistory")
+@conditional_get
+async def get_exercise_history():
+    from datetime import datetime
+    user_id = session.get("email")
+
+    try:
+        since = request.args.get("since")
+        try:
+            since = datetime.strptime(since, "%Y-%m-%d") if since else None
+        except ValueError:
+            raise Exception("since has to be a date in YYYY-MM-DD form")
+        history = await afm.full_attempt_history(user_id, request.args.get("summary"), since)
+    except Exception as e:
+        err_reason, *_ = e.args
+        return error_response("/exercisehistory failed. reason: {}".format(err_reason))
+
+    app.logger.info("Attempt history found for user: {}.  {} records.".format(user_id, len(history)))
+    return json_response(dict(history=history))
+
+
+@app.route("/resources")
+@conditional_get
+async def get_resources():
+    resources = await afm.get_resources(session["email"])
+    return json_response(dict(resources=resources))
+
+
+@app.route("/resourcesforexercise/<exercise_id>")
+@conditional_get
+async def get_resources_for_exercise(exercise_id):
+    resources = await afm.get_resources_for_exercise(exercise_id, session.get("email"))
+    return json_response(dict(resources=resources))
+
+
+@app.route("/addresource", methods=["POST"])
+async def add_resource():
+    user_id = session["email"]
+    json_data = await request.get_json()
+    try:
+        resource_id, reused = await afm.add_resource(json_data["new_caption"], json_data["new_url"], user_id,
+                                                     json_data["exercise_id"])
+    except Exception:
+        abort(400)
+
+    if reused:
+        app.logger.info("Linked existing resource {} for user: {}".format(resource_id, user_id))
+    return json_response(dict(resource_id=resource_id, reused=reused))
+
+
+@app.route("/changetags", methods=["POST"])
+async def change_tags():
+    try:
+        user_id = session.get("email")
+        json_data = await request.get_json()
+        if None in [user_id, json_data]:
+            raise Exception("user id and/or json data required when changing tags.  One of these is missing")
+
+        tag_list, exercise_id = json_data.get("tag_changes"), json_data.get("exercise_id")
+        tag_list = tag_list if tag_list else ""
+
+        if exercise_id is None:
+            raise Exception("I find your lack of exercise id when trying to change tags disturbing!")
+
+        await afm.change_tags(tag_list, user_id, exercise_id)
+        return "tag changes done."
+    except Exception as e:
+        reason, *_ = e.args
+        return error_response(reason)
+
+
+@app.route("/stats")
+async def get_stats():
+    return json_response(dict(cache=fm.cache.stats(), pool=fm.pool_stats(), titles=fm.title_fetcher.stats()))
+
+
+@app.route("/metrics")
+async def get_metrics():
+    return Response(app_metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/admin/slowqueries")
+async def get_slow_queries():
+    try:
+        order = request.args.get("order", "total")
+        limit = request.args.get("limit")
+        limit = int(limit) if limit else None
+        return json_response(dict(slow_query_log.stats(), queries=slow_query_log.report(order, limit)))
+    except Exception as e:
+        reason, *_ = e.args
+        return error_response("/admin/slowqueries failed. reason: {}".format(reason))
+
+
+@app.route("/suggestname", methods=["GET"])
+async def suggest_name():
+    try:
+        return await afm.run(model.suggest_name, request.args.get("url"), fm.title_fetcher)
+    except Exception as e:
+        err_reason, *_ = e.args
+        return error_response("/suggestname failed. reason: {}".format(err_reason))
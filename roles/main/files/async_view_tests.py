@@ -0,0 +1,115 @@
+import asyncio
+import sys
+import unittest
+from contextlib import contextmanager
+from unittest.mock import MagicMock
+from werkzeug.wrappers import Response
+from model_tests import make_section
+import view_tests
+
+# The async mode needs Python 3.7.  Anywhere it can run, a missing quart is a broken test environment, not a reason
+# to skip.
+if sys.version_info >= (3, 7):
+    import async_model
+    import async_view
+
+
+class SyncClient(object):
+    """
+    Drives Quart's test client from synchronous code, with the calls view_tests makes on Flask's.
+    """
+
+    def __init__(self, app, loop):
+        self.client = app.test_client()
+        self.loop = loop
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def get(self, path, headers=None, data=None):
+        return self.open(path, "GET", headers, data)
+
+    def post(self, path, headers=None, data=None):
+        return self.open(path, "POST", headers, data)
+
+    def open(self, path, method, headers=None, data=None):
+        res = self.loop.run_until_complete(self.client.open(path, method=method, headers=headers, data=data))
+        body = self.loop.run_until_complete(res.get_data())
+        return Response(body, status=res.status_code, headers=list(res.headers.items()))
+
+    @contextmanager
+    def session_transaction(self):
+        # Quart's session transaction has to be entered and left within one task, so changes are gathered up first.
+        changes = {}
+        yield changes
+
+        async def apply():
+            async with self.client.session_transaction() as sess:
+                sess.update(changes)
+        self.loop.run_until_complete(apply())
+
+
+class SyncApp(object):
+    def __init__(self, app, loop):
+        self.app = app
+        self.loop = loop
+
+    def test_client(self):
+        return SyncClient(self.app, self.loop)
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "the async mode needs Python 3.7")
+class AsyncViewTestCase(view_tests.ViewTestCase):
+    """
+    Every view_tests case again, against the async app.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.app = SyncApp(async_view.app, self.loop)
+        self.fm = async_view.fm
+        # The base setUp mocked the version lookup on view.py's model, not this one.
+        self.mock_model("get_data_version", MagicMock(return_value=0))
+
+    def tearDown(self):
+        self.loop.close()
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "the async mode needs Python 3.7")
+class AsyncModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fm = MagicMock()
+        self.fm.backend.engine_options.return_value = dict(pool_size=5, max_overflow=10)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_thread_count(self):
+        # The config template ships async_db_threads empty.
+        for threads, expected in (("", 15), ("4", 4)):
+            afm = async_model.make_async_model(self.fm, make_section(async_db_threads=threads))
+            self.assertEqual(expected, afm.executor._max_workers)
+            afm.close()
+        afm = async_model.make_async_model(self.fm, make_section())
+        self.assertEqual(15, afm.executor._max_workers)
+        afm.close()
+
+    def test_calls_run_inside_the_call_context(self):
+        entered = []
+
+        @contextmanager
+        def call_context():
+            entered.append(True)
+            yield
+
+        self.fm.get_data_version.return_value = 3
+        afm = async_model.make_async_model(self.fm, make_section(), call_context)
+        self.assertEqual(3, self.loop.run_until_complete(afm.get_data_version("someone")))
+        self.fm.get_data_version.assert_called_once_with("someone")
+        self.assertEqual([True], entered)
+        afm.close()
@@ -0,0 +1,250 @@
+"""
+backends.py
+
+Storage backends for Flashmark.
+
+MySQL is what production runs on.  SQLite is there for single node installs and for load testing and benchmarking
+without a MySQL server.  A file database is run in WAL mode so readers don't block the writer, and ":memory:" gives a
+throwaway database shared by every thread of the process, one at a time.
+
+Everything that depends on the database in use lives here: connection URLs and pool settings, connection setup,
+inserts that skip duplicates, upserts, and reading query plans.  Pick one with the backend key in config.ini.
+"""
+import os
+from sqlalchemy import event, text
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_SQLITE_PATH = "flashmark.db"
+MEMORY = ":memory:"
+
+
+class Backend(object):
+    """
+    What every backend offers.  Built without a config section, a backend can still build statements and read plans
+    but not connect.
+    """
+    name = None
+    explain_prefix = None
+
+    def __init__(self, config_section=None, dir_path=None):
+        self.config = config_section if config_section is not None else {}
+
+    def config_int(self, key, default):
+        return int(self.config.get(key, default))
+
+    def configure_engine(self, engine):
+        """
+        Hook anything the backend needs onto a newly built engine.
+        :param engine: The engine.
+        :return: Nothing.
+        """
+
+    def explain_statement(self, dbapi_conn, statement, parameters):
+        """
+        EXPLAIN a statement as the driver was handed it, straight through a DB-API connection so that no engine events
+        fire for it.
+        :param dbapi_conn: The DB-API connection.
+        :param statement: The statement, already compiled for the driver.
+        :param parameters: The parameters the driver was handed with it.
+        :return: The plan as one line of text.
+        """
+        cursor = dbapi_conn.cursor()
+        try:
+            cursor.execute(self.explain_prefix + statement, parameters)
+            names = [column[0] for column in cursor.description]
+            rows = [dict(zip(names, row)) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+        return self.describe_plan(self.plan_from_rows(rows))
+
+
+class MySQLBackend(Backend):
+    name = "mysql"
+    explain_prefix = "explain "
+
+    def url(self, admin=False):
+        """
+        :param admin: Connect as root, for schema changes.
+        :return: SQLAlchemy database URL.
+        """
+        config = self.config
+        host, db = config.get("host"), config.get("db")
+        if admin:
+            return "mysql+pymysql://{}:{}@{}/{}".format("root", config.get("root_password"), host, db)
+        return "mysql+pymysql://{}:{}@{}/{}?charset=utf8".format(config.get("user"), config.get("password"), host, db)
+
+    def engine_options(self):
+        """
+        :return: Keyword arguments for create_engine.
+        """
+        config = self.config
+        return dict(pool_size=config.getint("pool_size", 5),
+                    max_overflow=config.getint("pool_max_overflow", 10),
+                    pool_timeout=config.getint("pool_timeout", 30),
+                    pool_recycle=config.getint("pool_recycle", 14400),
+                    pool_pre_ping=config.getboolean("pool_pre_ping", True))
+
+    def insert_ignore(self, table):
+        """
+        Build an insert for the table that skips rows whose key is already there rather than failing.
+        :param table: The table to insert into.
+        :return: An insert statement to execute with a list of rows.
+        """
+        return table.insert().prefix_with("IGNORE")
+
+    def upsert_clause(self, key_columns, add_columns=(), set_columns=()):
+        """
+        Build the tail of an insert that updates the existing row instead when the key is already there.
+        :param key_columns: Columns of the unique key that may collide.
+        :param add_columns: Columns to add the inserted values onto.
+        :param set_columns: Columns to overwrite with the inserted values.
+        :return: SQL text to append to the insert.
+        """
+        updates = ["{0} = {0} + values({0})".format(column) for column in add_columns]
+        updates += ["{0} = values({0})".format(column) for column in set_columns]
+        return "on duplicate key update " + ", ".join(updates)
+
+    def explain(self, conn, sql, params):
+        """
+        :param conn: The database connection.
+        :param sql: Query to explain.
+        :param params: Bind values for the query.
+        :return: List of dicts, one per table the plan reads, with the table, access type, usable indexes and the
+                 index picked.
+        """
+        rows = conn.execute(text(self.explain_prefix + sql), **params).fetchall()
+        return self.plan_from_rows([dict(row) for row in rows])
+
+    def plan_from_rows(self, rows):
+        return [dict(table=row["table"], type=row["type"], possible_keys=(row["possible_keys"] or "").split(","),
+                     key=row["key"]) for row in rows]
+
+    def describe_plan(self, plan):
+        """
+        :param plan: What explain returned.
+        :return: The plan as one line of text.
+        """
+        return "; ".join("{} type={} possible_keys={} key={}".format(step["table"], step["type"],
+                                                                    ",".join(step["possible_keys"]), step["key"])
+                         for step in plan)
+
+    def uses_index(self, conn, sql, params, table, index):
+        """
+        EXPLAIN a query and see whether an index is available to it.  possible_keys is checked rather than the key
+        picked because the optimizer will happily pick a full scan on a near-empty table.
+        :param conn: The database connection.
+        :param sql: Query to explain.
+        :param params: Bind values for the query.
+        :param table: Table (or alias) that should be using the index.
+        :param index: Name of the index.
+        :return: A tuple of whether the index is usable and the plan as text.
+        """
+        plan = self.explain(conn, sql, params)
+        passed = any(step["table"] == table and index in step["possible_keys"] for step in plan)
+        return passed, self.describe_plan(plan)
+
+
+class SQLiteBackend(Backend):
+    name = "sqlite"
+    explain_prefix = "explain query plan "
+
+    def __init__(self, config_section=None, dir_path=None):
+        super().__init__(config_section, dir_path)
+        path = self.config.get("sqlite_path", DEFAULT_SQLITE_PATH)
+        if path != MEMORY and not os.path.isabs(path):
+            path = os.path.join(dir_path or os.path.dirname(os.path.abspath(__file__)), path)
+        self.path = path
+
+    @property
+    def in_memory(self):
+        return self.path == MEMORY
+
+    def url(self, admin=False):
+        return "sqlite://" if self.in_memory else "sqlite:///" + self.path
+
+    def engine_options(self):
+        connect_args = dict(check_same_thread=False)
+        if self.in_memory:
+            # Every connection would get a database of its own, so there is exactly one and it is lent out to one
+            # thread at a time.  A transaction on it can't be interleaved with another thread's.
+            return dict(poolclass=QueuePool, pool_size=1, max_overflow=0,
+                        pool_timeout=self.config_int("pool_timeout", 30), connect_args=connect_args)
+        config = self.config
+        return dict(poolclass=QueuePool, connect_args=connect_args,
+                    pool_size=config.getint("pool_size", 5),
+                    max_overflow=config.getint("pool_max_overflow", 10),
+                    pool_timeout=config.getint("pool_timeout", 30))
+
+    def configure_engine(self, engine):
+        busy_timeout = self.config_int("sqlite_busy_timeout", 5000)
+        synchronous = self.config.get("sqlite_synchronous", "NORMAL")
+        in_memory = self.in_memory
+
+        @event.listens_for(engine, "connect")
+        def on_connect(dbapi_conn, connection_record):
+            # Let SQLAlchemy decide where transactions start rather than the sqlite3 module, see on_begin.
+            dbapi_conn.isolation_level = None
+            cursor = dbapi_conn.cursor()
+            if not in_memory:
+                cursor.execute("pragma journal_mode = wal")
+                cursor.execute("pragma synchronous = {}".format(synchronous))
+            cursor.execute("pragma busy_timeout = {:d}".format(busy_timeout))
+            cursor.close()
+
+        @event.listens_for(engine, "begin")
+        def on_begin(conn):
+            # Take the write lock up front.  A deferred transaction that reads and then writes can't wait on
+            # busy_timeout for another writer to finish and fails straight away instead.
+            conn.execute("begin immediate")
+
+    def insert_ignore(self, table):
+        return table.insert().prefix_with("OR IGNORE")
+
+    def upsert_clause(self, key_columns, add_columns=(), set_columns=()):
+        updates = ["{0} = {0} + excluded.{0}".format(column) for column in add_columns]
+        updates += ["{0} = excluded.{0}".format(column) for column in set_columns]
+        return "on conflict ({}) do update set {}".format(", ".join(key_columns), ", ".join(updates))
+
+    def explain(self, conn, sql, params):
+        """
+        :return: List of the detail text of each step of the query plan.
+        """
+        rows = conn.execute(text(self.explain_prefix + sql), **params).fetchall()
+        return self.plan_from_rows([dict(row) for row in rows])
+
+    def plan_from_rows(self, rows):
+        return [row["detail"] for row in rows]
+
+    def describe_plan(self, plan):
+        return "; ".join(plan)
+
+    def uses_index(self, conn, sql, params, table, index):
+        plan = self.describe_plan(self.explain(conn, sql, params))
+        if index == "PRIMARY":
+            # SQLite backs a composite primary key with an automatic index.
+            return "sqlite_autoindex_{}".format(table) in plan or "PRIMARY KEY" in plan, plan
+        return index in plan, plan
+
+
+BACKENDS = {MySQLBackend.name: MySQLBackend, SQLiteBackend.name: SQLiteBackend}
+
+
+def make_backend(config_section, dir_path=None):
+    """
+    Build the storage backend described by the config file.
+    :param config_section: The learningmachine section of config.ini.
+    :param dir_path: Directory relative SQLite paths are taken from.  Defaults to the one this file is in.
+    :return: A backend.
+    """
+    name = config_section.get("backend", MySQLBackend.name)
+    if name not in BACKENDS:
+        raise Exception("Unknown backend {}.  Use one of: {}".format(name, ", ".join(sorted(BACKENDS))))
+    return BACKENDS[name](config_section, dir_path)
+
+
+def for_connection(conn):
+    """
+    :param conn: A database connection.
+    :return: A backend for the connection's dialect, for the parts that don't depend on configuration.
+    """
+    return BACKENDS[conn.dialect.name]()
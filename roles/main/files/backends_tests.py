@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+from configparser import ConfigParser
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.dialects import mysql, sqlite
+import backends
+from tabledefs import meta, user_table
+
+
+def make_section(**options):
+    cp = ConfigParser()
+    cp["learningmachine"] = options
+    return cp["learningmachine"]
+
+
+class BackendsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def make_engine(self, backend):
+        eng = create_engine(backend.url(), **backend.engine_options())
+        backend.configure_engine(eng)
+        meta.create_all(bind=eng)
+        return eng
+
+    def test_picks_backend_from_config(self):
+        backend = backends.make_backend(make_section(user="public", password="pw", host="db", db="lm"))
+        self.assertEqual("mysql+pymysql://public:pw@db/lm?charset=utf8", backend.url())
+        self.assertEqual("mysql+pymysql://root:rpw@db/lm",
+                         backends.make_backend(make_section(root_password="rpw", host="db", db="lm")).url(admin=True))
+
+        backend = backends.make_backend(make_section(backend="sqlite", sqlite_path="fm.db"), self.dir_path)
+        self.assertEqual("sqlite:///" + os.path.join(self.dir_path, "fm.db"), backend.url())
+
+        with self.assertRaises(Exception):
+            backends.make_backend(make_section(backend="oracle"))
+
+    def test_insert_ignore_and_upsert(self):
+        mysql_backend, sqlite_backend = backends.MySQLBackend(), backends.SQLiteBackend()
+        self.assertIn("INSERT IGNORE", str(mysql_backend.insert_ignore(user_table).compile(dialect=mysql.dialect())))
+        self.assertIn("INSERT OR IGNORE",
+                      str(sqlite_backend.insert_ignore(user_table).compile(dialect=sqlite.dialect())))
+        self.assertEqual("on duplicate key update n = n + values(n), name = values(name)",
+                         mysql_backend.upsert_clause(["id"], add_columns=["n"], set_columns=["name"]))
+        self.assertEqual("on conflict (id) do update set n = n + excluded.n, name = excluded.name",
+                         sqlite_backend.upsert_clause(["id"], add_columns=["n"], set_columns=["name"]))
+
+    def test_sqlite_file_runs_in_wal_mode(self):
+        backend = backends.make_backend(make_section(backend="sqlite", sqlite_path="fm.db"), self.dir_path)
+        eng = self.make_engine(backend)
+        self.assertEqual("wal", eng.execute("pragma journal_mode").scalar())
+
+        with eng.connect() as conn:
+            with self.assertRaises(ValueError):
+                with conn.begin():
+                    conn.execute(backend.insert_ignore(user_table), [dict(email="a@x"), dict(email="a@x")])
+                    raise ValueError()
+            self.assertEqual(0, conn.execute("select count(*) from users").scalar())
+
+            with conn.begin():
+                conn.execute(backend.insert_ignore(user_table), [dict(email="a@x"), dict(email="a@x")])
+            self.assertEqual(1, conn.execute("select count(*) from users").scalar())
+
+    def test_sqlite_memory_is_shared_one_user_at_a_time(self):
+        backend = backends.make_backend(make_section(backend="sqlite", sqlite_path=":memory:", pool_timeout="0"))
+        eng = self.make_engine(backend)
+        eng.execute(user_table.insert(), email="a@x")
+        with eng.connect() as first:
+            self.assertEqual(1, first.execute("select count(*) from users").scalar())
+        with eng.connect() as second:
+            self.assertEqual(1, second.execute("select count(*) from users").scalar())
+            with self.assertRaises(TimeoutError):
+                eng.connect()
@@ -0,0 +1,342 @@
+#!/var/app/learningmachine/venv/bin/python3.4
+"""
+benchmark.py
+
+End to end benchmarks for the Flashmark routes.
+
+    benchmark.py [options]        See benchmark.py --help for the list.
+
+Synthetic users are seeded into the database named in config.ini first, each with a deck of exercises, tags, attempt
+history and resources.  Users that already have a deck are left alone, so a database can be seeded once and then
+benchmarked over and over.  Every route is then driven in turn at the given concurrency, either in process through the
+Flask test client or over HTTP against a running server.  Latency percentiles, throughput and, in process, the number
+of SQL statements each request ran are printed and written out as JSON so runs can be compared.
+
+Point config.ini at backend=sqlite with sqlite_path=:memory: to benchmark without a MySQL server.
+"""
+import argparse
+import http.client
+import json
+import logging
+import math
+import random
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, urlparse
+
+DEFAULT_OUTPUT = "benchmark.json"
+
+WORDS = """
+python java rust haskell closure lambda decorator generator iterator coroutine thread process mutex semaphore socket
+packet router index btree hash heap stack queue graph tree trie sort merge quick binary search cache buffer page
+kernel syscall compiler parser lexer token grammar regex unicode encoding schema query join transaction commit
+rollback replica shard vector matrix tensor gradient""".split()
+
+# What a worker knows about the user it's benchmarking as.
+Deck = namedtuple("Deck", ["user_id", "exercise_ids", "tags"])
+
+# A route to drive.  path and body are functions of (rng, deck); body is None for GETs.
+Route = namedtuple("Route", ["name", "method", "path", "body"])
+
+
+def pick_tags(rng, deck, count=2):
+    return rng.sample(deck.tags, min(count, len(deck.tags)))
+
+
+ROUTES = [
+    Route("userinfo", "GET", lambda rng, deck: "/userinfo", None),
+    Route("exercises", "GET", lambda rng, deck: "/exercises", None),
+    Route("exercises_page", "GET", lambda rng, deck: "/exercises?limit=100", None),
+    Route("exercises_tags", "GET",
+          lambda rng, deck: "/exercises?" + urlencode(dict(tags=",".join(pick_tags(rng, deck)), mode="any")), None),
+    Route("tags", "GET", lambda rng, deck: "/tags", None),
+    Route("search", "GET", lambda rng, deck: "/search?" + urlencode(dict(q=rng.choice(WORDS)[:4])), None),
+    Route("nextexercises", "GET", lambda rng, deck: "/nextexercises?n=10", None),
+    Route("exercisehistory", "GET", lambda rng, deck: "/exercisehistory", None),
+    Route("exercisehistory_daily", "GET", lambda rng, deck: "/exercisehistory?summary=daily", None),
+    Route("resources", "GET", lambda rng, deck: "/resources", None),
+    Route("resourcesforexercise", "GET",
+          lambda rng, deck: "/resourcesforexercise/{}".format(rng.choice(deck.exercise_ids)), None),
+    Route("addscore", "POST", lambda rng, deck: "/addscore",
+          lambda rng, deck: dict(exercise_id=rng.choice(deck.exercise_ids), score=rng.randint(1, 3))),
+    Route("addscores", "POST", lambda rng, deck: "/addscores",
+          lambda rng, deck: dict(scores=[dict(exercise_id=rng.choice(deck.exercise_ids), score=rng.randint(1, 3))
+                                         for _ in range(10)])),
+    Route("changetags", "POST", lambda rng, deck: "/changetags",
+          lambda rng, deck: dict(exercise_id=rng.choice(deck.exercise_ids), tag_changes=" ".join(pick_tags(rng, deck)))),
+    Route("addexercise", "POST", lambda rng, deck: "/addexercise",
+          lambda rng, deck: dict(new_question=" ".join(rng.sample(WORDS, 5)) + "?",
+                                 new_answer=" ".join(rng.sample(WORDS, 3)))),
+    Route("addresource", "POST", lambda rng, deck: "/addresource",
+          lambda rng, deck: dict(new_caption=" ".join(rng.sample(WORDS, 3)), new_url="http://example.com/",
+                                 exercise_id=rng.choice(deck.exercise_ids))),
+]
+
+
+def benchmark_user(n):
+    return "bench-{}@localhost".format(n)
+
+
+def seed_user(fm, user_id, rng, exercises, tags, tags_per_exercise, attempts, history_days, resources):
+    """
+    Give a synthetic user a deck, unless they already have one.
+    :param fm: The FlashmarkModel to seed through.
+    :param user_id: The user to seed.
+    :param rng: random.Random to draw from.
+    :param exercises: Number of exercises in the deck.
+    :param tags: Number of distinct tags the deck uses.
+    :param tags_per_exercise: Number of tags on each exercise.
+    :param attempts: Number of attempts recorded against each exercise.
+    :param history_days: How many days back the attempts go.
+    :param resources: Number of resources, each linked to one exercise.
+    :return: The user's Deck.
+    """
+    from exercise_import import ImportRow
+    import model
+
+    tag_names = ["tag{}".format(n) for n in range(tags)]
+    fm.upsert_user(user_id, "Benchmark User")
+    existing = fm.get_all_exercises(user_id)
+    if existing:
+        deck_tags = sorted(set(tag for exercise in existing for tag in exercise["tags"]))
+        return Deck(user_id, [exercise["id"] for exercise in existing], deck_tags or tag_names)
+
+    rows = (ImportRow(n + 1, "{} {}?".format(n, " ".join(rng.sample(WORDS, 5))), " ".join(rng.sample(WORDS, 4)),
+                      rng.sample(tag_names, min(tags_per_exercise, tags)), None) for n in range(exercises))
+    fm.import_exercises(user_id, rows)
+    exercise_ids = [exercise["id"] for exercise in fm.get_all_exercises(user_id)]
+
+    now = datetime.now()
+    history = sorted((now - timedelta(days=rng.uniform(0, history_days)), exercise_id, rng.randint(1, 3))
+                     for exercise_id in exercise_ids for _ in range(attempts))
+    for start in range(0, len(history), model.MAX_SCORE_BATCH):
+        fm.add_attempts(user_id, [(exercise_id, score, when_attempted)
+                                  for when_attempted, exercise_id, score in history[start:start + model.MAX_SCORE_BATCH]])
+
+    for _ in range(resources):
+        fm.add_resource(" ".join(rng.sample(WORDS, 3)), "http://example.com/{}".format(rng.randint(0, 10 ** 6)),
+                        user_id, rng.choice(exercise_ids))
+
+    return Deck(user_id, exercise_ids, tag_names)
+
+
+class StatementCounter(object):
+    """
+    Counts the SQL statements sent through an engine by each thread.
+    """
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.local = threading.local()
+        event.listen(engine, "before_cursor_execute", self.count)
+
+    def count(self, conn, cursor, statement, parameters, context, executemany):
+        self.local.count = getattr(self.local, "count", 0) + 1
+
+    def take(self):
+        """
+        :return: Statements run by this thread since the last call.
+        """
+        count = getattr(self.local, "count", 0)
+        self.local.count = 0
+        return count
+
+
+class ClientTarget(object):
+    """
+    Sends requests through the Flask test client, in process.
+    """
+
+    def __init__(self, app, counter):
+        self.app = app
+        self.counter = counter
+        self.name = "client"
+
+    def session(self, user_id):
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess["email"] = user_id
+            sess["display_name"] = "Benchmark User"
+
+        def send(method, path, body):
+            self.counter.take()
+            res = client.open(path, method=method, json=body)
+            return res.status_code, len(res.get_data()), self.counter.take()
+        return send
+
+
+class HttpTarget(object):
+    """
+    Sends requests to a running server, such as a local uwsgi.  Session cookies are signed with the secret key from
+    config.ini, so it has to be the same one the server uses.
+    """
+
+    def __init__(self, app, base_url):
+        self.app = app
+        self.url = urlparse(base_url)
+        self.name = base_url
+
+    def session(self, user_id):
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        cookie = "{}={}".format(self.app.config["SESSION_COOKIE_NAME"],
+                                serializer.dumps(dict(email=user_id, display_name="Benchmark User")))
+        conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=60)
+
+        def send(method, path, body):
+            headers = {"Cookie": cookie}
+            data = None
+            if body is not None:
+                data = json.dumps(body).encode("utf8")
+                headers["Content-Type"] = "application/json"
+            conn.request(method, (self.url.path.rstrip("/") or "") + path, body=data, headers=headers)
+            res = conn.getresponse()
+            return res.status, len(res.read()), None
+        return send
+
+
+def percentile(ordered, fraction):
+    """
+    Nearest rank percentile.
+    :param ordered: Sorted list of numbers.
+    :param fraction: Which percentile, from 0 to 1.
+    :return: The percentile, or None for an empty list.
+    """
+    if not ordered:
+        return None
+    rank = max(0, min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def drive_route(target, route, decks, concurrency, requests, warmup, seed):
+    """
+    Send one route's requests from several threads at once.
+    :param target: ClientTarget or HttpTarget.
+    :param route: The Route to drive.
+    :param decks: List of Decks; worker n benchmarks as decks[n % len(decks)].
+    :param concurrency: Number of threads sending requests.
+    :param requests: Total number of timed requests, shared between the threads.
+    :param warmup: Untimed requests each thread sends first.
+    :param seed: Random seed, so runs send the same requests.
+    :return: Dict of latency percentiles in milliseconds, throughput, statuses, bytes and SQL statement counts.
+    """
+    latencies, statements, statuses, sizes = [], [], {}, []
+    lock = threading.Lock()
+    start_line = threading.Barrier(concurrency + 1)
+
+    def worker(n, count):
+        rng = random.Random(seed * 1000 + n)
+        deck = decks[n % len(decks)]
+        send = target.session(deck.user_id)
+        for _ in range(warmup):
+            send(route.method, route.path(rng, deck), route.body(rng, deck) if route.body else None)
+        start_line.wait()
+
+        mine = []
+        for _ in range(count):
+            path, body = route.path(rng, deck), route.body(rng, deck) if route.body else None
+            started = time.perf_counter()
+            status, size, sql = send(route.method, path, body)
+            mine.append(((time.perf_counter() - started) * 1000, status, size, sql))
+
+        with lock:
+            for elapsed, status, size, sql in mine:
+                latencies.append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+                sizes.append(size)
+                if sql is not None:
+                    statements.append(sql)
+
+    shares = [requests // concurrency + (1 if n < requests % concurrency else 0) for n in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(n, share)) for n, share in enumerate(shares)]
+    for thread in threads:
+        thread.start()
+    start_line.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return dict(requests=len(latencies), statuses=statuses,
+                p50_ms=round(percentile(latencies, 0.50), 3), p95_ms=round(percentile(latencies, 0.95), 3),
+                p99_ms=round(percentile(latencies, 0.99), 3), max_ms=round(latencies[-1], 3),
+                mean_ms=round(sum(latencies) / len(latencies), 3),
+                throughput_rps=round(len(latencies) / elapsed, 2) if elapsed else None,
+                mean_bytes=round(sum(sizes) / len(sizes), 1),
+                sql_per_request=round(sum(statements) / len(statements), 2) if statements else None,
+                sql_max=max(statements) if statements else None)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="End to end benchmarks for the Flashmark routes.")
+    parser.add_argument("--target", default="client",
+                        help="'client' for the in process test client, or the base URL of a running server")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per route")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed requests per thread per route")
+    parser.add_argument("--routes", default="", help="comma separated route names; all of them by default")
+    parser.add_argument("--users", type=int, default=2)
+    parser.add_argument("--exercises", type=int, default=500, help="exercises per user")
+    parser.add_argument("--tags", type=int, default=30, help="distinct tags per user")
+    parser.add_argument("--tags-per-exercise", type=int, default=3)
+    parser.add_argument("--attempts", type=int, default=10, help="attempts per exercise")
+    parser.add_argument("--history-days", type=int, default=365)
+    parser.add_argument("--resources", type=int, default=50, help="resources per user")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    import view
+    import migrations
+
+    fm = view.fm
+    # Logging every request to the console would end up being most of what gets measured.
+    view.app.logger.setLevel(logging.WARNING)
+    routes = ROUTES
+    if args.routes:
+        wanted = args.routes.split(",")
+        unknown = set(wanted) - set(route.name for route in ROUTES)
+        if unknown:
+            print("unknown routes: {}".format(", ".join(sorted(unknown))))
+            return 2
+        routes = [route for route in ROUTES if route.name in wanted]
+
+    with view.app.app_context():
+        if fm.backend.name == "sqlite":
+            # Nothing has made the tables yet when the database lives in this process.
+            migrations.upgrade(fm.db.engine, out=sys.stderr)
+
+        started = time.perf_counter()
+        rng = random.Random(args.seed)
+        decks = [seed_user(fm, benchmark_user(n), rng, args.exercises, args.tags, args.tags_per_exercise,
+                           args.attempts, args.history_days, args.resources) for n in range(args.users)]
+        print("seeded {} users in {:.1f}s".format(args.users, time.perf_counter() - started))
+
+    if args.target == "client":
+        target = ClientTarget(view.app, StatementCounter(fm.db.engine))
+    else:
+        target = HttpTarget(view.app, args.target)
+
+    results = {}
+    for route in routes:
+        results[route.name] = stats = drive_route(target, route, decks, args.concurrency, args.requests, args.warmup,
+                                                  args.seed)
+        print("{:<22} p50 {p50_ms:>8.2f}  p95 {p95_ms:>8.2f}  p99 {p99_ms:>8.2f} ms  {throughput_rps:>8.1f} req/s  "
+              "sql {sql}  {statuses}".format(route.name, sql=stats["sql_per_request"], **stats))
+
+    report = dict(recorded_at=datetime.now().isoformat(), target=target.name, backend=fm.backend.name,
+                  options=vars(args), routes=results)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("wrote {}".format(args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,202 @@
+"""
+cache.py
+
+Per-user read-through caching for the lookups FlashmarkModel does over and over again.
+
+Entries are grouped by user and namespace.  Every (user, namespace) pair has a generation token which is part of the
+key for each entry under it, so invalidating a user's exercises or resources is a matter of handing out a new token.
+Stale entries are never read again and simply age out of the backend.  Tokens age out too, after a day without
+changes, which costs that user one round of misses.
+"""
+import json
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+EXERCISES = "exercises"
+RESOURCES = "resources"
+GENERATION_TTL = 86400
+
+
+class LocalCache(object):
+    """
+    LRU cache with a time to live on each entry.  Lives in the memory of a single worker process.
+    Invalidation only reaches the worker that made the change, so this is only safe when one worker process serves
+    every request.  With more than one, the others keep serving what they cached until it expires.
+    """
+
+    def __init__(self, max_entries=2048, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, key):
+        """
+        Look up a key.
+        :param key: The key to look up.
+        :return: The stored value or None if it's missing or expired.
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.__entries[key]
+                return None
+
+            self.__entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value, evicting the least recently used entry if the cache is full.
+        :param key: The key to store the value under.
+        :param value: The value to store.
+        :param ttl: Seconds until the entry expires.  Defaults to the cache wide ttl.  0 means never.
+        :return: Nothing.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+
+        with self.__lock:
+            self.__entries[key] = (value, expires_at)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+class UwsgiCache(object):
+    """
+    Cache kept in a uwsgi cache2 store (see lm.ini) so that every worker on the box shares the same entries.
+    Eviction and expiry are handled by uwsgi itself.  Updates the store refuses, say because it is full, are counted
+    and logged rather than going unnoticed.
+    """
+
+    def __init__(self, cache_name, ttl=300, logger=None):
+        import uwsgi
+        self.uwsgi = uwsgi
+        self.cache_name = cache_name
+        self.ttl = ttl
+        self.logger = logger
+        self.failed_sets = 0
+
+    def get(self, key):
+        value = self.uwsgi.cache_get(key, self.cache_name)
+        return value.decode("utf8") if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if self.uwsgi.cache_update(key, value.encode("utf8"), ttl, self.cache_name):
+            return
+        self.failed_sets += 1
+        if self.logger and self.failed_sets % 1000 == 1:
+            self.logger.warning("uwsgi cache {} has refused {} updates.  Is it full?".format(
+                self.cache_name, self.failed_sets))
+
+
+class NullCache(object):
+    """
+    Backend that never holds onto anything.  Handy for switching caching off.
+    """
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+
+class ModelCache(object):
+    """
+    Read-through cache for model lookups with per-user, per-namespace invalidation.
+    Values have to be JSON serializable.  Every fetch hands back a fresh copy, so callers are free to mutate it.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def __generation(self, user_id, namespace):
+        gen_key = "gen:{}:{}".format(namespace, user_id)
+        generation = self.backend.get(gen_key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self.backend.set(gen_key, generation, GENERATION_TTL)
+        return generation
+
+    def fetch(self, user_id, namespace, key_parts, loader):
+        """
+        Get a value out of the cache, falling back on the loader to produce it when it isn't there.
+        :param user_id: The user the value belongs to.
+        :param namespace: Which group of values (EXERCISES or RESOURCES) it belongs to.
+        :param key_parts: Anything else that distinguishes the value, such as a tag name.
+        :param loader: Function with no arguments that produces the value on a miss.
+        :return: The cached or freshly loaded value.
+        """
+        generation = self.__generation(user_id, namespace)
+        key = ":".join([namespace, user_id or "", generation] + [str(part) for part in key_parts])
+
+        cached = self.backend.get(key)
+        if cached is not None:
+            self.hits += 1
+            return json.loads(cached)
+
+        self.misses += 1
+        value = loader()
+        self.backend.set(key, json.dumps(value))
+        return value
+
+    def invalidate(self, user_id, *namespaces):
+        """
+        Throw out everything cached for the user under the given namespaces.
+        :param user_id: The user whose data changed.
+        :param namespaces: The namespaces to throw out.
+        :return: Nothing.
+        """
+        for namespace in namespaces:
+            gen_key = "gen:{}:{}".format(namespace, user_id)
+            self.backend.set(gen_key, uuid.uuid4().hex, GENERATION_TTL)
+
+    def stats(self):
+        """
+        Hit and miss counts for this worker.
+        :return: A dictionary of the counters.
+        """
+        lookups = self.hits + self.misses
+        hit_ratio = float(self.hits) / lookups if lookups else 0.0
+        return dict(backend=type(self.backend).__name__, hits=self.hits, misses=self.misses, hit_ratio=hit_ratio,
+                    failed_sets=getattr(self.backend, "failed_sets", 0))
+
+
+def make_cache(config_section, logger=None):
+    """
+    Build the model cache described by the config file.
+    :param config_section: The learningmachine section of config.ini.
+    :param logger: Where to report falling back to a local cache when uwsgi isn't around, and updates uwsgi refuses.
+    :return: A ModelCache.
+    """
+    backend_name = config_section.get("cache_backend", "local")
+    ttl = config_section.getint("cache_ttl", 300)
+
+    if backend_name == "none":
+        backend = NullCache()
+    elif backend_name == "uwsgi":
+        try:
+            backend = UwsgiCache(config_section.get("cache_name", "flashmark"), ttl, logger)
+        except ImportError:
+            if logger:
+                logger.warning("uwsgi cache requested but not running under uwsgi.  Using a local cache instead, "
+                               "which is only safe with a single worker process.")
+            backend = LocalCache(config_section.getint("cache_max_entries", 2048), ttl)
+    else:
+        backend = LocalCache(config_section.getint("cache_max_entries", 2048), ttl)
+
+    return ModelCache(backend)
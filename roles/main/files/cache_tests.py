@@ -0,0 +1,85 @@
+import unittest
+import sys
+from unittest.mock import MagicMock, patch
+from cache import GENERATION_TTL, LocalCache, ModelCache, UwsgiCache, EXERCISES, RESOURCES
+
+
+class LocalCacheTestCase(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        local_cache = LocalCache(max_entries=2, ttl=0)
+        local_cache.set("a", "1")
+        local_cache.set("b", "2")
+        local_cache.get("a")
+        local_cache.set("c", "3")
+        self.assertEqual("1", local_cache.get("a"))
+        self.assertIsNone(local_cache.get("b"))
+        self.assertEqual("3", local_cache.get("c"))
+
+    def test_expires_entries(self):
+        local_cache = LocalCache(max_entries=2, ttl=10)
+        with patch("cache.time.monotonic", return_value=100.0):
+            local_cache.set("a", "1")
+        with patch("cache.time.monotonic", return_value=105.0):
+            self.assertEqual("1", local_cache.get("a"))
+        with patch("cache.time.monotonic", return_value=111.0):
+            self.assertIsNone(local_cache.get("a"))
+
+
+class ModelCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.model_cache = ModelCache(LocalCache())
+        self.test_user_id = "dummyuser@somewhere.com"
+
+    def test_read_through(self):
+        loader = MagicMock(return_value=[{"id": 1}])
+        first = self.model_cache.fetch(self.test_user_id, EXERCISES, ("all",), loader)
+        first.append({"id": 2})
+        second = self.model_cache.fetch(self.test_user_id, EXERCISES, ("all",), loader)
+        self.assertEqual([{"id": 1}], second)
+        self.assertEqual(1, loader.call_count)
+        self.assertEqual(1, self.model_cache.hits)
+        self.assertEqual(1, self.model_cache.misses)
+
+    def test_invalidate_only_touches_namespace(self):
+        exercise_loader = MagicMock(return_value=[])
+        resource_loader = MagicMock(return_value=[])
+        for i in range(2):
+            self.model_cache.fetch(self.test_user_id, EXERCISES, ("all",), exercise_loader)
+            self.model_cache.fetch(self.test_user_id, RESOURCES, ("all",), resource_loader)
+            self.model_cache.invalidate(self.test_user_id, EXERCISES)
+        self.assertEqual(2, exercise_loader.call_count)
+        self.assertEqual(1, resource_loader.call_count)
+
+    def test_users_are_kept_apart(self):
+        loader = MagicMock(return_value=[])
+        self.model_cache.fetch(self.test_user_id, EXERCISES, ("all",), loader)
+        self.model_cache.fetch("someoneelse@somewhere.com", EXERCISES, ("all",), loader)
+        self.assertEqual(2, loader.call_count)
+
+    def test_generations_expire(self):
+        backend = MagicMock()
+        backend.get.return_value = None
+        model_cache = ModelCache(backend)
+        model_cache.fetch(self.test_user_id, EXERCISES, ("all",), MagicMock(return_value=[]))
+        model_cache.invalidate(self.test_user_id, RESOURCES)
+        gen_ttls = [args[2] for args, kwargs in backend.set.call_args_list if args[0].startswith("gen:")]
+        self.assertEqual([GENERATION_TTL, GENERATION_TTL], gen_ttls)
+
+
+class UwsgiCacheTestCase(unittest.TestCase):
+    def test_counts_refused_updates(self):
+        uwsgi = MagicMock()
+        uwsgi.cache_update.side_effect = [True, None, None]
+        logger = MagicMock()
+        with patch.dict(sys.modules, {"uwsgi": uwsgi}):
+            uwsgi_cache = UwsgiCache("flashmark", logger=logger)
+
+        for key in ("a", "b", "c"):
+            uwsgi_cache.set(key, "1")
+        self.assertEqual(2, uwsgi_cache.failed_sets)
+        self.assertEqual(1, logger.warning.call_count)
+        self.assertEqual(2, ModelCache(uwsgi_cache).stats()["failed_sets"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+exercise_import.py
+
+Readers for bulk exercise imports.  Rows are pulled off the upload one line at a time, so a large deck never has to sit
+in memory all at once.
+
+Both readers produce ImportRow tuples.  A row that could not be parsed comes back with its error filled in and
+everything else left as None.  Length and tag validation happens in FlashmarkModel.import_exercises.
+"""
+import csv
+import json
+from collections import namedtuple
+
+ImportRow = namedtuple("ImportRow", ["line", "question", "answer", "tags", "error"])
+
+CSV_HEADER = ["question", "answer", "tags"]
+
+
+def read_csv(lines):
+    """
+    Read exercises out of CSV text.  Columns are question, answer and an optional space separated list of tags.
+    A header row naming those columns is allowed but not required.
+    :param lines: Iterable of text lines.
+    :return: A generator of ImportRow tuples.
+    """
+    reader = csv.reader(lines)
+    for fields in reader:
+        line = reader.line_num
+        if not fields or not any(field.strip() for field in fields):
+            continue
+        if line == 1 and [field.strip().lower() for field in fields] == CSV_HEADER[:len(fields)]:
+            continue
+        if len(fields) < 2 or len(fields) > 3:
+            yield ImportRow(line, None, None, None, "Expected question, answer and optional tags columns")
+            continue
+
+        question, answer, *tags = fields
+        tags = tags[0].split() if tags else []
+        yield ImportRow(line, question, answer, tags, None)
+
+
+def read_jsonl(lines):
+    """
+    Read exercises out of JSON lines text.  Each line is an object with question and answer keys and an optional tags
+    key holding either a space separated string or a list of tags.
+    :param lines: Iterable of text lines.
+    :return: A generator of ImportRow tuples.
+    """
+    for line, text in enumerate(lines, start=1):
+        if not text.strip():
+            continue
+        try:
+            json_ob = json.loads(text)
+        except ValueError:
+            yield ImportRow(line, None, None, None, "Line is not valid JSON")
+            continue
+
+        if not isinstance(json_ob, dict) or json_ob.get("question") is None or json_ob.get("answer") is None:
+            yield ImportRow(line, None, None, None, "Expected an object with question and answer keys")
+            continue
+
+        tags = json_ob.get("tags") or []
+        tags = tags.split() if isinstance(tags, str) else tags
+        yield ImportRow(line, str(json_ob["question"]), str(json_ob["answer"]), [str(tag) for tag in tags], None)
+
+
+READERS = {"csv": read_csv, "jsonl": read_jsonl}
@@ -1,4 +1,88 @@
-from oauth2client import client
+"""
+login.py
+
+Google OAuth logins.
+
+The client secrets and the discovery document for the profile API don't change while the app is running, so they are
+read once per worker by an OAuthClient and shared by every login after that.  Each login gets its own LoginHandler,
+which keeps track of how long each phase of the login took.
+
+The Google client libraries are slow to import, so they are only imported once a login actually needs them.
+"""
+import json
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
+from threading import Lock
+
+DEFAULT_SCOPE = "https://www.googleapis.com/auth/userinfo.email"
+DEFAULT_DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/plus/v1/rest"
+DEFAULT_TIMEOUT = 10
+
+
+class OAuthClient(object):
+    """
+    Everything about the OAuth setup that can be shared between logins: the parsed client secrets, the flow built
+    from them and the profile API's discovery document.  Each is loaded the first time it is needed and kept for the
+    life of the worker.
+    """
+
+    def __init__(self, secrets_file, scope, redirect_uri, auth_uri=None, token_uri=None,
+                 discovery_url=DEFAULT_DISCOVERY_URL, timeout=DEFAULT_TIMEOUT):
+        self.secrets_file = secrets_file
+        self.scope = scope
+        self.redirect_uri = redirect_uri
+        self.auth_uri = auth_uri
+        self.token_uri = token_uri
+        self.discovery_url = discovery_url
+        self.timeout = timeout
+
+        self.__lock = Lock()
+        self.__flow = None
+        self.__discovery_doc = None
+
+    @property
+    def flow(self):
+        """
+        :return: The OAuth2WebServerFlow for the client secrets file, built on first use.  Auth and token endpoints
+                 given to the constructor override the ones in the file.
+        """
+        if self.__flow is None:
+            from oauth2client import client, clientsecrets
+            with self.__lock:
+                if self.__flow is None:
+                    client_type, info = clientsecrets.loadfile(self.secrets_file)
+                    if client_type not in (clientsecrets.TYPE_WEB, clientsecrets.TYPE_INSTALLED):
+                        raise Exception("{} isn't a web or installed client secrets file".format(self.secrets_file))
+                    self.__flow = client.OAuth2WebServerFlow(info["client_id"], info["client_secret"],
+                                                             scope=self.scope, redirect_uri=self.redirect_uri,
+                                                             auth_uri=self.auth_uri or info["auth_uri"],
+                                                             token_uri=self.token_uri or info["token_uri"])
+        return self.__flow
+
+    def make_http(self):
+        """
+        :return: A new httplib2.Http with the client's timeout.  These aren't thread safe so each login gets its own.
+        """
+        import httplib2
+        return httplib2.Http(timeout=self.timeout)
+
+    def discovery_doc(self, http):
+        """
+        :param http: Http object to fetch the document with if it hasn't been fetched yet.
+        :return: The profile API's discovery document as text.
+        """
+        if self.__discovery_doc is None:
+            res, content = http.request(self.discovery_url)
+            if res.status >= 400:
+                raise Exception("Couldn't get the discovery document from {}: {}".format(self.discovery_url,
+                                                                                       res.status))
+            content = content.decode("utf8") if isinstance(content, bytes) else content
+            # Kept as text since building a service modifies the parsed document.  Parse it once here anyway so a
+            # broken document fails this login rather than being cached.
+            json.loads(content)
+            self.__discovery_doc = content
+        return self.__discovery_doc
 
 
 class LoginHandler(object):
@@ -8,21 +92,37 @@ class LoginHandler(object):
     Also assumes that permission scope and redirects are registered there as well.
     """
 
-    def __init__(self, secrets_file, scope, redirect_uri):
-        self.secrets_file = secrets_file
-        self.scope = scope
-        self.redirect_uri = redirect_uri
-        self.flow = client.flow_from_clientsecrets(secrets_file, scope=scope, redirect_uri=redirect_uri)
+    def __init__(self, oauth_client):
+        self.oauth_client = oauth_client
+        self.timings = OrderedDict()
         self.__display_name = None
         self.__email = None
 
+    @contextmanager
+    def timed(self, phase):
+        """
+        Record how long the body of the with block takes under the given phase name.
+        :param phase: Name of the login phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0) + time.perf_counter() - start
+
+    def describe_timings(self):
+        """
+        :return: The phase timings as text fit for the log, in milliseconds.
+        """
+        return " ".join("{}={:.1f}ms".format(phase, seconds * 1000) for phase, seconds in self.timings.items())
+
     @property
     def auth_url(self):
         """
         Makes a url that can be used to send the user on over to a Google login page.
         :return: The proper Google login url.
         """
-        url = self.flow.step1_get_authorize_url()
+        url = self.oauth_client.flow.step1_get_authorize_url()
         return url
 
     def setup_user_info(self, code):
@@ -35,12 +135,16 @@ class LoginHandler(object):
         :param code: The code that Google returns upon redirect from Google after a successful login.
         :return: Nothing.  Email and display name placed into session scope.
         """
-        import httplib2
-        from apiclient import discovery
-        creds = self.flow.step2_exchange(code)
-        http_auth = creds.authorize(httplib2.Http())
-        service = discovery.build("plus", "v1", http_auth)
-        res = service.people().get(userId="me").execute()
+        from googleapiclient import discovery
+        http = self.oauth_client.make_http()
+        with self.timed("exchange"):
+            creds = self.oauth_client.flow.step2_exchange(code, http=http)
+        with self.timed("discovery"):
+            doc = self.oauth_client.discovery_doc(http)
+        with self.timed("profile"):
+            http_auth = creds.authorize(http)
+            service = discovery.build_from_document(doc, http=http_auth)
+            res = service.people().get(userId="me").execute()
         self.__email = res.get("emails")[0].get("value")
         self.__display_name = res.get("displayName")
 
@@ -58,4 +162,20 @@ class LoginHandler(object):
         Accessor for the full name of the user.
         :return: The full username.
         """
-        return self.__display_name
\ No newline at end of file
+        return self.__display_name
+
+
+def make_client(config_section, secrets_file):
+    """
+    Build the OAuth client described by the config file.
+    :param config_section: The learningmachine section of config.ini.
+    :param secrets_file: Path to client_secret.json.
+    :return: An OAuthClient.
+    """
+    redirect_uri = config_section.get("login_redirect_uri",
+                                      "http://{}/login".format(config_section.get("domain", "localhost")))
+    return OAuthClient(secrets_file, config_section.get("login_scope", DEFAULT_SCOPE), redirect_uri,
+                       auth_uri=config_section.get("login_auth_uri") or None,
+                       token_uri=config_section.get("login_token_uri") or None,
+                       discovery_url=config_section.get("login_discovery_url", DEFAULT_DISCOVERY_URL),
+                       timeout=config_section.getfloat("login_timeout", DEFAULT_TIMEOUT))
@@ -0,0 +1,109 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from login import OAuthClient, LoginHandler
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Plays the parts of Google's token endpoint, discovery service and profile API.  Every request path is counted so
+    tests can tell what got fetched again.
+    """
+    hits = {}
+
+    def count(self):
+        path = urlparse(self.path).path
+        StubHandler.hits[path] = StubHandler.hits.get(path, 0) + 1
+        return path
+
+    def do_POST(self):
+        path = self.count()
+        body = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode("utf8"))
+        if path == "/token" and body.get("code") == ["good-code"]:
+            self.send_json(dict(access_token="stub-token", token_type="Bearer", expires_in=3600))
+        else:
+            self.send_json(dict(error="invalid_grant"), 400)
+
+    def do_GET(self):
+        path = self.count()
+        if path == "/discovery":
+            self.send_json(discovery_doc("http://127.0.0.1:{}/".format(self.server.server_port)))
+        elif path == "/plus/v1/people/me" and self.headers.get("Authorization") == "Bearer stub-token":
+            self.send_json(dict(displayName="Dummy User", emails=[dict(value="dummyuser@somewhere.com")]))
+        else:
+            self.send_json(dict(error="not found"), 404)
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def discovery_doc(root_url):
+    people_get = dict(id="plus.people.get", path="people/{userId}", httpMethod="GET", parameterOrder=["userId"],
+                      parameters=dict(userId=dict(type="string", required=True, location="path")),
+                      response={"$ref": "Person"})
+    return dict(kind="discovery#restDescription", name="plus", version="v1", rootUrl=root_url,
+                servicePath="plus/v1/", baseUrl=root_url + "plus/v1/", schemas=dict(Person=dict(id="Person")),
+                resources=dict(people=dict(methods=dict(get=people_get))))
+
+
+class LoginTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        cls.server.daemon_threads = True
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base_url = "http://127.0.0.1:{}".format(cls.server.server_port)
+
+        secrets = dict(web=dict(client_id="stub-client", client_secret="stub-secret",
+                                auth_uri="https://accounts.google.com/o/oauth2/auth",
+                                token_uri="https://oauth2.googleapis.com/token",
+                                redirect_uris=["http://localhost/login"]))
+        handle, cls.secrets_file = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(handle, "w") as f:
+            json.dump(secrets, f)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        os.remove(cls.secrets_file)
+
+    def setUp(self):
+        StubHandler.hits = {}
+        self.client = OAuthClient(self.secrets_file, "email", "http://localhost/login",
+                                  auth_uri=self.base_url + "/auth", token_uri=self.base_url + "/token",
+                                  discovery_url=self.base_url + "/discovery", timeout=5)
+
+    def test_auth_url(self):
+        url = urlparse(LoginHandler(self.client).auth_url)
+        self.assertEqual(self.base_url + "/auth", "{}://{}{}".format(url.scheme, url.netloc, url.path))
+        self.assertEqual(["stub-client"], parse_qs(url.query)["client_id"])
+
+    def test_login_reuses_flow_and_discovery(self):
+        for _ in range(3):
+            handler = LoginHandler(self.client)
+            handler.setup_user_info("good-code")
+            self.assertEqual("dummyuser@somewhere.com", handler.email)
+            self.assertEqual("Dummy User", handler.display_name)
+            self.assertEqual(["exchange", "discovery", "profile"], list(handler.timings))
+
+        self.assertIs(self.client.flow, LoginHandler(self.client).oauth_client.flow)
+        self.assertEqual({"/token": 3, "/discovery": 1, "/plus/v1/people/me": 3}, StubHandler.hits)
+
+    def test_bad_code(self):
+        with self.assertRaises(Exception):
+            LoginHandler(self.client).setup_user_info("bad-code")
+        self.assertNotIn("/discovery", StubHandler.hits)
@@ -0,0 +1,73 @@
+#!/var/app/learningmachine/venv/bin/python3.4
+"""
+maintenance.py
+
+Housekeeping jobs for the Flashmark database, run by hand or from cron.
+
+    maintenance.py backfill-rollups [user_id]   Rebuild the daily attempt rollups from the raw attempts.
+    maintenance.py archive [days]               Move attempts older than days (archive_after_days in config.ini by
+                                                default) into the attempts archive.
+    maintenance.py reindex-search [user_id]     Rebuild the search index from the exercises and resources.
+    maintenance.py purge [batch_size]           Remove deleted exercises along with their tags, attempts, rollups
+                                                and resource links.
+"""
+import sys
+from model import FlashmarkModel
+
+
+def backfill_rollups(fm, user_id=None):
+    """
+    Rebuild the daily attempt rollups.
+    :param fm: The FlashmarkModel to work through.
+    :param user_id: Only rebuild this user's rollups.  Everyone's if left out.
+    :return: Nothing.
+    """
+    rows = fm.backfill_attempt_rollups(user_id)
+    print("wrote {} rollup rows for {}".format(rows, user_id or "all users"))
+
+
+def archive(fm, days=None):
+    """
+    Move old attempts into the archive tier.
+    :param fm: The FlashmarkModel to work through.
+    :param days: Age in days past which attempts get archived.  No less than archive_after_days in config.ini.
+    :return: Nothing.
+    """
+    moved = fm.archive_attempts(int(days) if days is not None else None)
+    print("archived {} attempts".format(moved))
+
+
+def reindex_search(fm, user_id=None):
+    """
+    Rebuild the search index.
+    :param fm: The FlashmarkModel to work through.
+    :param user_id: Only reindex this user's exercises and resources.  Everyone's if left out.
+    :return: Nothing.
+    """
+    documents = fm.reindex_search(user_id)
+    print("indexed {} documents for {}".format(documents, user_id or "all users"))
+
+
+def purge(fm, batch_size=None):
+    """
+    Clear out exercises that have been deleted.
+    :param fm: The FlashmarkModel to work through.
+    :param batch_size: How many rows to remove per transaction (purge_batch_size in config.ini by default).
+    :return: Nothing.
+    """
+    purged = fm.purge_deleted_exercises(int(batch_size) if batch_size is not None else None)
+    print("purged {} deleted exercises".format(purged))
+
+
+COMMANDS = {"backfill-rollups": backfill_rollups, "archive": archive, "reindex-search": reindex_search,
+            "purge": purge}
+
+if __name__ == '__main__':
+    command, *args = sys.argv[1:] or [None]
+    if command not in COMMANDS:
+        print("usage: maintenance.py [{}] [args]".format("|".join(COMMANDS)))
+        sys.exit(2)
+
+    fm = FlashmarkModel()
+    with fm.app.app_context():
+        COMMANDS[command](fm, *args)
@@ -0,0 +1,287 @@
+"""
+metrics.py
+
+Request and database metrics for Flashmark, served in the Prometheus text format.
+
+Every request is timed and counted by route, method and status, along with the bytes sent back.  SQLAlchemy event hooks
+count the statements each request runs and the time spent waiting on the database.  Connection pool gauges are read
+from the model whenever the metrics are scraped.
+
+Numbers are kept per worker process, like /stats.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, g, request
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+UNMATCHED_ROUTE = "unmatched"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def format_labels(labels):
+    """
+    :param labels: List of (name, value) tuples.
+    :return: Prometheus label set, or an empty string when there are no labels.
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join("{}=\"{}\"".format(name, escape_label(value)) for name, value in labels) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    """
+    Registered on the app and the model's engine by init_app.  Everything is guarded by one lock; updates are a
+    handful of dictionary operations per request.
+    """
+
+    def __init__(self, fm=None, buckets=DEFAULT_BUCKETS):
+        self.fm = fm
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+
+        # (route, method) -> [count per bucket..., sum, count]
+        self.latency = {}
+        # (route, method, status) -> count
+        self.responses = {}
+        # (route, method) -> bytes
+        self.response_bytes = {}
+        # route -> statements, seconds
+        self.sql_statements = {}
+        self.sql_seconds = {}
+        # Statements run outside of any request, such as from maintenance jobs run in process.
+        self.background_statements = 0
+        self.background_seconds = 0.0
+
+    def init_app(self, app, engine=None):
+        """
+        Start recording requests to the app and, if given, statements sent through the engine.
+        Register this before any after_request hook that changes the body, such as compression, so that the bytes
+        counted are the ones actually sent.
+        :param app: The Flask app.
+        :param engine: The SQLAlchemy engine the model uses.
+        :return: self.
+        """
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        if engine is not None:
+            self.init_engine(engine)
+        return self
+
+    def init_engine(self, engine):
+        """
+        Start counting statements sent through the engine.
+        :param engine: The SQLAlchemy engine the model uses.
+        :return: self.
+        """
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+        return self
+
+    @staticmethod
+    def route_of(req):
+        return req.url_rule.rule if req.url_rule is not None else UNMATCHED_ROUTE
+
+    @staticmethod
+    def new_request():
+        """
+        :return: Dict to gather one request's timing and SQL counts in.
+        """
+        return dict(started=time.perf_counter(), sql_statements=0, sql_seconds=0.0)
+
+    @contextmanager
+    def bound(self, request_stats):
+        """
+        Count the statements this thread runs against a request, for requests that hand their database work to
+        other threads.
+        :param request_stats: What new_request returned for the request, or None.
+        :return: A context manager.
+        """
+        previous = getattr(self.local, "request", None)
+        self.local.request = request_stats
+        try:
+            yield
+        finally:
+            self.local.request = previous
+
+    def before_request(self):
+        g.metrics_request = self.local.request = self.new_request()
+
+    def after_request(self, response):
+        request_stats = g.get("metrics_request")
+        self.local.request = None
+        if request_stats is None:
+            return response
+        route, method = self.route_of(request), request.method
+        size = None if response.is_streamed else len(response.get_data())
+        self.finish_request(request_stats, route, method, response.status_code, size)
+        if response.is_streamed:
+            response.response = self.count_streamed(route, method, response.response)
+        return response
+
+    def finish_request(self, request_stats, route, method, status, size=None):
+        """
+        Record a request once its response is ready.
+        :param request_stats: What new_request returned when the request came in.
+        :param route: The URL rule the request matched.
+        :param method: The HTTP method.
+        :param status: The response status code.
+        :param size: The response body size, or None to leave it to count_streamed.
+        :return: Nothing.
+        """
+        elapsed = time.perf_counter() - request_stats["started"]
+        with self.lock:
+            histogram = self.latency.get((route, method))
+            if histogram is None:
+                histogram = self.latency[(route, method)] = [0] * len(self.buckets) + [0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    histogram[position] += 1
+            histogram[-2] += elapsed
+            histogram[-1] += 1
+
+            status_key = (route, method, status)
+            self.responses[status_key] = self.responses.get(status_key, 0) + 1
+            self.sql_statements[route] = self.sql_statements.get(route, 0) + request_stats["sql_statements"]
+            self.sql_seconds[route] = self.sql_seconds.get(route, 0.0) + request_stats["sql_seconds"]
+        if size is not None:
+            self.add_bytes(route, method, size)
+
+    def add_bytes(self, route, method, size):
+        with self.lock:
+            self.response_bytes[(route, method)] = self.response_bytes.get((route, method), 0) + size
+
+    def count_streamed(self, route, method, chunks):
+        """
+        Pass a streamed body through, adding up its size as it goes out.
+        """
+        size = 0
+        try:
+            for chunk in chunks:
+                size += len(chunk.encode("utf8") if isinstance(chunk, str) else chunk)
+                yield chunk
+        finally:
+            self.add_bytes(route, method, size)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("metrics_started")
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        request_stats = getattr(self.local, "request", None)
+        if request_stats is not None:
+            request_stats["sql_statements"] += 1
+            request_stats["sql_seconds"] += elapsed
+        else:
+            with self.lock:
+                self.background_statements += 1
+                self.background_seconds += elapsed
+
+    def render(self):
+        """
+        :return: Every metric in the Prometheus text format.
+        """
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append("{}{}{} {}".format(name, suffix, format_labels(labels), format_value(value)))
+
+        with self.lock:
+            latency = sorted((key, list(values)) for key, values in self.latency.items())
+            responses = sorted(self.responses.items())
+            response_bytes = sorted(self.response_bytes.items())
+            sql_statements = sorted(self.sql_statements.items())
+            sql_seconds = sorted(self.sql_seconds.items())
+            background = (self.background_statements, self.background_seconds)
+
+        samples = []
+        for (route, method), histogram in latency:
+            labels = [("method", method), ("route", route)]
+            for bound, count in zip(self.buckets, histogram):
+                samples.append(("_bucket", labels + [("le", format_value(float(bound)))], count))
+            samples.append(("_bucket", labels + [("le", "+Inf")], histogram[-1]))
+            samples.append(("_sum", labels, histogram[-2]))
+            samples.append(("_count", labels, histogram[-1]))
+        family("flashmark_request_duration_seconds", "histogram",
+               "Time spent handling requests, up until the response started going out.", samples)
+
+        family("flashmark_responses_total", "counter", "Responses sent, by status code.",
+               [("", [("method", method), ("route", route), ("status", status)], count)
+                for (route, method, status), count in responses])
+        family("flashmark_response_bytes_total", "counter", "Response body bytes sent.",
+               [("", [("method", method), ("route", route)], size) for (route, method), size in response_bytes])
+
+        family("flashmark_sql_statements_total", "counter", "SQL statements sent to the database.",
+               [("", [("route", route)], count) for route, count in sql_statements] +
+               [("", [("route", "")], background[0])])
+        family("flashmark_sql_seconds_total", "counter", "Time spent waiting on SQL statements.",
+               [("", [("route", route)], seconds) for route, seconds in sql_seconds] +
+               [("", [("route", "")], background[1])])
+
+        if self.fm is not None:
+            pool = self.fm.pool_stats()
+            for gauge in ("size", "checkedin", "checkedout", "overflow"):
+                if gauge in pool:
+                    family("flashmark_pool_{}".format(gauge), "gauge",
+                           "Connection pool {} right now.".format(gauge), [("", [], pool[gauge])])
+            family("flashmark_pool_checkouts_total", "counter", "Connections taken from the pool.",
+                   [("", [], pool["checkouts"])])
+            family("flashmark_pool_checkout_wait_seconds_total", "counter", "Time spent waiting for a connection.",
+                   [("", [], pool["checkout_wait_total"])])
+            family("flashmark_pool_checkout_wait_max_seconds", "gauge", "Longest wait for a connection so far.",
+                   [("", [], pool["checkout_wait_max"])])
+
+        family("flashmark_process_start_time_seconds", "gauge", "When this worker started, in seconds since the epoch.",
+               [("", [], self.started)])
+        return "\n".join(lines) + "\n"
+
+    def response(self):
+        """
+        :return: A Response holding the rendered metrics.
+        """
+        return Response(self.render(), mimetype=None, content_type=CONTENT_TYPE)
+
+
+def buckets_from_config(config_section):
+    """
+    :param config_section: The learningmachine section of config.ini.  metrics_buckets may hold comma separated latency
+                           bucket bounds in seconds.
+    :return: The latency bucket bounds.
+    """
+    if config_section is not None and config_section.get("metrics_buckets"):
+        return [float(bound) for bound in config_section.get("metrics_buckets").split(",")]
+    return DEFAULT_BUCKETS
+
+
+def init_app(app, fm, config_section=None):
+    """
+    Turn on metrics for the app and the model's engine.  Building the engine doesn't connect to the database.
+    :param app: The Flask app.
+    :param fm: The FlashmarkModel.
+    :param config_section: The learningmachine section of config.ini.
+    :return: The Metrics that was registered.
+    """
+    with fm.app.app_context():
+        engine = fm.db.engine
+    return Metrics(fm, buckets_from_config(config_section)).init_app(app, engine)
@@ -0,0 +1,56 @@
+import unittest
+from unittest.mock import MagicMock
+from flask import Flask, Response
+from sqlalchemy import create_engine
+import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.engine = create_engine("sqlite://")
+        self.fm = MagicMock()
+        self.fm.pool_stats.return_value = dict(size=5, checkedin=4, checkedout=1, overflow=-4, checkouts=7,
+                                               checkout_wait_total=0.5, checkout_wait_max=0.25)
+        self.metrics = metrics.Metrics(self.fm, buckets=(0.1, 1.0)).init_app(self.app, self.engine)
+
+        @self.app.route("/things/<int:thing_id>")
+        def get_thing(thing_id):
+            self.engine.execute("select 1")
+            self.engine.execute("select 2")
+            return "thing {}".format(thing_id)
+
+        @self.app.route("/stream")
+        def stream():
+            return Response((chunk for chunk in ["ab", "cde"]))
+
+    def test_counts_requests_by_route(self):
+        with self.app.test_client() as client:
+            client.get("/things/1")
+            client.get("/things/2")
+            client.get("/nowhere")
+
+        text = self.metrics.render()
+        self.assertIn('flashmark_request_duration_seconds_count{method="GET",route="/things/<int:thing_id>"} 2', text)
+        self.assertIn('flashmark_request_duration_seconds_bucket{method="GET",route="/things/<int:thing_id>",le="+Inf"} 2',
+                      text)
+        self.assertIn('flashmark_responses_total{method="GET",route="/things/<int:thing_id>",status="200"} 2', text)
+        self.assertIn('flashmark_responses_total{method="GET",route="unmatched",status="404"} 1', text)
+        self.assertIn('flashmark_response_bytes_total{method="GET",route="/things/<int:thing_id>"} 14', text)
+        self.assertIn('flashmark_sql_statements_total{route="/things/<int:thing_id>"} 4', text)
+        self.assertIn("flashmark_pool_checkedout 1", text)
+        self.assertIn("flashmark_pool_checkout_wait_max_seconds 0.25", text)
+
+    def test_counts_streamed_bytes_and_background_sql(self):
+        with self.app.test_client() as client:
+            res = client.get("/stream")
+            self.assertEqual(b"abcde", res.data)
+        self.engine.execute("select 1")
+
+        text = self.metrics.render()
+        self.assertIn('flashmark_response_bytes_total{method="GET",route="/stream"} 5', text)
+        self.assertIn('flashmark_sql_statements_total{route=""} 1', text)
+
+    def test_escapes_labels(self):
+        self.assertEqual('{route="a\\"b\\\\c\\nd"}', metrics.format_labels([("route", 'a"b\\c\nd')]))
+        self.assertEqual("", metrics.format_labels([]))
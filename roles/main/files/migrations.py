@@ -0,0 +1,376 @@
+#!/var/app/learningmachine/venv/bin/python3.4
+"""
+migrations.py
+
+Versioned schema changes for the Flashmark database.
+
+    migrations.py upgrade   Create any missing tables, then apply every migration that hasn't been applied yet.
+    migrations.py status    List the migrations and whether or not each one has been applied.
+    migrations.py check     EXPLAIN the hot queries and fail if any of them can't use the index it depends on.
+
+Fresh databases get the full schema straight from tabledefs.py, so each migration checks what is already there and
+only makes the changes that are missing.  That way the same list brings both old and new databases to the same place.
+"""
+import sys
+from collections import namedtuple
+from configparser import ConfigParser
+from datetime import datetime
+from sqlalchemy import bindparam, create_engine, inspect, text
+from sqlalchemy.exc import DBAPIError
+from tabledefs import meta, schema_version_table
+import backends
+import resource_urls
+import search
+
+# Migrations are applied in a transaction of their own unless own_transactions is set, for ones that work through big
+# tables a batch at a time and commit as they go.
+Migration = namedtuple("Migration", ["version", "description", "apply", "own_transactions"])
+Migration.__new__.__defaults__ = (False,)
+INDEX_BATCH_SIZE = 1000
+
+# Hot query, the table it reads, and the index that table has to be able to use.  Bind values are placeholders;
+# only the plan matters.
+PlanCheck = namedtuple("PlanCheck", ["name", "sql", "params", "table", "index"])
+
+
+def engine_from_config(dir_path=None):
+    """
+    Build an engine for the backend in config.ini.  On MySQL it logs in as root, since schema changes need more than
+    the public user has.
+    :param dir_path: Directory holding config.ini.  Defaults to the one this file is in.
+    :return: A SQLAlchemy engine.
+    """
+    cp = ConfigParser()
+    dir_path = dir_path or __file__.rsplit("/", maxsplit=1)[0]
+    config_file_name = "{}/{}".format(dir_path, "config.ini")
+    cp.read(config_file_name)
+
+    backend = backends.make_backend(cp["learningmachine"], dir_path)
+    eng = create_engine(backend.url(admin=True))
+    backend.configure_engine(eng)
+    return eng
+
+
+def add_column(conn, table_name, column_def):
+    """
+    Add a column to a table unless it's already there.
+    :param conn: The database connection.
+    :param table_name: Table to add the column to.
+    :param column_def: Column definition as it would appear in 'alter table ... add column'.
+    :return: Nothing.
+    """
+    column_name = column_def.split()[0]
+    existing = set(column["name"] for column in inspect(conn).get_columns(table_name))
+    if column_name not in existing:
+        conn.execute("alter table {} add column {}".format(table_name, column_def))
+
+
+def create_index(conn, table_name, index_name, columns, unique=False):
+    """
+    Create an index unless one by that name is already there.
+    :param conn: The database connection.
+    :param table_name: Table to index.
+    :param index_name: Name for the index.
+    :param columns: List of column names to index, in order.
+    :param unique: Whether to make it a unique index.
+    :return: Nothing.
+    """
+    existing = set(index["name"] for index in inspect(conn).get_indexes(table_name))
+    if index_name not in existing:
+        conn.execute("create {}index {} on {} ({})".format("unique " if unique else "", index_name, table_name,
+                                                           ", ".join(columns)))
+
+
+def migrate_scheduling_columns(conn):
+    add_column(conn, "exercises", "ease_factor float default 2.5")
+    add_column(conn, "exercises", "interval_days integer default 0")
+    add_column(conn, "exercises", "repetitions integer default 0")
+    add_column(conn, "exercises", "due_at datetime null")
+    create_index(conn, "exercises", "ix_exercises_user_due", ["user_id", "due_at"])
+
+
+def migrate_attempt_index(conn):
+    create_index(conn, "attempts", "ix_attempts_exercise", ["exercise_id"])
+
+
+def migrate_difficulty_index(conn):
+    create_index(conn, "exercises", "ix_exercises_user_difficulty", ["user_id", "difficulty"])
+
+
+def migrate_tag_link_index(conn):
+    create_index(conn, "exercises_by_exercise_tags", "ix_ebet_user_tag", ["user_id", "tag_name", "exercise_id"])
+
+
+def migrate_exercise_text_columns(conn):
+    # Questions and answers are capped at CHARACTER_LIMIT characters, so they can live inline as varchar.
+    # SQLite doesn't enforce column types, so there's nothing to do there.
+    if conn.dialect.name == "mysql":
+        conn.execute("alter table exercises modify question varchar(140), modify answer varchar(140)")
+
+
+def migrate_attempt_rollups(conn):
+    # create_all has already made the table.  Fill it in from the attempts recorded before it existed.
+    if conn.execute("select count(*) from attempt_rollups").scalar():
+        return
+    conn.execute("""
+    insert into attempt_rollups (exercise_id, day, user_id, bad, okay, good)
+    select a.exercise_id, date(a.when_attempted), e.user_id,
+           sum(case when a.score = 1 then 1 else 0 end),
+           sum(case when a.score = 2 then 1 else 0 end),
+           sum(case when a.score = 3 then 1 else 0 end)
+    from attempts as a
+    join exercises as e
+    on a.exercise_id = e.id
+    group by a.exercise_id, date(a.when_attempted), e.user_id""")
+
+
+def migrate_attempt_archive(conn):
+    # create_all makes attempts_archive itself.  Archiving finds old attempts by when_attempted.
+    create_index(conn, "attempts", "ix_attempts_when", ["when_attempted"])
+
+
+def migrate_data_version(conn):
+    add_column(conn, "users", "data_version integer default 0")
+
+
+def index_search_terms(conn, exercise_filter="", batch_size=INDEX_BATCH_SIZE):
+    """
+    Write the search_terms rows for every exercise and resource, a batch of documents at a time, each batch in its own
+    transaction.  Each batch replaces whatever rows its documents had, so running it again after an interruption
+    picks up cleanly.
+    :param conn: The database connection, outside of any transaction.
+    :param exercise_filter: Extra condition on which exercises get indexed, starting with "and".
+    :param batch_size: How many documents to index per transaction.
+    :return: Nothing.
+    """
+    search_terms = meta.tables["search_terms"]
+    documents = [
+        (search.EXERCISE, "select id, user_id, question, answer from exercises where id > :after {} order by id "
+                          "limit :lim".format(exercise_filter),
+         lambda eid, user_id, question, answer: search.exercise_rows(user_id, eid, question, answer)),
+        (search.RESOURCE, "select id, user_id, caption from resources where id > :after order by id limit :lim",
+         lambda rid, user_id, caption: search.resource_rows(user_id, rid, caption)),
+    ]
+    for kind, query, rows_for in documents:
+        after = 0
+        while True:
+            with conn.begin():
+                batch = conn.execute(text(query), after=after, lim=batch_size).fetchall()
+                if not batch:
+                    break
+                doc_ids = [row[0] for row in batch]
+                conn.execute(search_terms.delete().where(search_terms.c.kind == kind)
+                             .where(search_terms.c.doc_id.in_(doc_ids)))
+                rows = [term_row for row in batch for term_row in rows_for(*row)]
+                if rows:
+                    conn.execute(search_terms.insert(), rows)
+            after = doc_ids[-1]
+
+
+def migrate_search_index(conn):
+    # create_all makes search_terms.  Index everything written before it existed.
+    index_search_terms(conn)
+
+
+def migrate_soft_delete(conn):
+    add_column(conn, "exercises", "deleted_at datetime null")
+    create_index(conn, "exercises", "ix_exercises_deleted", ["deleted_at"])
+
+
+def migrate_resource_dedupe(conn):
+    # Key every resource by its normalized URL and fold each user's copies of a URL into the oldest one, moving the
+    # exercise links across, before the key is made unique.
+    add_column(conn, "resources", "url_key varchar(40) null")
+    resources, links = meta.tables["resources"], meta.tables["resources_by_exercise"]
+
+    keepers, keys, duplicates = {}, [], {}
+    for rid, user_id, url in conn.execute("select id, user_id, url from resources order by id"):
+        key = resource_urls.url_key(url or "")
+        keeper = keepers.setdefault((user_id, key), rid)
+        if keeper == rid:
+            keys.append(dict(rid=rid, key=key))
+        else:
+            duplicates[rid] = keeper
+
+    if keys:
+        conn.execute(resources.update().where(resources.c.id == bindparam("rid")).values(url_key=bindparam("key")),
+                     keys)
+
+    duplicate_ids = sorted(duplicates)
+    for start in range(0, len(duplicate_ids), 500):
+        chunk = duplicate_ids[start:start + 500]
+        moved = [dict(resource_id=duplicates[rid], exercise_id=eid) for rid, eid
+                 in conn.execute(links.select().where(links.c.resource_id.in_(chunk)))]
+        if moved:
+            conn.execute(backends.for_connection(conn).insert_ignore(links), moved)
+        conn.execute(links.delete().where(links.c.resource_id.in_(chunk)))
+        search_terms = meta.tables["search_terms"]
+        conn.execute(search_terms.delete().where(search_terms.c.kind == search.RESOURCE)
+                     .where(search_terms.c.doc_id.in_(chunk)))
+        conn.execute(resources.delete().where(resources.c.id.in_(chunk)))
+
+    create_index(conn, "resources", "ux_resources_user_url", ["user_id", "url_key"], unique=True)
+
+
+def migrate_search_term_collation(conn):
+    # Under MySQL's default utf8 collation, terms that differ only in accents or case were the same key, so documents
+    # with both "café" and "cafe" couldn't be indexed.  Terms are compared byte for byte now and folded to unaccented
+    # form by search.tokenize, so the index is built again with the folded terms.
+    if conn.dialect.name == "mysql":
+        conn.execute("alter table search_terms modify term varchar(64) character set utf8 collate utf8_bin not null")
+    index_search_terms(conn, "and deleted_at is null")
+
+
+MIGRATIONS = [
+    Migration(1, "Spaced repetition columns on exercises", migrate_scheduling_columns),
+    Migration(2, "Index attempts by exercise", migrate_attempt_index),
+    Migration(3, "Index exercises by user and difficulty", migrate_difficulty_index),
+    Migration(4, "Index tag links by user and tag", migrate_tag_link_index),
+    Migration(5, "Exercise question and answer as varchar(140)", migrate_exercise_text_columns),
+    Migration(6, "Daily attempt rollups", migrate_attempt_rollups),
+    Migration(7, "Archive tier for old attempts", migrate_attempt_archive),
+    Migration(8, "Per user data version", migrate_data_version),
+    Migration(9, "Search index over exercises and resources", migrate_search_index, own_transactions=True),
+    Migration(10, "Soft delete for exercises", migrate_soft_delete),
+    Migration(11, "One resource per user and URL", migrate_resource_dedupe),
+    Migration(12, "Search terms compared byte for byte", migrate_search_term_collation, own_transactions=True),
+]
+
+
+PLAN_CHECKS = [
+    PlanCheck("attempts for an exercise",
+              "select score, when_attempted from attempts where exercise_id = :eid",
+              dict(eid=0), "attempts", "ix_attempts_exercise"),
+    PlanCheck("attempt history join",
+              "select a.exercise_id, a.score, a.when_attempted from attempts as a join exercises as e "
+              "on a.exercise_id = e.id where e.user_id = :uid order by a.exercise_id, a.id",
+              dict(uid=""), "a", "ix_attempts_exercise"),
+    PlanCheck("hardest exercise",
+              "select max(difficulty) from exercises where user_id = :uid",
+              dict(uid=""), "exercises", "ix_exercises_user_difficulty"),
+    PlanCheck("exercises with a tag",
+              "select exercise_id from exercises_by_exercise_tags where user_id = :uid and tag_name = :tag",
+              dict(uid="", tag=""), "exercises_by_exercise_tags", "ix_ebet_user_tag"),
+    PlanCheck("next exercises due",
+              "select id, due_at from exercises where user_id = :uid and deleted_at is null "
+              "order by due_at, id limit 10",
+              dict(uid=""), "exercises", "ix_exercises_user_due"),
+    PlanCheck("daily attempt summary",
+              "select exercise_id, day, bad, okay, good from attempt_rollups where user_id = :uid "
+              "order by exercise_id, day",
+              dict(uid=""), "attempt_rollups", "ix_attempt_rollups_user_day"),
+    PlanCheck("search term prefix",
+              "select kind, doc_id, max(weight) from search_terms where user_id = :uid and term >= :low and term < :high "
+              "group by kind, doc_id",
+              dict(uid="", low="py", high="pz"), "search_terms", "PRIMARY"),
+    PlanCheck("archived attempts for an exercise",
+              "select score, when_attempted from attempts_archive where exercise_id = :eid",
+              dict(eid=0), "attempts_archive", "ix_attempts_archive_exercise"),
+    PlanCheck("attempts due for archiving",
+              "select id from attempts where when_attempted < :cutoff",
+              dict(cutoff="2000-01-01"), "attempts", "ix_attempts_when"),
+    PlanCheck("deleted exercises to purge",
+              "select id from exercises where deleted_at is not null",
+              dict(), "exercises", "ix_exercises_deleted"),
+    PlanCheck("resource by url",
+              "select id from resources where user_id = :uid and url_key = :key",
+              dict(uid="", key=""), "resources", "ux_resources_user_url"),
+]
+
+
+def applied_versions(conn):
+    """
+    :param conn: The database connection.
+    :return: Set of migration versions already applied.
+    """
+    return set(version for version, *_ in conn.execute(schema_version_table.select()))
+
+
+def upgrade(eng, out=sys.stdout):
+    """
+    Create missing tables and apply every pending migration, in version order.
+    :param eng: The database engine.
+    :param out: Where to report progress.
+    :return: List of the versions that were applied.
+    """
+    meta.create_all(bind=eng)
+
+    applied = []
+    with eng.connect() as conn:
+        done = applied_versions(conn)
+        for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+            if migration.version in done:
+                continue
+            print("applying {}: {}".format(migration.version, migration.description), file=out)
+            if migration.own_transactions:
+                migration.apply(conn)
+            with conn.begin():
+                if not migration.own_transactions:
+                    migration.apply(conn)
+                conn.execute(schema_version_table.insert().values(version=migration.version,
+                                                                  description=migration.description,
+                                                                  applied_at=datetime.now()))
+            applied.append(migration.version)
+
+    return applied
+
+
+def status(eng, out=sys.stdout):
+    """
+    Report which migrations have been applied.
+    :param eng: The database engine.
+    :param out: Where to write the report.
+    :return: Number of pending migrations.
+    """
+    meta.create_all(bind=eng, tables=[schema_version_table])
+    with eng.connect() as conn:
+        done = applied_versions(conn)
+
+    pending = 0
+    for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+        state = "applied" if migration.version in done else "pending"
+        pending += migration.version not in done
+        print("{:>3}  {:<8} {}".format(migration.version, state, migration.description), file=out)
+    return pending
+
+
+def plan_uses_index(conn, check):
+    """
+    EXPLAIN a hot query and see whether the expected index is available to it.
+    :param conn: The database connection.
+    :param check: The PlanCheck to run.
+    :return: A tuple of whether the check passed and the plan as text.
+    """
+    return backends.for_connection(conn).uses_index(conn, check.sql, check.params, check.table, check.index)
+
+
+def check_plans(eng, out=sys.stdout):
+    """
+    EXPLAIN every hot query and report any that can't use their index.
+    :param eng: The database engine.
+    :param out: Where to write the report.
+    :return: Number of failed checks.
+    """
+    failures = 0
+    with eng.connect() as conn:
+        for check in PLAN_CHECKS:
+            try:
+                passed, plan = plan_uses_index(conn, check)
+            except DBAPIError as e:
+                passed, plan = False, str(e.orig)
+            failures += not passed
+            print("{:<5} {} ({}): {}".format("ok" if passed else "FAIL", check.name, check.index, plan), file=out)
+    return failures
+
+
+COMMANDS = {"upgrade": upgrade, "status": status, "check": check_plans}
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+    if command not in COMMANDS:
+        print("usage: migrations.py [{}]".format("|".join(COMMANDS)))
+        sys.exit(2)
+
+    result = COMMANDS[command](engine_from_config())
+    if command in ("status", "check") and result:
+        sys.exit(1)
@@ -0,0 +1,71 @@
+import io
+import unittest
+from sqlalchemy import create_engine, inspect
+import migrations
+
+
+class MigrationsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.eng = create_engine("sqlite://")
+        self.out = io.StringIO()
+
+    def make_old_schema(self):
+        self.eng.execute("create table users (email varchar(255) primary key, display_name text)")
+        self.eng.execute("create table exercises (id integer primary key, question text, answer text, "
+                         "difficulty integer, user_id varchar(255))")
+        self.eng.execute("create table attempts (id integer primary key, score integer, when_attempted timestamp, "
+                         "exercise_id integer)")
+        self.eng.execute("create table exercises_by_exercise_tags (exercise_id integer, tag_name varchar(255), "
+                         "user_id varchar(255), primary key (exercise_id, tag_name, user_id))")
+
+    def test_upgrade_brings_old_schema_up_to_date(self):
+        self.make_old_schema()
+        self.assertGreater(migrations.check_plans(self.eng, self.out), 0)
+
+        applied = migrations.upgrade(self.eng, self.out)
+        self.assertEqual([m.version for m in migrations.MIGRATIONS], applied)
+        columns = set(column["name"] for column in inspect(self.eng).get_columns("exercises"))
+        self.assertTrue({"ease_factor", "interval_days", "repetitions", "due_at"} <= columns)
+        self.assertEqual(0, migrations.check_plans(self.eng, self.out))
+
+    def test_upgrade_only_applies_pending_migrations(self):
+        migrations.upgrade(self.eng, self.out)
+        self.assertEqual([], migrations.upgrade(self.eng, self.out))
+        self.assertEqual(0, migrations.status(self.eng, self.out))
+
+    def test_fresh_schema_passes_plan_checks(self):
+        migrations.upgrade(self.eng, self.out)
+        self.assertEqual(0, migrations.check_plans(self.eng, self.out))
+
+    def test_resource_dedupe_folds_duplicate_urls(self):
+        migrations.upgrade(self.eng, self.out)
+        self.eng.execute("drop index ux_resources_user_url")
+        self.eng.execute("insert into resources (id, caption, url, user_id) values "
+                         "(1, 'Docs', 'https://docs.python.org/3/', 'a'), "
+                         "(2, 'Docs again', 'HTTPS://docs.python.org:443/3/', 'a'), "
+                         "(3, 'Docs', 'https://docs.python.org/3/', 'b')")
+        self.eng.execute("insert into resources_by_exercise (resource_id, exercise_id) values (1, 10), (2, 10), (2, 11)")
+
+        with self.eng.begin() as conn:
+            migrations.migrate_resource_dedupe(conn)
+        resources = self.eng.execute("select id, user_id from resources order by id").fetchall()
+        self.assertEqual([(1, "a"), (3, "b")], resources)
+        links = self.eng.execute("select resource_id, exercise_id from resources_by_exercise order by 2").fetchall()
+        self.assertEqual([(1, 10), (1, 11)], links)
+        self.assertEqual(0, self.eng.execute("select count(*) from resources where url_key is null").scalar())
+
+    def test_search_index_is_built_in_batches(self):
+        migrations.upgrade(self.eng, self.out)
+        self.eng.execute("insert into exercises (id, question, answer, user_id) values "
+                         "(1, 'python decorators', 'wrap', 'a'), (2, 'python generators', 'yield', 'a'), "
+                         "(3, 'deleted', 'gone', 'a')")
+        self.eng.execute("update exercises set deleted_at = '2024-01-01' where id = 3")
+        self.eng.execute("insert into search_terms (user_id, term, kind, doc_id, weight) "
+                         "values ('a', 'stale', 'exercise', 1, 1)")
+
+        with self.eng.connect() as conn:
+            migrations.index_search_terms(conn, "and deleted_at is null", batch_size=1)
+            migrations.index_search_terms(conn, "and deleted_at is null", batch_size=1)
+        terms = self.eng.execute("select doc_id, term, weight from search_terms order by doc_id, term").fetchall()
+        self.assertEqual([(1, "decorators", 3), (1, "python", 3), (1, "wrap", 1),
+                          (2, "generators", 3), (2, "python", 3), (2, "yield", 1)], terms)
@@ -1,74 +1,199 @@
-from sqlalchemy import create_engine, MetaData, Table, Column, ForeignKey, Integer, VARCHAR, Text, TIMESTAMP, String, bindparam, DateTime
+from sqlalchemy import Integer
 from sqlalchemy.sql import select, and_, text
-from tabledefs import user_table, exercise_table, attempt_table, resource_table, resource_by_exercise_table, exercise_by_exercise_tags_table, meta
+import tabledefs
 from configparser import ConfigParser
 from collections import namedtuple
-from bs4 import BeautifulSoup
-import requests
-from requests.exceptions import MissingSchema, ConnectionError
+from contextlib import contextmanager
 import re
-from flask import Flask
+import threading
+import time
+from flask import Flask, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+import backends
+import cache
+import scheduler
+import title_fetcher
+import resource_urls
+import search
 
 CHARACTER_LIMIT = 140
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_NEXT_EXERCISES = 10
+MAX_PAGE_SIZE = 500
+EXERCISE_FIELDS = ("id", "question", "answer", "difficulty", "tags")
+IMPORT_CHUNK_SIZE = 500
+MAX_SCORE_BATCH = 500
+BAD, OKAY, GOOD = 1, 2, 3
+ROLLUP_COLUMNS = {BAD: "bad", OKAY: "okay", GOOD: "good"}
+HISTORY_SUMMARIES = ["daily"]
+TAG_MODES = ["any", "all"]
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+DEFAULT_ARCHIVE_AFTER_DAYS = 365
+DEFAULT_ARCHIVE_BATCH_SIZE = 1000
+MAX_DELETE_BATCH = 500
+DEFAULT_PURGE_BATCH_SIZE = 1000
+
+
+def all_tags_valid(tag_candidates):
+    """
+    Check that every tag is made up of only numbers, letters, and underscores.
+    :param tag_candidates: List of tags to check.
+    :return: True if every tag is valid.  False otherwise.
+    """
+    patt = r"^\w+$"
+    for tag in tag_candidates:
+        if not re.match(patt, tag):
+            return False
+    return True
+
+
+class BackendSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy, with the storage backend getting a look at the engine once it's been built.
+    """
+
+    def __init__(self, backend, app=None, **kwargs):
+        self.backend = backend
+        super().__init__(app, **kwargs)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # The backend has already settled the pool and connection arguments.
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        self.backend.configure_engine(engine)
+        return engine
+
 
 class FlashmarkModel():
-    def __init__(self, app=None):
+    def __init__(self, app=None, db_section=None):
+        """
+        :param app: The Flask app.  One is made up when it's left out.
+        :param db_section: Settings to use instead of the learningmachine section of config.ini.
+        """
         self.app = app if app else Flask(__name__)
 
         # setup a database url from out of the config file
-        # NOTE: This could well be a perfect setup for a
-        cp = ConfigParser()
         dir_path = __file__.rsplit("/", maxsplit=1)[0]
-        config_file_name = "{}/{}".format(dir_path, "config.ini")
-        cp.read(config_file_name)
-        db_section = cp["learningmachine"]
-        user, password = db_section.get("user"), db_section.get("password")
-        host, db = db_section.get("host"), db_section.get("db")
-        db_url = "mysql+pymysql://{}:{}@{}/{}?charset=utf8".format(user, password, host, db)
-        self.app.config["SQLALCHEMY_DATABASE_URI"] = db_url
-        self.db = SQLAlchemy(self.app)
-        self.eng = create_engine(db_url, pool_recycle=14400, echo=False)
+        if db_section is None:
+            cp = ConfigParser()
+            config_file_name = "{}/{}".format(dir_path, "config.ini")
+            cp.read(config_file_name)
+            db_section = cp["learningmachine"]
+        self.backend = backends.make_backend(db_section, dir_path)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = self.backend.url()
+        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        self.app.config["SQLALCHEMY_ENGINE_OPTIONS"] = self.backend.engine_options()
+        self.db = BackendSQLAlchemy(self.backend, self.app)
+        self.cache = cache.make_cache(db_section, self.app.logger)
+        self.title_fetcher = title_fetcher.make_fetcher(db_section)
+        self.archive_after_days = db_section.getint("archive_after_days", DEFAULT_ARCHIVE_AFTER_DAYS)
+        self.archive_batch_size = db_section.getint("archive_batch_size", DEFAULT_ARCHIVE_BATCH_SIZE)
+        self.purge_batch_size = db_section.getint("purge_batch_size", DEFAULT_PURGE_BATCH_SIZE)
+
+        # Connections handed out during a request all go back to the pool when the request is torn down.
+        self.app.teardown_appcontext(self.release_request_connection)
+        self.local = threading.local()
+        self.checkout_count = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+
+        # Table definitions are shared with the migration tool, which is also what creates them.  Nothing here
+        # talks to the database until the first request needs it.
+        self.user_table = tabledefs.user_table
+        self.exercise_table = tabledefs.exercise_table
+        self.attempt_table = tabledefs.attempt_table
+        self.attempt_archive_table = tabledefs.attempt_archive_table
+        self.search_term_table = tabledefs.search_term_table
+        self.attempt_rollup_table = tabledefs.attempt_rollup_table
+        self.resource_table = tabledefs.resource_table
+        self.resource_by_exercise_table = tabledefs.resource_by_exercise_table
+        self.exercise_tag_table = tabledefs.exercise_tag_table
+        self.exercise_by_exercise_tags_table = tabledefs.exercise_by_exercise_tags_table
+
+    def __checkout(self):
+        """
+        Take a connection from the pool, keeping track of how long we had to wait for it.
+        :return: A new database connection.
+        """
+        started = time.monotonic()
+        conn = self.db.engine.connect()
+        waited = time.monotonic() - started
 
-        db = self.db
-        self.user_table = db.Table("users",
-                           db.Column("email", db.VARCHAR(255), primary_key=True),
-                           db.Column("display_name", Text))
-
-        self.exercise_table = db.Table("exercises",
-                       db.Column("id", db.Integer, primary_key=True, autoincrement=True),
-                       db.Column("question", db.Text),
-                       db.Column("answer", db.Text),
-                       db.Column("difficulty", db.Integer, default=0),
-                       db.Column("user_id", db.ForeignKey("users.email")))
-
-        self.attempt_table = db.Table("attempts",
-                              db.Column("id", db.Integer, primary_key=True, autoincrement=True),
-                              db.Column("score", db.Integer),
-                              db.Column("when_attempted", db.TIMESTAMP),
-                              db.Column("exercise_id", db.ForeignKey("exercises.id")))
-
-        self.resource_table = db.Table("resources",
-                               db.Column("id", db.Integer, primary_key=True, autoincrement=True),
-                               db.Column("caption", db.Text),
-                               db.Column("url", db.Text),
-                               db.Column("user_id", db.ForeignKey("users.email")))
-
-        self.resource_by_exercise_table = db.Table("resources_by_exercise",
-                                   db.Column("resource_id", db.Integer, db.ForeignKey("resources.id"), primary_key=True),
-                                   db.Column("exercise_id", db.Integer, db.ForeignKey("exercises.id"), primary_key=True))
-
-        self.exercise_tag_table = db.Table("exercise_tags",
-                                   db.Column("name", db.VARCHAR(255), primary_key=True),
-                                   db.Column("user_id", db.ForeignKey("users.email"), primary_key=True))
-
-        self.exercise_by_exercise_tags_table = db.Table("exercises_by_exercise_tags",
-                                                db.Column("exercise_id", db.ForeignKey("exercises.id"), primary_key=True),
-                                                db.Column("tag_name", db.VARCHAR(255), primary_key=True),
-                                                db.Column("user_id", db.VARCHAR(255), primary_key=True),
-                                                db.ForeignKeyConstraint(["tag_name", "user_id"], ["exercise_tags.name", "exercise_tags.user_id"]))
-
-        self.db.create_all()
+        self.checkout_count += 1
+        self.checkout_wait_total += waited
+        self.checkout_wait_max = max(self.checkout_wait_max, waited)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        Hand out a database connection.  Within a request, every model call shares the same connection and it stays
+        checked out until the request is torn down.  Outside of a request, nested calls share one connection which is
+        closed when the outermost block exits.
+        :return: A context manager that yields the connection.
+        """
+        if has_request_context():
+            conn = g.get("flashmark_conn")
+            if conn is None:
+                conn = g.flashmark_conn = self.__checkout()
+            yield conn
+            return
+
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self.local.conn = self.__checkout()
+        try:
+            yield conn
+        finally:
+            self.local.conn = None
+            conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Unit of work.  Begins a transaction on the shared connection, or joins the one already in progress, so that
+        view handlers can group several model calls together and have either all or none of them committed.
+        Example: with fm.transaction(): fm.add_exercise(...); fm.change_tags(...)
+        :return: A context manager that yields the shared connection.
+        """
+        with self.connection() as conn:
+            if conn.in_transaction():
+                yield conn
+            else:
+                with conn.begin():
+                    yield conn
+
+    def release_request_connection(self, exception=None):
+        """
+        Give the request's connection (if it took one) back to the pool.
+        :param exception: Whatever exception ended the request, if any.
+        :return: Nothing.
+        """
+        conn = g.pop("flashmark_conn", None)
+        if conn is not None:
+            conn.close()
+
+    def pool_stats(self):
+        """
+        Live numbers on the connection pool for this worker.
+        :return: A dictionary of pool gauges along with checkout counts and wait times.
+        """
+        pool = self.db.engine.pool
+        stats = dict(checkouts=self.checkout_count,
+                     checkout_wait_total=self.checkout_wait_total,
+                     checkout_wait_max=self.checkout_wait_max)
+
+        for gauge in ("size", "checkedin", "checkedout", "overflow"):
+            if hasattr(pool, gauge):
+                stats[gauge] = getattr(pool, gauge)()
+
+        return stats
 
     def user_exists(self, email_arg):
         """
@@ -80,8 +205,8 @@ class FlashmarkModel():
         query = db.select([self.user_table])\
                 .where(self.user_table.c.email == email_arg)
 
-        conn = db.engine.connect()
-        user_found = True if conn.execute(query).fetchall() else False
+        with self.connection() as conn:
+            user_found = True if conn.execute(query).fetchall() else False
         return user_found
 
     def add_user(self, email, display_name):
@@ -91,13 +216,49 @@ class FlashmarkModel():
         :param display_name: Full name of the user to be added.
         :return: Nothing
         """
-        conn = self.db.engine.connect()
+        with self.connection() as conn:
+            query = self.user_table.insert()\
+                              .values(email=email, display_name=display_name)
 
-        query = self.user_table.insert()\
-                          .values(email=email, display_name=display_name)
+            conn.execute(query)
 
-        conn.execute(query)
-        conn.close()
+    def upsert_user(self, email, display_name):
+        """
+        Add a user to the database unless they are already there, in a single statement.
+        :param email: Email address to have act as an id for the user.
+        :param display_name: Full name of the user.
+        :return: True if the user was added, False if they already existed.
+        """
+        with self.connection() as conn:
+            query = self.backend.insert_ignore(self.user_table).values(email=email, display_name=display_name)
+            res = conn.execute(query)
+        return res.rowcount > 0
+
+    def __bump_data_version(self, conn, user_id):
+        """
+        Mark that something belonging to the user has changed.  Called from inside every write's transaction so the
+        new version only becomes visible along with the change itself.
+        :param conn: The database connection.
+        :param user_id: The user whose data changed.  None bumps every user.
+        :return: Nothing.
+        """
+        query = "update users set data_version = coalesce(data_version, 0) + 1"
+        if user_id is None:
+            conn.execute(self.db.text(query))
+        else:
+            conn.execute(self.db.text(query + " where email = :uid"), uid=user_id)
+
+    def get_data_version(self, user_id):
+        """
+        Get the user's data version.  It goes up every time one of their exercises, attempts, tags or resources
+        changes, so views can tell whether a client's copy is still current without reading any of those tables.
+        :param user_id: The user to look up.
+        :return: The version number.  0 for a user that doesn't exist or has never changed anything.
+        """
+        with self.connection() as conn:
+            query = self.db.text("select data_version from users where email = :uid")
+            row = conn.execute(query, uid=user_id).fetchone()
+        return (row[0] or 0) if row else 0
 
     def __get_new_difficulty(self, conn, user_id):
         """
@@ -106,7 +267,7 @@ class FlashmarkModel():
         :param user_id: ID of the user
         :return:
         """
-        query = self.db.text("select max(difficulty) from exercises where user_id = :uid")
+        query = self.db.text("select max(difficulty) from exercises where user_id = :uid and deleted_at is null")
         diff, *_ = conn.execute(query, uid=user_id).fetchall()[0]
         if diff:
             diff += 1
@@ -128,57 +289,212 @@ class FlashmarkModel():
             msg = "Either the new question or new answer exceeded char limit of {} chars".format(CHARACTER_LIMIT)
             raise Exception(msg)
 
-        conn = self.db.engine.connect()
-        with conn.begin() as trans:
+        with self.transaction() as conn:
             diff = self.__get_new_difficulty(conn, user_id)
             query = self.exercise_table.insert()\
                               .values(question=question, answer=answer, difficulty=diff, user_id=user_id)
             result = conn.execute(query)
-            trans.commit()
-        conn.close()
+            new_exercise_id = result.inserted_primary_key[0]
+            self.__index_documents(conn, search.exercise_rows(user_id, new_exercise_id, question, answer))
+            self.__bump_data_version(conn, user_id)
+        self.cache.invalidate(user_id, cache.EXERCISES)
 
-    def get_all_exercises(self, user_id, tag_arg=None):
+    def import_exercises(self, user_id, rows, chunk_size=IMPORT_CHUNK_SIZE):
         """
-        Get all the exercises along with the thing tags that are associated with them.
-        :param user_id: The ID of the user we're looking up exercises for.
-        :return:: A list of exercise info including all the tags that this exercise is connected to.
+        Bulk load exercises for a user.  Rows get the same checks as add_exercise, new exercises get increasing
+        difficulties starting from a single max(difficulty) lookup, and inserts go out in chunks with one executemany
+        per table.  Each chunk is committed on its own.  A bad row is reported and skipped rather than failing the import,
+        and so is every row of a chunk the database turns down, so the errors always say exactly which rows weren't
+        stored.  An upload that can't be read any further ends the import with an error that has no line.
+        :param user_id: user id string
+        :param rows: Iterable of exercise_import.ImportRow tuples.
+        :param chunk_size: How many exercises to insert per round trip.
+        :return: A tuple of the number of exercises imported and a list of dictionaries describing rejected rows.
         """
-        from itertools import groupby
+        imported, errors, chunk = 0, [], []
 
-        # Give me all the exercise recs along with the tags associated with them.
+        with self.connection() as conn:
+            diff = self.__get_new_difficulty(conn, user_id)
+            stored_tags = set(self.__get_stored_tags(conn, user_id=user_id))
+
+            rows = iter(rows)
+            while True:
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    errors.append(dict(line=None, error="Stopped reading the upload: {}".format(e)))
+                    break
+
+                if row.error:
+                    errors.append(dict(line=row.line, error=row.error))
+                    continue
+                if len(row.question) > CHARACTER_LIMIT or len(row.answer) > CHARACTER_LIMIT:
+                    msg = "Either the question or answer exceeded char limit of {} chars".format(CHARACTER_LIMIT)
+                    errors.append(dict(line=row.line, error=msg))
+                    continue
+                if not all_tags_valid(row.tags):
+                    msg = "Tags are supposed to be made up of only numbers, letters, and underscores"
+                    errors.append(dict(line=row.line, error=msg))
+                    continue
+
+                tags = sorted(set(tag.lower() for tag in row.tags))
+                chunk.append(dict(line=row.line, question=row.question, answer=row.answer, difficulty=diff,
+                                  user_id=user_id, tags=tags))
+                diff += 1
+
+                if len(chunk) >= chunk_size:
+                    imported += self.__try_exercise_chunk(conn, user_id, chunk, stored_tags, errors)
+                    chunk = []
+
+            if chunk:
+                imported += self.__try_exercise_chunk(conn, user_id, chunk, stored_tags, errors)
+
+        if imported:
+            self.cache.invalidate(user_id, cache.EXERCISES)
+        return imported, errors
+
+    def __try_exercise_chunk(self, conn, user_id, chunk, stored_tags, errors):
+        """
+        Insert one chunk of an import, reporting each of its rows as an error if the database turns the chunk down.
+        :param errors: List of rejected rows to add to.
+        :return: Number of exercises inserted.
+        """
+        try:
+            return self.__insert_exercise_chunk(conn, user_id, chunk, stored_tags)
+        except Exception as e:
+            self.app.logger.exception("Import chunk failed for user: {}".format(user_id))
+            errors.extend(dict(line=rec["line"], error="Not stored: {}".format(type(e).__name__)) for rec in chunk)
+            return 0
+
+    def __insert_exercise_chunk(self, conn, user_id, chunk, stored_tags):
+        """
+        Insert one chunk of an import along with its tags.
+        :param conn: The database connection.
+        :param user_id: user id string
+        :param chunk: List of exercise dictionaries, each with a distinct difficulty.
+        :param stored_tags: Set of tag names the user already has.  New tags get added to it.
+        :return: Number of exercises inserted.
+        """
+        db = self.db
+        exercise_rows = [dict(question=rec["question"], answer=rec["answer"], difficulty=rec["difficulty"], user_id=user_id)
+                         for rec in chunk]
+        new_tags = sorted(set(tag for rec in chunk for tag in rec["tags"]).difference(stored_tags))
+
+        with self.transaction():
+            floor_id, *_ = conn.execute(db.text("select coalesce(max(id), 0) from exercises")).fetchall()[0]
+            conn.execute(self.exercise_table.insert(), exercise_rows)
+
+            # executemany doesn't hand back the new ids.  Difficulties within an import are unique, so use them
+            # to match the rows we just inserted back up with their tags and search terms.
+            query = db.text("""
+            select id, difficulty
+            from exercises
+            where user_id = :uid
+            and id > :floor
+            and difficulty between :low and :high""")
+            res = conn.execute(query, uid=user_id, floor=floor_id,
+                               low=chunk[0]["difficulty"], high=chunk[-1]["difficulty"])
+            id_by_difficulty = {difficulty: eid for eid, difficulty in res}
+
+            if any(rec["tags"] for rec in chunk):
+                if new_tags:
+                    # Another request may have made the same tag since stored_tags was read.
+                    conn.execute(self.backend.insert_ignore(self.exercise_tag_table),
+                                 [dict(name=tag, user_id=user_id) for tag in new_tags])
+
+                links = [dict(exercise_id=id_by_difficulty[rec["difficulty"]], tag_name=tag, user_id=user_id)
+                         for rec in chunk for tag in rec["tags"]]
+                conn.execute(self.exercise_by_exercise_tags_table.insert(), links)
+
+            self.__index_documents(conn, [row for rec in chunk
+                                          for row in search.exercise_rows(user_id, id_by_difficulty[rec["difficulty"]],
+                                                                          rec["question"], rec["answer"])])
+
+            self.__bump_data_version(conn, user_id)
+
+        stored_tags.update(new_tags)
+        return len(chunk)
+
+    def __normalize_tags(self, tags, mode):
+        """
+        Tidy up a tag filter.
+        :param tags: None, a single tag, or a list of tags.
+        :param mode: "any" to match exercises with at least one of the tags, "all" for exercises with every one of them.
+        :return: Sorted list of distinct lower case tags.
+        """
+        if mode not in TAG_MODES:
+            raise Exception("Tag mode has to be one of: {}".format(", ".join(TAG_MODES)))
+        if tags is None:
+            return []
+        tags = [tags] if isinstance(tags, str) else tags
+        return sorted(set(tag.lower() for tag in tags if tag))
+
+    def __tag_filter(self, id_column, tags, mode):
+        """
+        Build the where clause condition limiting exercises to those with the given tags.  Both modes are a single pass
+        over the (user_id, tag_name, exercise_id) index: "any" is the union of the tags' exercises and "all" is their
+        intersection, found by counting how many of the tags each exercise turned up under.
+        :param id_column: The exercise id column being filtered, e.g. "e.id".
+        :param tags: Normalized list of tags.  Bound as :tags, along with :uid and :tag_count.
+        :param mode: "any" or "all".
+        :return: A condition to tack on with 'and', or an empty string when there are no tags to filter on.
+        """
+        if not tags:
+            return ""
+
+        having = "group by exercise_id having count(*) = :tag_count" if mode == "all" and len(tags) > 1 else ""
+        return """
+            and {} in (
+                select exercise_id
+                from exercises_by_exercise_tags
+                where user_id = :uid
+                and tag_name in :tags
+                {}
+            )""".format(id_column, having)
+
+    def __tag_query(self, query_str, tags):
+        """
+        :param query_str: SQL text that may include a __tag_filter condition.
+        :param tags: Normalized list of tags being filtered on.
+        :return: The text query, with :tags set up to take a list when there are tags.
+        """
+        query = self.db.text(query_str)
+        if tags:
+            query = query.bindparams(self.db.bindparam("tags", expanding=True))
+        return query
+
+    def __query_exercise_records(self, conn, user_id, tags=None, mode="any"):
+        """
+        Run the exercise / tag join for a user.  One row comes back per exercise / tag pairing, ordered by exercise id.
+        Exercises that pass the tag filter come back with ALL of their tags, not only the ones asked for.
+        :param conn: The database connection.
+        :param user_id: The ID of the user we're looking up exercises for.
+        :param tags: Normalized list of tags to filter on.  Empty or None for every exercise.
+        :param mode: "any" or "all" of the tags.
+        :return: The record set for the query.
+        """
+        tags = tags or []
         query_str = """
         select e.id, e.question, e.answer, e.difficulty, ebet.tag_name
         from exercises as e
         left join exercises_by_exercise_tags as ebet
         on e.id = ebet.exercise_id
         where e.user_id = :uid
-        order by e.id"""
+        and e.deleted_at is null{tag_filter}
+        order by e.id""".format(tag_filter=self.__tag_filter("e.id", tags, mode))
 
-        # Give me exercise recs along with the ALL tags associated with them
-        # if and only if ONE of the tags is 'tag_arg'
-        query_str_with_tag = """
-        select e.id, e.question, e.answer, e.difficulty, ebet.tag_name
-        from exercises as e
-        left join exercises_by_exercise_tags as ebet
-        on e.id = ebet.exercise_id
-        where e.user_id = :uid
-        and exists (
-            select *
-            from exercises_by_exercise_tags ebet_inner
-            where ebet_inner.exercise_id = e.id
-            and ebet_inner.user_id = :uid
-            and ebet_inner.tag_name = :tag
-        )
-        order by e.id;
-        """
+        query = self.__tag_query(query_str, tags)
+        return conn.execute(query, uid=user_id, tags=tags, tag_count=len(tags))
 
-        conn = self.db.engine.connect()
-        if tag_arg:
-            query = self.db.text(query_str_with_tag)
-            record_set = conn.execute(query, uid=user_id, tag=tag_arg)
-        else:
-            query = self.db.text(query_str)
-            record_set = conn.execute(query, uid=user_id).fetchall()
+    def __group_exercise_records(self, record_set):
+        """
+        Fold exercise / tag rows into one dictionary per exercise.
+        :param record_set: Rows of (id, question, answer, difficulty, tag_name) ordered by exercise id.
+        :return: A list of exercise info including all the tags that each exercise is connected to.
+        """
+        from itertools import groupby
 
         exercise_id_key = lambda rec: list(rec)[0]
 
@@ -198,6 +514,118 @@ class FlashmarkModel():
 
         return exercise_list
 
+    def get_all_exercises(self, user_id, tags=None, mode="any"):
+        """
+        Get all the exercises along with the thing tags that are associated with them.
+        Results are cached per user and tag filter until the user's exercises change.
+        :param user_id: The ID of the user we're looking up exercises for.
+        :param tags: Optional tag, or list of tags, that returned exercises must be connected to.
+        :param mode: "any" for exercises with at least one of the tags, "all" for exercises with every one of them.
+        :return:: A list of exercise info including all the tags that this exercise is connected to.
+        """
+        tags = self.__normalize_tags(tags, mode)
+
+        def load_exercises():
+            with self.connection() as conn:
+                record_set = self.__query_exercise_records(conn, user_id, tags, mode).fetchall()
+                exercise_list = self.__group_exercise_records(record_set)
+            return exercise_list
+
+        return self.cache.fetch(user_id, cache.EXERCISES, ("all", mode, ",".join(tags)), load_exercises)
+
+    def get_tag_counts(self, user_id):
+        """
+        Get every tag the user has along with how many exercises each one is connected to.
+        Cached with the exercises, since those are what the counts change along with.
+        :param user_id: The ID of the user we're looking up tags for.
+        :return: A list of dictionaries with the tag name and its exercise count, in tag name order.
+        """
+        query_str = """
+        select t.name, count(e.id)
+        from exercise_tags as t
+        left join exercises_by_exercise_tags as ebet
+        on ebet.user_id = t.user_id
+        and ebet.tag_name = t.name
+        left join exercises as e
+        on e.id = ebet.exercise_id
+        and e.deleted_at is null
+        where t.user_id = :uid
+        group by t.name
+        order by t.name"""
+
+        def load_tags():
+            with self.connection() as conn:
+                res = conn.execute(self.db.text(query_str), uid=user_id)
+                return [dict(name=name, count=count) for name, count in res]
+
+        return self.cache.fetch(user_id, cache.EXERCISES, ("tags",), load_tags)
+
+    def get_exercise_page(self, user_id, tags=None, after=None, limit=DEFAULT_PAGE_SIZE, fields=None, mode="any"):
+        """
+        Get one page of a user's exercises, ordered by exercise id.  Paging is keyset based, so the cost of a page
+        does not grow with how far into the deck it is.
+        :param user_id: The ID of the user we're looking up exercises for.
+        :param tags: Optional tag, or list of tags, that returned exercises must be connected to.
+        :param after: Exercise id to start after.  None starts at the beginning of the deck.
+        :param limit: Max number of exercises in the page.
+        :param fields: Which of EXERCISE_FIELDS to send back.  The id is always included.  None means all of them.
+        :param mode: "any" for exercises with at least one of the tags, "all" for exercises with every one of them.
+        :return: A tuple of the exercise list and the cursor to pass as 'after' for the next page (None on the last page).
+        """
+        fields = list(EXERCISE_FIELDS) if fields is None else fields
+        unknown_fields = set(fields).difference(EXERCISE_FIELDS)
+        if unknown_fields:
+            raise Exception("Unknown exercise fields requested: {}".format(", ".join(sorted(unknown_fields))))
+
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise Exception("Page size has to be between 1 and {}".format(MAX_PAGE_SIZE))
+
+        columns = [field for field in EXERCISE_FIELDS if field in fields and field not in ("id", "tags")]
+        select_list = ", ".join(["e.id"] + ["e.{}".format(column) for column in columns])
+        with_tags = "tags" in fields
+
+        tags = self.__normalize_tags(tags, mode)
+        tag_filter = self.__tag_filter("exercises.id", tags, mode)
+
+        tag_join = """
+        left join exercises_by_exercise_tags as ebet
+        on e.id = ebet.exercise_id""" if with_tags else ""
+
+        # Pick the ids for the page first so that the limit counts exercises rather than exercise / tag rows.
+        query_str = """
+        select {select_list}{tag_column}
+        from (
+            select id
+            from exercises
+            where user_id = :uid
+            and deleted_at is null
+            and id > :after{tag_filter}
+            order by id
+            limit :lim
+        ) as page
+        join exercises as e
+        on e.id = page.id{tag_join}
+        order by e.id""".format(select_list=select_list, tag_column=", ebet.tag_name" if with_tags else "",
+                                tag_filter=tag_filter, tag_join=tag_join)
+
+        with self.connection() as conn:
+            query = self.__tag_query(query_str, tags)
+            record_set = conn.execute(query, uid=user_id, tags=tags, tag_count=len(tags), after=after or 0,
+                                      lim=limit).fetchall()
+
+        exercise_list = []
+        for rec in record_set:
+            if not exercise_list or exercise_list[-1]["id"] != rec["id"]:
+                dict_rec = {column: rec[column] for column in ["id"] + columns}
+                if with_tags:
+                    dict_rec["tags"] = []
+                exercise_list.append(dict_rec)
+            if with_tags and rec["tag_name"]:
+                exercise_list[-1]["tags"].append(rec["tag_name"])
+
+        next_after = exercise_list[-1]["id"] if len(exercise_list) == limit else None
+        return exercise_list, next_after
+
     def add_attempt(self, exercise_id, score, user_id):
         """
         Record how well the user did in attempting an exercise
@@ -205,14 +633,12 @@ class FlashmarkModel():
         :param score: Score the user gave themselves
         :return: Nothing
         """
-        BAD, OKAY, GOOD = 1, 2, 3
-        conn = self.db.engine.connect()
         from datetime import datetime
         now = datetime.now()
         exercise_parm = self.db.bindparam("exercise_id", type_=Integer)
         score_parm = self.db.bindparam("score", type_=Integer)
 
-        with conn.begin() as trans:
+        with self.transaction() as conn:
             query = self.attempt_table.insert()\
                                  .values(exercise_id=exercise_parm, score=score_parm, when_attempted=now)
             conn.execute(query, exercise_id=exercise_id, score=score)
@@ -232,127 +658,679 @@ class FlashmarkModel():
                 query = self.db.text(query_text)
                 conn.execute(query, d=difficulty, uid=user_id, eid=exercise_id)
 
+            self.__reschedule(conn, user_id, [(exercise_id, score, now)])
+            self.__add_to_rollups(conn, [(exercise_id, score, now)])
+            self.__bump_data_version(conn, user_id)
+
+        self.cache.invalidate(user_id, cache.EXERCISES)
+
+
+    def add_attempts(self, user_id, scores):
+        """
+        Record a batch of attempts in one transaction.  The end result is the same as calling add_attempt on each score
+        in order: difficulties are worked out in memory from one read of the exercises involved and one max(difficulty)
+        over the rest of the deck, then written back with one executemany.
+        Scores for exercises the user doesn't own, or that aren't BAD, OKAY or GOOD, are skipped.
+        :param user_id: The user the attempts belong to.
+        :param scores: Ordered list of (exercise_id, score, when_attempted) tuples.  when_attempted may be None for now.
+        :return: A tuple of the number of attempts recorded and a list of dictionaries describing the skipped ones.
+        """
+        from datetime import datetime
+        db = self.db
+        now = datetime.now()
+
+        if len(scores) > MAX_SCORE_BATCH:
+            raise Exception("No more than {} scores can be sent at once".format(MAX_SCORE_BATCH))
+
+        exercise_ids = list(set(exercise_id for exercise_id, score, when_attempted in scores))
+        if not exercise_ids:
+            return 0, []
+
+        ids_parm = db.bindparam("ids", expanding=True)
+        owned_query = db.select([self.exercise_table.c.id, self.exercise_table.c.difficulty])\
+            .where(and_(self.exercise_table.c.user_id == db.bindparam("user_id"),
+                        self.exercise_table.c.id.in_(ids_parm),
+                        self.exercise_table.c.deleted_at.is_(None)))
+        others_query = db.select([db.func.max(self.exercise_table.c.difficulty)])\
+            .where(and_(self.exercise_table.c.user_id == db.bindparam("user_id"),
+                        self.exercise_table.c.id.notin_(ids_parm),
+                        self.exercise_table.c.deleted_at.is_(None)))
+
+        with self.transaction() as conn:
+            difficulties = {eid: diff or 0 for eid, diff in conn.execute(owned_query, user_id=user_id, ids=exercise_ids)}
+            others_max, *_ = conn.execute(others_query, user_id=user_id, ids=exercise_ids).fetchall()[0]
+
+            attempts, skipped, changed = [], [], set()
+            for index, (exercise_id, score, when_attempted) in enumerate(scores):
+                if exercise_id not in difficulties:
+                    skipped.append(dict(index=index, exercise_id=exercise_id, error="Not one of this user's exercises"))
+                    continue
+                if score not in (BAD, OKAY, GOOD):
+                    skipped.append(dict(index=index, exercise_id=exercise_id, error="Score has to be 1, 2 or 3"))
+                    continue
+
+                when_attempted = min(when_attempted, now) if when_attempted else now
+                attempts.append(dict(exercise_id=exercise_id, score=score, when_attempted=when_attempted))
+
+                # Same rules as add_attempt: BAD jumps to one past the hardest exercise, GOOD steps down one.
+                if score == BAD:
+                    diff = max([d for d in [others_max] + list(difficulties.values()) if d is not None])
+                    difficulties[exercise_id] = diff + 1 if diff else 1
+                    changed.add(exercise_id)
+                elif score == GOOD:
+                    difficulties[exercise_id] -= 1
+                    changed.add(exercise_id)
+
+            if attempts:
+                conn.execute(self.attempt_table.insert(), attempts)
+
+            if changed:
+                query = db.text("update exercises set difficulty = :d where user_id = :uid and id = :eid")
+                conn.execute(query, [dict(d=difficulties[eid], uid=user_id, eid=eid) for eid in sorted(changed)])
+
+            if attempts:
+                scored = [(rec["exercise_id"], rec["score"], rec["when_attempted"]) for rec in attempts]
+                self.__reschedule(conn, user_id, scored)
+                self.__add_to_rollups(conn, scored)
+                self.__bump_data_version(conn, user_id)
+
+        if attempts:
+            self.cache.invalidate(user_id, cache.EXERCISES)
+        return len(attempts), skipped
+
+    def __reschedule(self, conn, user_id, scored):
+        """
+        Move the spaced repetition schedule along for a run of attempts.  Reads the current schedule for every exercise
+        involved in one query, replays the attempts in order, and writes the results back with one executemany.
+        :param conn: The database connection.
+        :param user_id: The user the exercises belong to.
+        :param scored: Ordered list of (exercise_id, score, when_attempted) tuples.
+        :return: Nothing.
+        """
+        db = self.db
+        exercises = self.exercise_table
+        query = db.select([exercises.c.id, exercises.c.ease_factor, exercises.c.interval_days, exercises.c.repetitions])\
+            .where(and_(exercises.c.user_id == db.bindparam("user_id"),
+                        exercises.c.id.in_(db.bindparam("ids", expanding=True))))
+
+        ids = list(set(exercise_id for exercise_id, score, when_attempted in scored))
+        schedules = {eid: scheduler.Schedule(ease, interval, reps, None)
+                     for eid, ease, interval, reps in conn.execute(query, user_id=user_id, ids=ids)}
+
+        for exercise_id, score, when_attempted in scored:
+            current = schedules.get(exercise_id)
+            if current is not None:
+                schedules[exercise_id] = scheduler.next_schedule(score, current.ease_factor, current.interval_days,
+                                                                 current.repetitions, when_attempted)
+
+        if schedules:
+            query = db.text("""
+            update exercises
+            set ease_factor = :ease, interval_days = :interval, repetitions = :reps, due_at = :due
+            where user_id = :uid and id = :eid""")
+            conn.execute(query, [dict(ease=sched.ease_factor, interval=sched.interval_days, reps=sched.repetitions,
+                                      due=sched.due_at, uid=user_id, eid=eid)
+                                 for eid, sched in sorted(schedules.items())])
+
+    def __add_to_rollups(self, conn, scored):
+        """
+        Count a run of attempts into the daily rollups.  Attempts are totalled per exercise and day in memory first,
+        then added onto the stored counts with one executemany.  Rows are filed under the exercise's owner, the same
+        way backfill_attempt_rollups files them.
+        :param conn: The database connection.
+        :param scored: List of (exercise_id, score, when_attempted) tuples.
+        :return: Nothing.
+        """
+        db = self.db
+        counts = {}
+        for exercise_id, score, when_attempted in scored:
+            column = ROLLUP_COLUMNS.get(score)
+            if column is None:
+                continue
+            day_counts = counts.setdefault((exercise_id, when_attempted.date()), dict(bad=0, okay=0, good=0))
+            day_counts[column] += 1
+
+        if not counts:
+            return
+
+        on_conflict = self.backend.upsert_clause(["exercise_id", "day"], add_columns=["bad", "okay", "good"])
+
+        query = db.text("""
+        insert into attempt_rollups (exercise_id, day, user_id, bad, okay, good)
+        select id, :day, user_id, :bad, :okay, :good
+        from exercises
+        where id = :eid
+        """ + on_conflict).bindparams(db.bindparam("day", type_=db.Date))
+        conn.execute(query, [dict(eid=eid, day=day, **day_counts)
+                             for (eid, day), day_counts in sorted(counts.items())])
+
+    def backfill_attempt_rollups(self, user_id=None):
+        """
+        Rebuild the daily rollups from the raw attempts, archived ones included, for one user or for everyone.
+        :param user_id: The user whose rollups get rebuilt.  None for every user.
+        :return: Number of rollup rows written.
+        """
+        user_filter = "where e.user_id = :uid" if user_id else ""
+        insert_query = self.db.text("""
+        insert into attempt_rollups (exercise_id, day, user_id, bad, okay, good)
+        select a.exercise_id, date(a.when_attempted), e.user_id,
+               sum(case when a.score = {} then 1 else 0 end),
+               sum(case when a.score = {} then 1 else 0 end),
+               sum(case when a.score = {} then 1 else 0 end)
+        from (
+            select exercise_id, score, when_attempted from attempts
+            union all
+            select exercise_id, score, when_attempted from attempts_archive
+        ) as a
+        join exercises as e
+        on a.exercise_id = e.id
+        {}
+        group by a.exercise_id, date(a.when_attempted), e.user_id""".format(BAD, OKAY, GOOD, user_filter))
+
+        delete_query = self.attempt_rollup_table.delete()
+        if user_id:
+            delete_query = delete_query.where(self.attempt_rollup_table.c.user_id == self.db.bindparam("uid"))
+
+        with self.transaction() as conn:
+            conn.execute(delete_query, uid=user_id)
+            res = conn.execute(insert_query, uid=user_id)
+            self.__bump_data_version(conn, user_id)
+        return res.rowcount
+
+    def archive_attempts(self, older_than_days=None, batch_size=None):
+        """
+        Move attempts older than the cutoff from the attempts table into attempts_archive.  Works through them in
+        batches, each in its own transaction, so the job never holds locks on a big slice of the table for long.
+        :param older_than_days: Age in days past which attempts get archived.  Defaults to archive_after_days, and
+                                can't be any less, since reads of recent attempts skip the archive.
+        :param batch_size: How many attempts to move per transaction.  Defaults to archive_batch_size.
+        :return: Number of attempts moved.
+        """
+        from datetime import datetime, timedelta
+        db = self.db
+        older_than_days = self.archive_after_days if older_than_days is None else older_than_days
+        if older_than_days < self.archive_after_days:
+            raise Exception("Attempts newer than archive_after_days ({}) can't be archived".format(
+                self.archive_after_days))
+        batch_size = batch_size or self.archive_batch_size
+        cutoff = datetime.now() - timedelta(days=older_than_days)
+
+        ids_query = db.select([self.attempt_table.c.id])\
+            .where(self.attempt_table.c.when_attempted < db.bindparam("cutoff", type_=db.DateTime))\
+            .order_by(self.attempt_table.c.id)\
+            .limit(batch_size)
+        copy_query = db.text("""
+        insert into attempts_archive (id, score, when_attempted, exercise_id)
+        select id, score, when_attempted, exercise_id
+        from attempts
+        where id in :ids""").bindparams(db.bindparam("ids", expanding=True))
+        delete_query = self.attempt_table.delete()\
+            .where(self.attempt_table.c.id.in_(db.bindparam("ids", expanding=True)))
+
+        moved = 0
+        while True:
+            with self.transaction() as conn:
+                ids = [attempt_id for attempt_id, *_ in conn.execute(ids_query, cutoff=cutoff)]
+                if not ids:
+                    break
+                conn.execute(copy_query, ids=ids)
+                conn.execute(delete_query, ids=ids)
+            moved += len(ids)
+
+        return moved
+
+    def get_next_exercises(self, user_id, count=DEFAULT_NEXT_EXERCISES):
+        """
+        Get the exercises that come due soonest for a user.  Exercises that have never been attempted come first.
+        Served straight off the (user_id, due_at) index, so only the exercises asked for get read.
+        :param user_id: The ID of the user we're looking up exercises for.
+        :param count: How many exercises to hand back.
+        :return: A list of exercise info in due order, including tags and when each exercise is due.
+        """
+        if count < 1 or count > MAX_PAGE_SIZE:
+            raise Exception("Number of exercises has to be between 1 and {}".format(MAX_PAGE_SIZE))
+
+        query_str = """
+        select e.id, e.question, e.answer, e.difficulty, e.due_at, ebet.tag_name
+        from (
+            select id, due_at
+            from exercises
+            where user_id = :uid
+            and deleted_at is null
+            order by due_at, id
+            limit :lim
+        ) as due
+        join exercises as e
+        on e.id = due.id
+        left join exercises_by_exercise_tags as ebet
+        on e.id = ebet.exercise_id
+        order by due.due_at, e.id"""
 
-            trans.commit()
+        with self.connection() as conn:
+            query = self.db.text(query_str).columns(due_at=self.db.DateTime)
+            record_set = conn.execute(query, uid=user_id, lim=count).fetchall()
 
-        conn.close()
+        exercise_list = []
+        for eid, question, answer, diff, due_at, tag in record_set:
+            if not exercise_list or exercise_list[-1]["id"] != eid:
+                due_at = due_at.isoformat() if due_at else None
+                exercise_list.append(dict(id=eid, question=question, answer=answer, difficulty=diff, due_at=due_at,
+                                          tags=[]))
+            if tag:
+                exercise_list[-1]["tags"].append(tag)
 
+        return exercise_list
 
-    def get_attempts(self, exercise_id):
+    def get_attempts(self, exercise_id, since=None):
         """
         Grab attempts history as they pertain to attempts on a particular exercise
         :param exercise_id: ID number for the exercise in question
+        :param since: Only include attempts made at or after this datetime.  None for the full history, archive included.
         :return: History of scores and dates attemptes for that exercise as a list of dictionaries.
         """
-        conn = self.db.engine.connect()
-
-        query = self.db.select([self.attempt_table.c.score, self.attempt_table.c.when_attempted])\
-                .where(self.attempt_table.c.exercise_id == self.db.bindparam("exercise_id", type_=Integer))
-
-        result_records = conn.execute(query, exercise_id=exercise_id).fetchall()
-        attempts = [{"score": score, "when_attempted": when_attempted.isoformat()}
-                        for score, when_attempted in result_records]
-        conn.close()
+        with self.connection() as conn:
+            query = self.__attempts_query(since, exercise_id=True)
+            result_records = conn.execute(query, exercise_id=exercise_id, since=since).fetchall()
+            attempts = [{"score": score, "when_attempted": when_attempted.isoformat()}
+                            for eid, aid, score, when_attempted in result_records]
         return attempts
 
+    def __attempt_tiers(self, since):
+        """
+        :param since: Earliest attempt time being asked for, or None for all of them.
+        :return: The attempt tables that could hold attempts made since then.  Nothing newer than archive_after_days
+                 has been archived, so recent ranges only need the hot table.
+        """
+        from datetime import datetime, timedelta
+        archived_before = datetime.now() - timedelta(days=self.archive_after_days)
+        if since is not None and since >= archived_before:
+            return [self.attempt_table]
+        return [self.attempt_table, self.attempt_archive_table]
 
-    def full_attempt_history(self, user_id):
+    def __attempts_query(self, since, exercise_id=False, user_id=False):
+        """
+        Build a query over the hot and archived attempts, as far back as since needs.
+        :param since: Earliest attempt time to include, or None for all of them.  Bound as :since.
+        :param exercise_id: Whether to filter on one exercise, bound as :exercise_id.
+        :param user_id: Whether to filter on the exercises of one user, bound as :user_id.
+        :return: A query for exercise_id, id, score and when_attempted in exercise, then attempt order.
+        """
+        db = self.db
+        exercises = self.exercise_table
+
+        selects = []
+        for tier in self.__attempt_tiers(since):
+            query = db.select([tier.c.exercise_id.label("exercise_id"), tier.c.id.label("attempt_id"),
+                               tier.c.score.label("score"), tier.c.when_attempted.label("when_attempted")])
+            if user_id:
+                query = query.select_from(tier.join(exercises, tier.c.exercise_id == exercises.c.id))\
+                    .where(and_(exercises.c.user_id == db.bindparam("user_id"), exercises.c.deleted_at.is_(None)))
+            if exercise_id:
+                query = query.where(tier.c.exercise_id == db.bindparam("exercise_id", type_=Integer))
+            if since is not None:
+                query = query.where(tier.c.when_attempted >= db.bindparam("since", type_=db.DateTime))
+            selects.append(query)
+
+        if len(selects) == 1:
+            return selects[0].order_by("exercise_id", "attempt_id")
+        return db.union_all(*selects).order_by("exercise_id", "attempt_id")
+
+    def full_attempt_history(self, user_id, summary=None, since=None):
         """
         Get a full history on all topics, all exercises under those topics, and all attempts made.
+        Exercises and attempts are each pulled with a single query and stitched together in one pass,
+        rather than looking up attempts one exercise at a time.
         :param user_id: The user whose history we're looking up.
-        :return: A hierarchial history list in the form of topic -> exercise -> attempts
+        :param summary: None for every attempt, or "daily" for per day counts of each score read from the rollups.
+        :param since: Only include attempts made at or after this datetime.  None for the full history, archive included.
+        :return: A hierarchial history list in the form of topic -> exercise -> attempts.  With a daily summary each
+                 exercise has a "daily" list of day, bad, okay and good counts in place of its attempts.
         """
+        if summary is not None and summary not in HISTORY_SUMMARIES:
+            raise Exception("Summary has to be one of: {}".format(", ".join(HISTORY_SUMMARIES)))
 
-        # pull basic topic information from the database for this user..
-        conn = self.db.engine.connect()
+        with self.connection() as conn:
+            record_set = self.__query_exercise_records(conn, user_id).fetchall()
+            exercises_with_attempts = self.__group_exercise_records(record_set)
 
-        # new version.....
-        # get all exercises
-        exercises_with_attempts = self.get_all_exercises(user_id)
+            if summary == "daily":
+                history_key, history_by_exercise = "daily", self.__daily_rollups(conn, user_id, since)
+            else:
+                history_key, history_by_exercise = "attempts", self.__attempts_by_exercise(conn, user_id, since)
 
-        # for each exercise get the attempts for that exercise
         for exercise in exercises_with_attempts:
-            attempts = self.get_attempts(exercise.get("id"))
-            exercise.update({"attempts": attempts})
+            exercise.update({history_key: history_by_exercise.get(exercise.get("id"), [])})
 
-        conn.close()
         return exercises_with_attempts
 
-
-    def delete_exercise(self, user_id, exercise_id):
+    def __attempts_by_exercise(self, conn, user_id, since=None):
         """
-        Submit a request to have an exercise deleted.
-        :param exercise_id: ID of the exercise we're requesting to have deleted
-        :return: Nothing.
+        :param conn: The database connection.
+        :param user_id: The user whose attempts we're looking up.
+        :param since: Earliest attempt time to include, or None for all of them.
+        :return: Dict of exercise id to that exercise's attempts in the order they were made.
         """
-        conn = self.db.engine.connect()
-
-        exercise_parm = self.db.bindparam("exercise_id", type_=self.db.Integer)
-        user_parm = self.db.bindparam("user_id", type_=self.db.String)
-
-        query = self.db.select([self.exercise_table.c.id]).where(and_(
-            self.exercise_table.c.id == exercise_parm,
-            self.exercise_table.c.user_id == user_parm
-        ))
-
-        is_valid_user = conn.execute(query, exercise_id=exercise_id, user_id=user_id).fetchone()
-
-        if is_valid_user:
-            with conn.begin() as trans:
-                query = self.exercise_by_exercise_tags_table.delete().where(self.exercise_by_exercise_tags_table.c.exercise_id == exercise_parm)
-                conn.execute(query, exercise_id=exercise_id)
-
-                query = self.attempt_table.delete().where(self.attempt_table.c.exercise_id == exercise_parm)
-                conn.execute(query, exercise_id=exercise_id)
-
-                query = self.resource_by_exercise_table.delete().where(self.resource_by_exercise_table.c.exercise_id == exercise_parm)
-                conn.execute(query, exercise_id=exercise_id)
-
-                query = self.exercise_table.delete().where(self.exercise_table.c.id == exercise_parm)
-                conn.execute(query, exercise_id=exercise_id)
-                trans.commit()
+        query = self.__attempts_query(since, user_id=True)
 
-            msg = "Executed deleteion query on exercise: {} belonging to user: {}".format(exercise_id, user_id)
-        else:
-            msg = "User: {} not the owner of exercise: {}".format(user_id, exercise_id)
-
-        conn.close()
-        return msg
-
-    def delete_resource(self, user_id, resource_id):
-        conn = self.db.engine.connect()
+        attempts_by_exercise = {}
+        for exercise_id, attempt_id, score, when_attempted in conn.execute(query, user_id=user_id, since=since):
+            attempt = {"score": score, "when_attempted": when_attempted.isoformat()}
+            attempts_by_exercise.setdefault(exercise_id, []).append(attempt)
+        return attempts_by_exercise
 
-        user_parm = self.db.bindparam("user_id", type_=self.db.String)
-        resource_parm = self.db.bindparam("resource_id", type_=self.db.Integer)
+    def __daily_rollups(self, conn, user_id, since=None):
+        """
+        :param conn: The database connection.
+        :param user_id: The user whose rollups we're looking up.
+        :param since: Earliest day to include, or None for all of them.
+        :return: Dict of exercise id to that exercise's daily score counts, oldest day first.
+        """
+        rollups = self.attempt_rollup_table
+        query = self.db.select([rollups.c.exercise_id, rollups.c.day, rollups.c.bad, rollups.c.okay, rollups.c.good])\
+            .where(rollups.c.user_id == self.db.bindparam("user_id"))\
+            .order_by(rollups.c.exercise_id, rollups.c.day)
+        if since is not None:
+            query = query.where(rollups.c.day >= self.db.bindparam("since", type_=self.db.Date))
+
+        daily_by_exercise = {}
+        since = since.date() if since is not None else None
+        for exercise_id, day, bad, okay, good in conn.execute(query, user_id=user_id, since=since):
+            daily = {"day": day.isoformat(), "bad": bad, "okay": okay, "good": good}
+            daily_by_exercise.setdefault(exercise_id, []).append(daily)
+        return daily_by_exercise
+
+
+    def __index_documents(self, conn, rows):
+        """
+        Add search_terms rows for newly written exercises or resources.
+        :param conn: The database connection.
+        :param rows: Rows as built by search.exercise_rows or search.resource_rows.
+        :return: Nothing.
+        """
+        if rows:
+            conn.execute(self.search_term_table.insert(), rows)
 
-        query = self.db.select([self.resource_table.c.id]).where(and_(
-            self.resource_table.c.id == resource_parm,
-            self.resource_table.c.user_id == user_parm
-        ))
+    def __unindex_documents(self, conn, kind, doc_ids):
+        """
+        Take exercises or resources out of the search index.
+        :param conn: The database connection.
+        :param kind: search.EXERCISE or search.RESOURCE.
+        :param doc_ids: Ids of the exercises or resources.
+        :return: Nothing.
+        """
+        query = self.db.text("delete from search_terms where kind = :kind and doc_id in :ids")\
+            .bindparams(self.db.bindparam("ids", expanding=True))
+        conn.execute(query, kind=kind, ids=list(doc_ids))
 
-        is_valid_user = conn.execute(query, user_id=user_id, resource_id=resource_id).fetchone()
+    def search(self, user_id, query, offset=0, limit=DEFAULT_SEARCH_LIMIT):
+        """
+        Search a user's exercises and resources.  Each query term matches indexed terms that start with it.  Documents
+        matching more of the query terms rank first, then documents where the terms carry more weight.
+        :param user_id: The user whose exercises and resources get searched.
+        :param query: What the user typed.
+        :param offset: How many results to skip, for paging.
+        :param limit: Max number of results to hand back.
+        :return: A tuple of the list of results, each with a type of "exercise" or "resource", and the offset for the
+                 next page (None on the last page).
+        """
+        db = self.db
+        if limit < 1 or limit > MAX_SEARCH_LIMIT:
+            raise Exception("Number of results has to be between 1 and {}".format(MAX_SEARCH_LIMIT))
+        if offset < 0:
+            raise Exception("Offset can't be negative")
+
+        terms = search.query_terms(query)
+        if not terms:
+            return [], None
+
+        # One index range scan per query term, each scoring a document once however many indexed terms it matched.
+        per_term = """
+            select kind, doc_id, max(weight) as score
+            from search_terms
+            where user_id = :uid
+            and term >= :low{n} and term < :high{n}
+            group by kind, doc_id"""
+        query_str = """
+        select kind, doc_id, count(*) as matched, sum(score) as score
+        from ({}
+        ) as hits
+        group by kind, doc_id
+        order by matched desc, score desc, kind, doc_id
+        limit :lim offset :off""".format("\n            union all".join(per_term.format(n=n) for n in range(len(terms))))
+
+        params = dict(uid=user_id, lim=limit, off=offset)
+        for n, term in enumerate(terms):
+            params["low{}".format(n)], params["high{}".format(n)] = search.prefix_range(term)
+
+        with self.connection() as conn:
+            hits = conn.execute(db.text(query_str), **params).fetchall()
+            exercise_ids = [doc_id for kind, doc_id, matched, score in hits if kind == search.EXERCISE]
+            resource_ids = [doc_id for kind, doc_id, matched, score in hits if kind == search.RESOURCE]
+            documents = self.__search_documents(conn, user_id, exercise_ids, resource_ids)
+
+        results = []
+        for kind, doc_id, matched, score in hits:
+            document = documents.get((kind, doc_id))
+            if document is not None:
+                # MySQL hands sums back as Decimal, which jsonify can't write and ujson writes as a float.
+                results.append(dict(document, type=kind, matched=int(matched), score=int(score)))
+
+        next_offset = offset + limit if len(hits) == limit else None
+        return results, next_offset
+
+    def __search_documents(self, conn, user_id, exercise_ids, resource_ids):
+        """
+        Look up the exercises and resources that came up in a search.
+        :param conn: The database connection.
+        :param user_id: The user they belong to.
+        :param exercise_ids: Ids of the exercises to look up.
+        :param resource_ids: Ids of the resources to look up.
+        :return: Dict of (kind, id) to the document's info.
+        """
+        db = self.db
+        documents = {}
+
+        if exercise_ids:
+            query = db.text("""
+            select e.id, e.question, e.answer, e.difficulty, ebet.tag_name
+            from exercises as e
+            left join exercises_by_exercise_tags as ebet
+            on e.id = ebet.exercise_id
+            where e.user_id = :uid
+            and e.id in :ids
+            and e.deleted_at is null
+            order by e.id""").bindparams(db.bindparam("ids", expanding=True))
+            record_set = conn.execute(query, uid=user_id, ids=exercise_ids).fetchall()
+            for exercise in self.__group_exercise_records(record_set):
+                documents[(search.EXERCISE, exercise["id"])] = exercise
+
+        if resource_ids:
+            query = db.text("""
+            select id, caption, url
+            from resources
+            where user_id = :uid
+            and id in :ids""").bindparams(db.bindparam("ids", expanding=True))
+            for rid, caption, url in conn.execute(query, uid=user_id, ids=resource_ids):
+                documents[(search.RESOURCE, rid)] = dict(id=rid, caption=caption, url=url)
+
+        return documents
+
+    def reindex_search(self, user_id=None):
+        """
+        Rebuild the search index from the exercises and resources, for one user or for everyone.
+        :param user_id: The user whose index gets rebuilt.  None for every user.
+        :return: Number of documents indexed.
+        """
+        db = self.db
+        user_filter = " where user_id = :uid" if user_id else ""
+        exercises_query = db.text("select id, user_id, question, answer from exercises where deleted_at is null" +
+                                  (" and user_id = :uid" if user_id else ""))
+        resources_query = db.text("select id, user_id, caption from resources" + user_filter)
+        delete_query = db.text("delete from search_terms" + user_filter)
+
+        with self.transaction() as conn:
+            conn.execute(delete_query, uid=user_id)
+
+            exercises = conn.execute(exercises_query, uid=user_id).fetchall()
+            resources = conn.execute(resources_query, uid=user_id).fetchall()
+            for start in range(0, len(exercises), IMPORT_CHUNK_SIZE):
+                self.__index_documents(conn, [row for eid, owner, question, answer
+                                              in exercises[start:start + IMPORT_CHUNK_SIZE]
+                                              for row in search.exercise_rows(owner, eid, question, answer)])
+            for start in range(0, len(resources), IMPORT_CHUNK_SIZE):
+                self.__index_documents(conn, [row for rid, owner, caption in resources[start:start + IMPORT_CHUNK_SIZE]
+                                              for row in search.resource_rows(owner, rid, caption)])
+
+        return len(exercises) + len(resources)
 
-        if is_valid_user:
-            with conn.begin() as trans:
-                query = self.resource_by_exercise_table.delete().where(self.resource_by_exercise_table.c.resource_id == resource_parm)
-                conn.execute(query, resource_id=resource_id)
+    def delete_exercise(self, user_id, exercise_id):
+        """
+        Submit a request to have an exercise deleted.  See delete_exercises.
+        :param exercise_id: ID of the exercise we're requesting to have deleted
+        :return: A message saying what happened.
+        """
+        if self.delete_exercises(user_id, [exercise_id]):
+            return "Marked exercise: {} belonging to user: {} deleted".format(exercise_id, user_id)
+        return "User: {} not the owner of exercise: {}".format(user_id, exercise_id)
 
-                query = self.resource_table.delete().where(self.resource_table.c.id == resource_parm)
-                conn.execute(query, resource_id=resource_id)
-                trans.commit()
+    def delete_exercises(self, user_id, exercise_ids):
+        """
+        Delete a batch of exercises.  They're marked deleted with one update, which takes them out of every read straight
+        away, and dropped from the search index.  Their tag links, attempts, rollups and resource links are left for
+        purge_deleted_exercises to clear out later.
+        Ids that aren't the user's, or that are already deleted, are skipped.
+        :param user_id: The user the exercises belong to.
+        :param exercise_ids: Ids of the exercises to delete.
+        :return: Number of exercises deleted.
+        """
+        from datetime import datetime
+        db = self.db
 
-        conn.close()
+        exercise_ids = sorted(set(exercise_ids))
+        if len(exercise_ids) > MAX_DELETE_BATCH:
+            raise Exception("No more than {} exercises can be deleted at once".format(MAX_DELETE_BATCH))
+        if not exercise_ids:
+            return 0
+
+        exercises = self.exercise_table
+        owned_query = db.select([exercises.c.id])\
+            .where(and_(exercises.c.user_id == db.bindparam("user_id"),
+                        exercises.c.id.in_(db.bindparam("ids", expanding=True)),
+                        exercises.c.deleted_at.is_(None)))
+        mark_query = db.text("""
+        update exercises
+        set deleted_at = :now
+        where user_id = :uid
+        and id in :ids
+        and deleted_at is null""").bindparams(db.bindparam("ids", expanding=True), db.bindparam("now", type_=db.DateTime))
+
+        with self.transaction() as conn:
+            owned = [eid for eid, *_ in conn.execute(owned_query, user_id=user_id, ids=exercise_ids)]
+            if not owned:
+                return 0
+            conn.execute(mark_query, uid=user_id, ids=owned, now=datetime.now())
+            self.__unindex_documents(conn, search.EXERCISE, owned)
+            self.__bump_data_version(conn, user_id)
+
+        self.cache.invalidate(user_id, cache.EXERCISES, cache.RESOURCES)
+        return len(owned)
+
+    def purge_deleted_exercises(self, batch_size=None):
+        """
+        Remove exercises marked deleted, along with everything hanging off of them.  Works through them in batches,
+        each in its own short transaction, and clears their attempts out a batch of rows at a time, so the job never
+        holds locks on a big slice of any table.
+        :param batch_size: How many exercises, or attempts, to remove per transaction.  Defaults to purge_batch_size.
+        :return: Number of exercises removed.
+        """
+        db = self.db
+        batch_size = batch_size or self.purge_batch_size
+        ids_parm = db.bindparam("ids", expanding=True)
+        exercises = self.exercise_table
+
+        deleted_query = db.select([exercises.c.id])\
+            .where(exercises.c.deleted_at.isnot(None))\
+            .order_by(exercises.c.id)\
+            .limit(batch_size)
+        tier_queries = [(db.select([tier.c.id]).where(tier.c.exercise_id.in_(ids_parm)).limit(batch_size),
+                         tier.delete().where(tier.c.id.in_(db.bindparam("row_ids", expanding=True))))
+                        for tier in (self.attempt_table, self.attempt_archive_table)]
+        link_deletes = [self.exercise_by_exercise_tags_table.delete()
+                            .where(self.exercise_by_exercise_tags_table.c.exercise_id.in_(ids_parm)),
+                        self.attempt_rollup_table.delete().where(self.attempt_rollup_table.c.exercise_id.in_(ids_parm)),
+                        self.resource_by_exercise_table.delete()
+                            .where(self.resource_by_exercise_table.c.exercise_id.in_(ids_parm)),
+                        exercises.delete().where(and_(exercises.c.id.in_(ids_parm), exercises.c.deleted_at.isnot(None)))]
+
+        purged = 0
+        while True:
+            with self.connection() as conn:
+                ids = [eid for eid, *_ in conn.execute(deleted_query)]
+            if not ids:
+                break
+
+            for ids_query, delete_query in tier_queries:
+                while True:
+                    with self.transaction() as conn:
+                        row_ids = [row_id for row_id, *_ in conn.execute(ids_query, ids=ids)]
+                        if not row_ids:
+                            break
+                        conn.execute(delete_query, row_ids=row_ids)
+
+            with self.transaction() as conn:
+                for delete_query in link_deletes:
+                    conn.execute(delete_query, ids=ids)
+            purged += len(ids)
+
+        return purged
+
+    def delete_resource(self, user_id, resource_id, exercise_id=None):
+        """
+        Take a resource off of an exercise.  Other exercises can share the resource, so the resource itself is only
+        deleted, and dropped from the search index, once no exercise links to it any more.
+        :param user_id: The user the resource belongs to.
+        :param resource_id: Id of the resource.
+        :param exercise_id: The exercise to take it off of.  Leave it out to delete the resource from every exercise.
+        :return: "FINISHED"
+        """
+        db = self.db
+        resources, links = self.resource_table, self.resource_by_exercise_table
+        resource_query = db.select([resources.c.id])\
+            .where(and_(resources.c.id == db.bindparam("resource_id"), resources.c.user_id == db.bindparam("user_id")))
+        unlink_query = links.delete()\
+            .where(and_(links.c.resource_id == db.bindparam("resource_id"),
+                        links.c.exercise_id == db.bindparam("exercise_id")))
+        remaining_query = db.select([links.c.exercise_id]).where(links.c.resource_id == db.bindparam("resource_id"))\
+            .limit(1)
+
+        with self.transaction() as conn:
+            if conn.execute(resource_query, resource_id=resource_id, user_id=user_id).fetchone() is None:
+                return "FINISHED"
+
+            if exercise_id is not None:
+                conn.execute(unlink_query, resource_id=resource_id, exercise_id=exercise_id)
+            if exercise_id is None or conn.execute(remaining_query, resource_id=resource_id).fetchone() is None:
+                conn.execute(links.delete().where(links.c.resource_id == db.bindparam("resource_id")),
+                             resource_id=resource_id)
+                conn.execute(resources.delete().where(resources.c.id == db.bindparam("resource_id")),
+                             resource_id=resource_id)
+                self.__unindex_documents(conn, search.RESOURCE, [resource_id])
+            self.__bump_data_version(conn, user_id)
+
+        # Only once the changes are committed, so no other worker can cache what was there before under the new token.
+        self.cache.invalidate(user_id, cache.RESOURCES)
         return "FINISHED"
 
-
     def add_resource(self, caption, url, user_id, exercise_id=None):
         """
-        Add a clickable resource to the data store
+        Add a clickable resource to the data store.  Each user has one resource per URL, going by resource_urls, so
+        adding a URL they already have links the existing resource to the exercise instead of storing it again.  The
+        existing resource keeps its caption.
         :param caption: The text to show up for the user to click on.
         :param url: Where clicking the text takes you.
         :param user_id: Who owns this link.
-        :param exercise_id The exercise that this resource refers to.
-        :return: Nothing.
+        :param exercise_id The exercise that this resource refers to.  It has to be one of the user's and not deleted.
+        :return: A tuple of the id of the resource and whether it was one the user already had.
         """
 
         db = self.db
@@ -361,25 +1339,90 @@ class FlashmarkModel():
             msg = "Either new caption or new url exceeded char limit of {} chars".format(CHARACTER_LIMIT)
             raise Exception(msg)
 
-        caption_parm = self.db.bindparam("caption", type_=self.db.String)
-        url_parm = self.db.bindparam("url", type_=self.db.String)
-        user_parm = self.db.bindparam("user_id", type_=self.db.String)
-        exercise_parm = self.db.bindparam("exercise_id", type_=self.db.Integer)
-
-        conn = db.engine.connect()
-
-        with conn.begin() as trans:
-            query = self.resource_table.insert().values(caption=caption_parm, url=url_parm, user_id=user_parm)
-            result = conn.execute(query, caption=caption, url=url, user_id=user_id)
-            new_resource_id = result.inserted_primary_key[0]
-
-            query = self.resource_by_exercise_table.insert().values(exercise_id=exercise_parm, resource_id=new_resource_id)
-            conn.execute(query, exercise_id=exercise_id, user_id=user_id)
-            trans.commit()
+        key = resource_urls.url_key(url)
+        resources = self.resource_table
+        insert_query = self.backend.insert_ignore(resources)\
+            .values(caption=db.bindparam("caption", type_=db.String), url=db.bindparam("url", type_=db.String),
+                    user_id=db.bindparam("user_id", type_=db.String), url_key=db.bindparam("url_key", type_=db.String))
+        id_query = db.select([resources.c.id])\
+            .where(and_(resources.c.user_id == db.bindparam("user_id"), resources.c.url_key == db.bindparam("url_key")))
+        link_query = self.backend.insert_ignore(self.resource_by_exercise_table)
+        exercises = self.exercise_table
+        owned_query = db.select([exercises.c.id])\
+            .where(and_(exercises.c.id == db.bindparam("exercise_id"), exercises.c.user_id == db.bindparam("user_id"),
+                        exercises.c.deleted_at.is_(None)))
+
+        with self.transaction() as conn:
+            if exercise_id is not None and \
+                    conn.execute(owned_query, exercise_id=exercise_id, user_id=user_id).fetchone() is None:
+                raise Exception("No exercise {} for this user".format(exercise_id))
+
+            result = conn.execute(insert_query, caption=caption, url=url, user_id=user_id, url_key=key)
+            resource_id, *_ = conn.execute(id_query, user_id=user_id, url_key=key).fetchone()
+            created = result.rowcount > 0
+            if created:
+                self.__index_documents(conn, search.resource_rows(user_id, resource_id, caption))
+
+            if exercise_id is not None:
+                conn.execute(link_query, resource_id=resource_id, exercise_id=exercise_id)
+            self.__bump_data_version(conn, user_id)
+
+        self.cache.invalidate(user_id, cache.RESOURCES)
+        return resource_id, not created
+
+    def link_resource(self, user_id, resource_id, link_ids=(), unlink_ids=()):
+        """
+        Link one of the user's resources to a batch of exercises, and unlink it from another, in one transaction.
+        Exercises that aren't the user's, or that are deleted, are skipped, as are links that are already there or
+        already gone.
+        :param user_id: The user the resource belongs to.
+        :param resource_id: Id of the resource.
+        :param link_ids: Ids of the exercises to link it to.
+        :param unlink_ids: Ids of the exercises to unlink it from.
+        :return: A tuple of the number of links made and the number removed.
+        """
+        db = self.db
 
-        conn.close()
-        msg = ""
-        return msg
+        link_ids, unlink_ids = sorted(set(link_ids)), sorted(set(unlink_ids))
+        if len(link_ids) + len(unlink_ids) > MAX_DELETE_BATCH:
+            raise Exception("No more than {} exercises can be linked or unlinked at once".format(MAX_DELETE_BATCH))
+
+        resources, links, exercises = self.resource_table, self.resource_by_exercise_table, self.exercise_table
+        resource_query = db.select([resources.c.id])\
+            .where(and_(resources.c.id == db.bindparam("resource_id"), resources.c.user_id == db.bindparam("user_id")))
+        owned_query = db.select([exercises.c.id])\
+            .where(and_(exercises.c.user_id == db.bindparam("user_id"),
+                        exercises.c.id.in_(db.bindparam("ids", expanding=True)),
+                        exercises.c.deleted_at.is_(None)))
+        unlink_query = links.delete()\
+            .where(and_(links.c.resource_id == db.bindparam("rid"),
+                        links.c.exercise_id.in_(db.bindparam("ids", expanding=True))))
+        linked_query = db.select([links.c.exercise_id])\
+            .where(and_(links.c.resource_id == db.bindparam("rid"),
+                        links.c.exercise_id.in_(db.bindparam("ids", expanding=True))))
+
+        linked = unlinked = 0
+        with self.transaction() as conn:
+            if conn.execute(resource_query, resource_id=resource_id, user_id=user_id).fetchone() is None:
+                raise Exception("No resource {} for this user".format(resource_id))
+
+            if link_ids:
+                owned = [eid for eid, *_ in conn.execute(owned_query, user_id=user_id, ids=link_ids)]
+                if owned:
+                    already = set(eid for eid, *_ in conn.execute(linked_query, rid=resource_id, ids=owned))
+                    new_links = [dict(resource_id=resource_id, exercise_id=eid) for eid in owned if eid not in already]
+                    if new_links:
+                        conn.execute(self.backend.insert_ignore(links), new_links)
+                    linked = len(new_links)
+            if unlink_ids:
+                unlinked = conn.execute(unlink_query, rid=resource_id, ids=unlink_ids).rowcount
+
+            if linked or unlinked:
+                self.__bump_data_version(conn, user_id)
+
+        if linked or unlinked:
+            self.cache.invalidate(user_id, cache.RESOURCES)
+        return linked, unlinked
 
     def get_resources(self, user_id):
         """
@@ -388,42 +1431,20 @@ class FlashmarkModel():
         :return: A list of all the exercises owned by this user
         """
         db = self.db
-        conn = db.engine.connect()
-        user_id_parm = db.bindparam("user_id")
-        query = db.select([self.resource_table])\
-            .where(self.resource_table.c.user_id == user_id_parm)
-
-        result = conn.execute(query, user_id=user_id)
-        resources = [dict(resource_id=resource_id, user_id=user_id, caption=caption, url=url)
-                        for resource_id, caption, url, user_id in result.fetchall()]
-        conn.close()
-
-        return resources
-
-
-    def get_resources_for_exercise(self, exercise_id, user_id):
-        """
-        Get all resources connected to the given exercise
-        :param exercise_id: ID of the exercise in question
-        :param user_id: Owning user
-        :return: A list the appropriate resources.
-        """
-        db = self.db
-        conn = db.engine.connect()
-        user_id_parm = db.bindparam("user_id")
-        exercise_parm = db.bindparam("exercise_id")
 
-        query = db.select([self.resource_table.c.id, self.resource_table.c.caption, self.resource_table.c.url, self.resource_table.c.user_id])\
-                    .select_from(self.resource_table.join(self.resource_by_exercise_table))\
-                    .where(and_(self.resource_table.c.user_id == user_id_parm,
-                                self.resource_by_exercise_table.c.exercise_id == exercise_parm))
+        def load_resources():
+            with self.connection() as conn:
+                user_id_parm = db.bindparam("user_id")
+                query = db.select([self.resource_table.c.id, self.resource_table.c.caption, self.resource_table.c.url,
+                                   self.resource_table.c.user_id])\
+                    .where(self.resource_table.c.user_id == user_id_parm)
 
-        result = conn.execute(query, user_id=user_id, exercise_id=exercise_id)
-        resources = [dict(resource_id=resource_id, user_id=user_id, caption=caption, url=url)
-                        for resource_id, caption, url, user_id in result.fetchall()]
-        conn.close()
+                result = conn.execute(query, user_id=user_id)
+                resources = [dict(resource_id=resource_id, user_id=owner_id, caption=caption, url=url)
+                                for resource_id, caption, url, owner_id in result.fetchall()]
+            return resources
 
-        return resources
+        return self.cache.fetch(user_id, cache.RESOURCES, ("all",), load_resources)
 
 
     def get_resources_for_exercise(self, exercise_id, user_id):
@@ -434,21 +1455,26 @@ class FlashmarkModel():
         :return: A list the appropriate resources.
         """
         db = self.db
-        conn = db.engine.connect()
-        user_id_parm = db.bindparam("user_id")
-        exercise_parm = db.bindparam("exercise_id")
 
-        query = db.select([self.resource_table.c.id, self.resource_table.c.caption, self.resource_table.c.url, self.resource_table.c.user_id])\
-                    .select_from(self.resource_table.join(self.resource_by_exercise_table))\
-                    .where(and_(self.resource_table.c.user_id == user_id_parm,
-                                self.resource_by_exercise_table.c.exercise_id == exercise_parm))
+        def load_resources():
+            with self.connection() as conn:
+                user_id_parm = db.bindparam("user_id")
+                exercise_parm = db.bindparam("exercise_id")
 
-        result = conn.execute(query, user_id=user_id, exercise_id=exercise_id)
-        resources = [dict(resource_id=resource_id, user_id=user_id, caption=caption, url=url)
-                        for resource_id, caption, url, user_id in result.fetchall()]
-        conn.close()
+                query = db.select([self.resource_table.c.id, self.resource_table.c.caption, self.resource_table.c.url, self.resource_table.c.user_id])\
+                            .select_from(self.resource_table.join(self.resource_by_exercise_table)
+                                         .join(self.exercise_table,
+                                               self.exercise_table.c.id == self.resource_by_exercise_table.c.exercise_id))\
+                            .where(and_(self.resource_table.c.user_id == user_id_parm,
+                                        self.resource_by_exercise_table.c.exercise_id == exercise_parm,
+                                        self.exercise_table.c.deleted_at.is_(None)))
 
-        return resources
+                result = conn.execute(query, user_id=user_id, exercise_id=exercise_id)
+                resources = [dict(resource_id=resource_id, user_id=owner_id, caption=caption, url=url)
+                                for resource_id, caption, url, owner_id in result.fetchall()]
+            return resources
+
+        return self.cache.fetch(user_id, cache.RESOURCES, ("exercise", exercise_id), load_resources)
 
 
     def get_new_difficulty(self, conn, user_id):
@@ -459,7 +1485,7 @@ class FlashmarkModel():
         :return:
         """
         db = self.db
-        query = db.text("select max(difficulty) from exercises where user_id = :uid")
+        query = db.text("select max(difficulty) from exercises where user_id = :uid and deleted_at is null")
         diff, *_ = conn.execute(query, uid=user_id).fetchall()[0]
         if diff:
             diff += 1
@@ -476,12 +1502,12 @@ class FlashmarkModel():
         :return: Nothing.
         """
         db = self.db
-        conn = db.engine.connect()
-        with conn.begin() as trans:
+        with self.transaction() as conn:
             diff = self.get_new_difficulty(conn, user_id)
             query = db.text("update exercises set difficulty = :d where user_id = :uid and id = :eid")
             conn.execute(query, d=diff, uid=user_id, eid=exercise_id)
-            trans.commit()
+            self.__bump_data_version(conn, user_id)
+        self.cache.invalidate(user_id, cache.EXERCISES)
 
     def __get_stored_tags(self, conn, user_id=None, exercise_id=None):
         db = self.db
@@ -501,24 +1527,6 @@ class FlashmarkModel():
         return tag_list
 
 
-    def __should_add_tag(self, conn, tag_name, user_id):
-        """
-        Determined whether to add the tag to the system based on whether or not it's already there.
-        :param conn: The database connection.
-        :param tag_name: The tag to look up.
-        :param user_id: The ID of the user that we're looking up stored tags for.
-        :return: True if the tag needs to be added or False if it's already in there.
-        """
-        db = self.db
-        query = db.text("select name from exercise_tags where user_id = :uid")
-        res = conn.execute(query, uid=user_id)
-        stored_tag_list = [tag for tag, *_ in res.fetchall()]
-        if tag_name in stored_tag_list:
-            return False
-        else:
-            return True
-
-
     def __get_tags_to_change(self, conn, tag_list, exercise_id):
         """
         Gets tags to be removed and tags to be added for the exercise.
@@ -545,69 +1553,52 @@ class FlashmarkModel():
         """
         db = self.db
 
-        def __all_tags_valid(tag_candidates):
-            import re
-            patt = r"^\w+$"
-            for tag in tag_candidates:
-                if not re.match(patt, tag):
-                    return False
-            return True
-
         tags = tag_list.split()
-        if not __all_tags_valid(tags):
+        if not all_tags_valid(tags):
             raise Exception("Tags are supposed to be made up of only numbers, letters, and underscores")
 
-        tags = [tag.lower() for tag in tags]
-        conn = db.engine.connect()
-
-        with conn.begin() as trans:
-            for tag in tags:
-                if self.__should_add_tag(conn, tag, user_id):
-                    query = db.text("insert into exercise_tags values(:new_tag, :uid)")
-                    conn.execute(query, new_tag=tag, uid=user_id)
+        tags = sorted(set(tag.lower() for tag in tags))
+        with self.transaction() as conn:
+            if tags:
+                conn.execute(self.backend.insert_ignore(self.exercise_tag_table),
+                             [dict(name=tag, user_id=user_id) for tag in tags])
 
             tags_to_connect, tags_to_disconnect = self.__get_tags_to_change(conn, tags, exercise_id)
 
-            for tag in tags_to_connect:
-                query = db.text("insert into exercises_by_exercise_tags values( :eid, :tag, :uid)")
-                conn.execute(query, eid=exercise_id, tag=tag, uid=user_id)
+            if tags_to_connect:
+                conn.execute(self.exercise_by_exercise_tags_table.insert(),
+                             [dict(exercise_id=exercise_id, tag_name=tag, user_id=user_id) for tag in tags_to_connect])
 
-            for tag in tags_to_disconnect:
-                query = db.text("delete from exercises_by_exercise_tags where exercise_id = :eid and tag_name = :tag and user_id = :uid")
-                conn.execute(query, eid=exercise_id, tag=tag, uid=user_id)
+            if tags_to_disconnect:
+                query = db.text("delete from exercises_by_exercise_tags "
+                                "where exercise_id = :eid and user_id = :uid and tag_name in :tags")
+                query = query.bindparams(db.bindparam("tags", expanding=True))
+                conn.execute(query, eid=exercise_id, uid=user_id, tags=tags_to_disconnect)
 
-            trans.commit()
+            self.__bump_data_version(conn, user_id)
+        self.cache.invalidate(user_id, cache.EXERCISES)
 
 
-def suggest_name(url):
+def suggest_name(url, fetcher):
     """
     Suggest a name for the resource url by grabbing the text from the title tag
     :param url: The URL for the learning resource in question.
+    :param fetcher: The TitleFetcher to look the page title up with.
     :return: A text string representing the title name for the learning resource
     """
-    try:
-        if url is None:
-            raise Exception("You didn't pass me a URL to look up.")
-
-        # title part
-        raw_html_text = requests.get(url).text
-        soup = BeautifulSoup(raw_html_text, "lxml")
-        titles = soup("title")
-        title_text = titles[0].text if titles else ""
-        title_text = title_text.strip()
-
-        # domain name part
-        match = re.search(r"/.+?/", url)
-        domain_part = match.group()
-        domain_part = domain_part.replace("/", "")
-
-        full_suggestion = "{} - {}".format(title_text, domain_part)
-        return full_suggestion
-
-    except MissingSchema as ms:
-        raise Exception("You need an http or https at the start of the URL you're passing.")
-    except ConnectionError as ce:
-        raise Exception("I can't get at the page you're trying to point me towards.")
+    if url is None:
+        raise Exception("You didn't pass me a URL to look up.")
+
+    # title part
+    title_text = fetcher.get_title(url)
+
+    # domain name part
+    match = re.search(r"/.+?/", url)
+    domain_part = match.group()
+    domain_part = domain_part.replace("/", "")
+
+    full_suggestion = "{} - {}".format(title_text, domain_part)
+    return full_suggestion
 
 
 if __name__ == '__main__':
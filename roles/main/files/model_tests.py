@@ -0,0 +1,290 @@
+import unittest
+from datetime import datetime, timedelta
+from configparser import ConfigParser
+from unittest.mock import MagicMock, patch
+from flask import Flask
+import cache
+import model
+import search
+from exercise_import import ImportRow
+import tabledefs
+
+
+def make_section(**options):
+    cp = ConfigParser()
+    cp["learningmachine"] = options
+    return cp["learningmachine"]
+
+
+class ModelTestCase(unittest.TestCase):
+    """
+    The model against a throwaway in-memory SQLite database.
+    """
+
+    def setUp(self):
+        self.fm = model.FlashmarkModel(Flask(__name__), make_section(backend="sqlite", sqlite_path=":memory:"))
+        with self.fm.app.app_context():
+            tabledefs.meta.create_all(bind=self.fm.db.engine)
+        self.user_id = "dummyuser@somewhere.com"
+        self.fm.add_user(self.user_id, "Dummy User")
+        self.fm.add_user("other@somewhere.com", "Other User")
+
+    def add_exercise(self, user_id=None):
+        self.fm.add_exercise("question?", "answer", user_id or self.user_id)
+        with self.fm.connection() as conn:
+            return conn.execute("select max(id) from exercises").scalar()
+
+    def difficulty(self, exercise_id):
+        with self.fm.connection() as conn:
+            return conn.execute("select difficulty from exercises where id = ?", exercise_id).scalar()
+
+    def rows(self, query_str, *params):
+        with self.fm.connection() as conn:
+            return [tuple(row) for row in conn.execute(query_str, *params)]
+
+    def resource_ids(self, exercise_id):
+        return [resource["resource_id"] for resource in self.fm.get_resources_for_exercise(exercise_id, self.user_id)]
+
+    def test_shared_resource_outlives_one_exercise(self):
+        first, second = self.add_exercise(), self.add_exercise()
+        resource_id, reused = self.fm.add_resource("Docs", "https://docs.python.org/3/", self.user_id, first)
+        self.assertFalse(reused)
+        self.assertEqual((resource_id, True),
+                         self.fm.add_resource("Python docs", "HTTPS://docs.python.org:443/3/#top", self.user_id, second))
+        self.assertEqual(1, len(self.fm.get_resources(self.user_id)))
+
+        self.fm.delete_resource(self.user_id, resource_id, first)
+        self.assertEqual([], self.resource_ids(first))
+        self.assertEqual([resource_id], self.resource_ids(second))
+        self.assertEqual(1, len(self.fm.search(self.user_id, "docs")[0]))
+
+        self.fm.delete_resource(self.user_id, resource_id, second)
+        self.assertEqual([], self.fm.get_resources(self.user_id))
+        self.assertEqual([], self.fm.search(self.user_id, "docs")[0])
+
+    def test_add_resource_checks_the_exercise(self):
+        others = self.add_exercise("other@somewhere.com")
+        with self.assertRaises(Exception):
+            self.fm.add_resource("Docs", "https://docs.python.org/3/", self.user_id, others)
+
+        deleted = self.add_exercise()
+        self.fm.delete_exercises(self.user_id, [deleted])
+        with self.assertRaises(Exception):
+            self.fm.add_resource("Docs", "https://docs.python.org/3/", self.user_id, deleted)
+        self.assertEqual([], self.fm.get_resources(self.user_id))
+
+    def test_search_indexes_accented_and_plain_forms(self):
+        self.fm.add_exercise("Café résumé?", "cafe resume", self.user_id)
+        results, next_offset = self.fm.search(self.user_id, "resume")
+        self.assertEqual(["Café résumé?"], [result["question"] for result in results])
+        self.assertEqual((int, int), (type(results[0]["matched"]), type(results[0]["score"])))
+        self.assertEqual(1, len(self.fm.search(self.user_id, "café")[0]))
+
+    def test_archive_keeps_recent_attempts_hot(self):
+        with self.assertRaises(Exception):
+            self.fm.archive_attempts(self.fm.archive_after_days - 1)
+        self.assertEqual(0, self.fm.archive_attempts(self.fm.archive_after_days))
+
+    def test_archived_attempts_still_show_up_in_the_history(self):
+        exercise_id = self.add_exercise()
+        now = datetime.now()
+        old, older = now - timedelta(days=self.fm.archive_after_days + 1), now - timedelta(days=400)
+        self.fm.add_attempts(self.user_id, [(exercise_id, model.BAD, older), (exercise_id, model.OKAY, old),
+                                            (exercise_id, model.GOOD, now)])
+        hot_ids = self.rows("select id from attempts order by id")
+
+        self.assertEqual(2, self.fm.archive_attempts(batch_size=1))
+        self.assertEqual(hot_ids[2:], self.rows("select id from attempts"))
+        self.assertEqual([(hot_ids[0][0], model.BAD), (hot_ids[1][0], model.OKAY)],
+                         self.rows("select id, score from attempts_archive order by id"))
+
+        expected = [{"score": score, "when_attempted": when.isoformat()}
+                    for score, when in ((model.BAD, older), (model.OKAY, old), (model.GOOD, now))]
+        self.assertEqual(expected, self.fm.get_attempts(exercise_id))
+        self.assertEqual(expected[2:], self.fm.get_attempts(exercise_id, since=now - timedelta(days=1)))
+        self.assertEqual(expected[1:], self.fm.get_attempts(exercise_id, since=old))
+        history, = self.fm.full_attempt_history(self.user_id)
+        self.assertEqual(expected, history["attempts"])
+
+    def test_rollups_add_up_and_backfill_the_same(self):
+        first, second, others = self.add_exercise(), self.add_exercise(), self.add_exercise("other@somewhere.com")
+        today = datetime.now()
+        yesterday = today - timedelta(days=1)
+        self.fm.add_attempts(self.user_id, [(first, model.BAD, yesterday), (first, model.GOOD, yesterday),
+                                            (second, model.OKAY, today)])
+        # A second write for the same exercise and day adds onto the row rather than making another.
+        self.fm.add_attempts(self.user_id, [(first, model.GOOD, yesterday)])
+        self.fm.add_attempt(first, model.OKAY, self.user_id)
+        self.fm.add_attempt(others, model.GOOD, "other@somewhere.com")
+
+        rollups = self.fm.attempt_rollup_table
+        query = rollups.select().order_by(rollups.c.exercise_id, rollups.c.day)
+        expected = [(first, yesterday.date(), self.user_id, 1, 0, 2), (first, today.date(), self.user_id, 0, 1, 0),
+                    (second, today.date(), self.user_id, 0, 1, 0), (others, today.date(), "other@somewhere.com", 0, 0, 1)]
+        self.assertEqual(expected, self.rows(query))
+
+        # The backfill counts archived attempts too, and only touches the rollups of the user asked for.
+        archived = datetime(2000, 1, 1)
+        with self.fm.connection() as conn:
+            conn.execute("update attempt_rollups set good = 99")
+            conn.execute("insert into attempts_archive (id, score, when_attempted, exercise_id) values (1000, ?, ?, ?)",
+                         model.BAD, archived, second)
+        expected.insert(2, (second, archived.date(), self.user_id, 1, 0, 0))
+        self.assertEqual(4, self.fm.backfill_attempt_rollups(self.user_id))
+        self.assertEqual(expected[:4] + [expected[4][:-1] + (99,)], self.rows(query))
+        self.assertEqual(5, self.fm.backfill_attempt_rollups())
+        self.assertEqual(expected, self.rows(query))
+
+    def tagged_exercises(self, *tag_lists):
+        exercise_ids = []
+        for tags in tag_lists:
+            exercise_ids.append(self.add_exercise())
+            self.fm.change_tags(tags, self.user_id, exercise_ids[-1])
+        return exercise_ids
+
+    def test_tag_filters(self):
+        both, python, web, untagged, deleted = self.tagged_exercises("python web", "Python", "web", "", "python web")
+        self.fm.delete_exercises(self.user_id, [deleted])
+        others = self.add_exercise("other@somewhere.com")
+        self.fm.change_tags("python web", "other@somewhere.com", others)
+
+        def ids(tags, mode="any"):
+            return [exercise["id"] for exercise in self.fm.get_all_exercises(self.user_id, tags, mode)]
+
+        self.assertEqual([both, python, web, untagged], ids(None))
+        self.assertEqual([both, python], ids("python"))
+        self.assertEqual([both, python, web], ids(["python", "WEB"]))
+        self.assertEqual([both], ids(["python", "web"], "all"))
+        self.assertEqual([both, python], ids(["python", "python"], "all"))
+        self.assertEqual([], ids(["python", "sql"], "all"))
+        # Exercises that match come back with all of their tags.
+        self.assertEqual(["python", "web"], sorted(self.fm.get_all_exercises(self.user_id, "web", "all")[0]["tags"]))
+        self.assertEqual([dict(name="python", count=2), dict(name="web", count=2)],
+                         self.fm.get_tag_counts(self.user_id))
+
+    def test_exercise_pages(self):
+        first, second, deleted, third = self.tagged_exercises("a b c", "b", "a", "a")
+        self.fm.delete_exercises(self.user_id, [deleted])
+        self.add_exercise("other@somewhere.com")
+
+        # The limit counts exercises, not the exercise / tag rows the page is read from.
+        page, after = self.fm.get_exercise_page(self.user_id, limit=1)
+        self.assertEqual(["a", "b", "c"], sorted(page[0].pop("tags")))
+        self.assertEqual([dict(id=first, question="question?", answer="answer", difficulty=self.difficulty(first))], page)
+        self.assertEqual(first, after)
+        page, after = self.fm.get_exercise_page(self.user_id, after=after, limit=2, fields=["id"])
+        self.assertEqual(([dict(id=second), dict(id=third)], third), (page, after))
+        self.assertEqual(([], None), self.fm.get_exercise_page(self.user_id, after=after, limit=2))
+
+        page, after = self.fm.get_exercise_page(self.user_id, tags="a", limit=5, fields=["question"])
+        self.assertEqual(([dict(id=first, question="question?"), dict(id=third, question="question?")], None),
+                         (page, after))
+        page, after = self.fm.get_exercise_page(self.user_id, tags=["a", "b"], mode="all", fields=["tags"])
+        self.assertEqual([dict(id=first, tags=["a", "b", "c"])], [dict(rec, tags=sorted(rec["tags"])) for rec in page])
+
+    def test_change_tags(self):
+        exercise_id, neighbour = self.tagged_exercises("Python web", "web")
+        links = "select tag_name from exercises_by_exercise_tags where exercise_id = ? order by tag_name"
+        self.assertEqual([("python",), ("web",)], self.rows(links, exercise_id))
+
+        self.fm.change_tags("web SQL sql", self.user_id, exercise_id)
+        self.assertEqual([("sql",), ("web",)], self.rows(links, exercise_id))
+        self.assertEqual([("web",)], self.rows(links, neighbour))
+        # Tags stay on the user's list once made, even with nothing linked to them.
+        self.assertEqual([("python",), ("sql",), ("web",)], self.rows("select name from exercise_tags order by name"))
+
+        self.fm.change_tags("", self.user_id, exercise_id)
+        self.assertEqual([], self.rows(links, exercise_id))
+        with self.assertRaises(Exception):
+            self.fm.change_tags("not-valid", self.user_id, neighbour)
+        self.assertEqual([("web",)], self.rows(links, neighbour))
+
+    def test_bad_scores_ignore_deleted_exercises(self):
+        single, batched, deleted = self.add_exercise(), self.add_exercise(), self.add_exercise()
+        self.fm.set_exercise_most_difficult(deleted, self.user_id)
+        self.fm.delete_exercises(self.user_id, [deleted])
+
+        self.fm.add_attempt(single, model.BAD, self.user_id)
+        single_difficulty = self.difficulty(single)
+        self.fm.add_attempts(self.user_id, [(batched, model.BAD, None)])
+        self.assertLess(single_difficulty, self.difficulty(deleted))
+        self.assertEqual(single_difficulty + 1, self.difficulty(batched))
+
+    def test_purge_removes_deleted_exercises_and_what_hangs_off_them(self):
+        kept, purged = self.add_exercise(), self.add_exercise()
+        for exercise_id in (kept, purged):
+            self.fm.change_tags("python", self.user_id, exercise_id)
+            self.fm.add_attempts(self.user_id, [(exercise_id, model.GOOD, None), (exercise_id, model.BAD, None)])
+        with self.fm.connection() as conn:
+            conn.execute("insert into attempts_archive (id, score, when_attempted, exercise_id) values (?, 3, ?, ?)",
+                         [(1000, datetime(2000, 1, 1), kept), (1001, datetime(2000, 1, 1), purged)])
+        resource_id, reused = self.fm.add_resource("Docs", "https://docs.python.org/3/", self.user_id, kept)
+        self.fm.link_resource(self.user_id, resource_id, [purged])
+
+        self.assertEqual(1, self.fm.delete_exercises(self.user_id, [purged]))
+        self.assertEqual(0, self.fm.delete_exercises(self.user_id, [purged]))
+        # Marked deleted, but nothing is gone until the purge runs.
+        self.assertEqual([kept], [exercise["id"] for exercise in self.fm.get_all_exercises(self.user_id)])
+        self.assertEqual(2, len(self.rows("select id from attempts where exercise_id = ?", purged)))
+
+        self.assertEqual(1, self.fm.purge_deleted_exercises(batch_size=1))
+        self.assertEqual(0, self.fm.purge_deleted_exercises())
+        for table in ("attempts", "attempts_archive", "attempt_rollups", "exercises_by_exercise_tags",
+                      "resources_by_exercise"):
+            self.assertEqual([(kept,)], self.rows("select distinct exercise_id from {}".format(table)), table)
+        self.assertEqual([(kept,)], self.rows("select id from exercises"))
+        self.assertEqual([(resource_id,)], self.rows("select id from resources"))
+
+    def test_unlinking_invalidates_after_commit(self):
+        first, second = self.add_exercise(), self.add_exercise()
+        resource_id, reused = self.fm.add_resource("Docs", "https://docs.python.org/3/", self.user_id, first)
+        self.fm.link_resource(self.user_id, resource_id, [second])
+
+        def check_committed(user_id, *namespaces):
+            with self.fm.connection() as conn:
+                self.assertFalse(conn.in_transaction())
+                links = conn.execute("select exercise_id from resources_by_exercise").fetchall()
+            self.assertEqual([(second,)], links)
+
+        with patch.object(self.fm.cache, "invalidate", MagicMock(side_effect=check_committed)) as invalidate:
+            self.fm.delete_resource(self.user_id, resource_id, first)
+        invalidate.assert_called_once_with(self.user_id, cache.RESOURCES)
+
+    def test_import_exercises(self):
+        def rows():
+            yield ImportRow(1, "What is a decorator?", "A wrapper", ["python", "Functions"], None)
+            # Some other request makes one of the import's new tags before it gets written.
+            with self.fm.connection() as conn:
+                conn.execute("insert into exercise_tags (name, user_id) values ('python', ?)", self.user_id)
+            yield ImportRow(2, "x" * (model.CHARACTER_LIMIT + 1), "too long", [], None)
+            yield ImportRow(3, None, None, None, "Line is not valid JSON")
+            yield ImportRow(4, "What is yield?", "Generators", ["python"], None)
+
+        imported, errors = self.fm.import_exercises(self.user_id, rows(), chunk_size=10)
+        self.assertEqual(2, imported)
+        self.assertEqual([2, 3], [error["line"] for error in errors])
+        with self.fm.connection() as conn:
+            links = conn.execute("select e.question, t.tag_name from exercises as e "
+                                 "join exercises_by_exercise_tags as t on t.exercise_id = e.id "
+                                 "order by e.question, t.tag_name").fetchall()
+            tags = conn.execute("select name from exercise_tags order by name").fetchall()
+        self.assertEqual([("What is a decorator?", "functions"), ("What is a decorator?", "python"),
+                          ("What is yield?", "python")], links)
+        self.assertEqual([("functions",), ("python",)], tags)
+
+    def test_import_reports_every_row_of_a_failed_chunk(self):
+        rows = [ImportRow(line, "Question {}?".format(line), "answer", [], None) for line in range(1, 6)]
+        real_rows = search.exercise_rows
+
+        def failing_rows(user_id, exercise_id, question, answer):
+            if question == "Question 4?":
+                raise Exception("database went away")
+            return real_rows(user_id, exercise_id, question, answer)
+
+        with patch.object(search, "exercise_rows", failing_rows):
+            imported, errors = self.fm.import_exercises(self.user_id, rows, chunk_size=2)
+        self.assertEqual(3, imported)
+        self.assertEqual([3, 4], [error["line"] for error in errors])
+        with self.fm.connection() as conn:
+            questions = [question for question, in conn.execute("select question from exercises order by id")]
+        self.assertEqual(["Question 1?", "Question 2?", "Question 5?"], questions)
@@ -0,0 +1,47 @@
+"""
+resource_urls.py
+
+Normalizing learning resource URLs so that the same page is only stored once per user.
+
+Two URLs that differ only in the case of the scheme or host, a default port, an empty path or a trailing #fragment lead
+to the same page and get the same key.  Paths and query strings are left as they are since servers are free to treat
+those as case and order sensitive.
+"""
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    """
+    :param url: A URL as the user typed it.
+    :return: The URL in its normal form.  URLs without a scheme are taken to be http.
+    """
+    url = url.strip()
+    if "://" not in url:
+        url = "http://" + url
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").rstrip(".")
+    if ":" in host:
+        host = "[{}]".format(host)
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    netloc = host if port is None or DEFAULT_PORTS.get(scheme) == port else "{}:{}".format(host, port)
+    if parts.username is not None:
+        credentials = parts.username if parts.password is None else "{}:{}".format(parts.username, parts.password)
+        netloc = "{}@{}".format(credentials, netloc)
+
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+def url_key(url):
+    """
+    :param url: A URL as the user typed it.
+    :return: Fixed length key for the normalized URL, for the unique (user_id, url_key) index on resources.
+    """
+    return hashlib.sha1(normalize_url(url).encode("utf8")).hexdigest()
@@ -0,0 +1,15 @@
+import unittest
+from resource_urls import normalize_url, url_key
+
+
+class ResourceUrlsTestCase(unittest.TestCase):
+    def test_normalize_url(self):
+        self.assertEqual("https://docs.python.org/3/", normalize_url(" HTTPS://Docs.Python.org:443/3/#top "))
+        self.assertEqual("http://example.com/", normalize_url("example.com"))
+        self.assertEqual("http://example.com:8080/a?b=1&a=2", normalize_url("http://EXAMPLE.com:8080/a?b=1&a=2"))
+        self.assertEqual("http://user@example.com/Path", normalize_url("http://user@Example.com./Path"))
+
+    def test_url_key(self):
+        self.assertEqual(url_key("http://example.com"), url_key("HTTP://example.com:80/#intro"))
+        self.assertNotEqual(url_key("http://example.com/a"), url_key("http://example.com/A"))
+        self.assertEqual(40, len(url_key("example.com")))
@@ -0,0 +1,225 @@
+"""
+responses.py
+
+JSON responses for the Flashmark views.
+
+Serialization goes through ujson when it's installed and falls back on the standard library otherwise.  Either way the
+output is the same bytes flask.jsonify would have produced: sorted keys, ASCII only, compact separators and a trailing
+newline.  Big lists can be encoded and sent a slice at a time rather than being built up as one string.  Only the
+encoding is incremental: the list itself is already in memory, since the model loads and caches it whole.
+
+Responses above a size threshold are compressed with brotli or gzip, whichever the client prefers and the server has.
+"""
+import json
+import zlib
+from flask import Response, current_app, jsonify, request
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_LEVEL = 6
+STREAM_SLICE = 200
+COMPRESSIBLE_TYPES = ("application/json", "text/html", "text/plain", "text/csv")
+
+# Covers the places serializers tend to disagree: escaping, slashes, floats and big integers.  Floats stay in the range
+# the API actually sends (ease factors and the like).  ujson writes exponents differently (1e-7 against 1e-07), but
+# nothing Flashmark serves is small or large enough to need one.
+COMPATIBILITY_SAMPLE = {"text": "caf\u00e9 \u2028 \U0001f600 \"q\" \\ / \n\t\x01", "floats": [2.5, 1.3, 0.1, 2.36, 123456.789],
+                        "ints": [0, -1, 2 ** 53], "nested": [{"b": None, "a": True}], "": False}
+
+
+def std_dumps(obj):
+    """
+    :param obj: The structure to serialize.
+    :return: JSON text the way jsonify writes it, minus the trailing newline.
+    """
+    return json.dumps(obj, sort_keys=True, ensure_ascii=True, separators=(",", ":"))
+
+
+def fast_dumps(obj):
+    """
+    Same as std_dumps, through ujson.  Anything ujson can't handle goes through the standard library instead.
+    :param obj: The structure to serialize.
+    :return: JSON text.
+    """
+    try:
+        return ujson.dumps(obj, sort_keys=True, ensure_ascii=True, escape_forward_slashes=False)
+    except (TypeError, OverflowError, ValueError):
+        return std_dumps(obj)
+
+
+def pick_dumps():
+    """
+    :return: ujson backed dumps if ujson is installed and gives exactly the same output as the standard library on
+             the compatibility sample, otherwise the standard library's.
+    """
+    if ujson is None:
+        return std_dumps
+    try:
+        if fast_dumps(COMPATIBILITY_SAMPLE) == std_dumps(COMPATIBILITY_SAMPLE):
+            return fast_dumps
+    except Exception:
+        pass
+    return std_dumps
+
+
+dumps = pick_dumps()
+
+
+def json_response(obj, status=200):
+    """
+    Drop in replacement for jsonify.
+    :param obj: The structure to send back.
+    :param status: HTTP status code.
+    :return: A Response.
+    """
+    if current_app.debug:
+        # jsonify pretty prints in debug mode.  Leave that to it.
+        res = jsonify(obj)
+        res.status_code = status
+        return res
+    return Response(dumps(obj) + "\n", status=status, mimetype="application/json")
+
+
+def iter_json_list(key, items, extra=None):
+    """
+    Serialize {key: items, **extra} a slice of items at a time, giving exactly what dumps would for the whole thing.
+    :param key: The key the list lives under.
+    :param items: The list to stream.
+    :param extra: Dict of any other top level keys.
+    :return: A generator of text chunks.
+    """
+    members = dict(extra or {})
+    members[key] = None
+
+    yield "{"
+    for position, member_key in enumerate(sorted(members)):
+        prefix = "," if position else ""
+        if member_key != key:
+            yield "{}{}:{}".format(prefix, dumps(member_key), dumps(members[member_key]))
+            continue
+
+        yield "{}{}:[".format(prefix, dumps(key))
+        for start in range(0, len(items), STREAM_SLICE):
+            chunk = ",".join(dumps(item) for item in items[start:start + STREAM_SLICE])
+            yield ("," if start else "") + chunk
+        yield "]"
+    yield "}\n"
+
+
+def json_list_response(key, items, extra=None):
+    """
+    Streamed equivalent of json_response({key: items, **extra}) for big lists.  This saves holding the encoded body
+    on top of the list.  The list has to be built in full first, so it doesn't save the memory the list takes.
+    :param key: The key the list lives under.
+    :param items: The list to stream.
+    :param extra: Dict of any other top level keys.
+    :return: A streamed Response.
+    """
+    if current_app.debug:
+        obj = dict(extra or {})
+        obj[key] = items
+        return json_response(obj)
+    return Response(iter_json_list(key, items, extra), mimetype="application/json")
+
+
+def choose_encoding():
+    """
+    :return: "br" or "gzip" depending on what the client accepts and prefers, or None to send the body as is.
+    """
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(offered)
+
+
+class Compressor(object):
+    """
+    Registered as an after_request hook.  Compresses JSON and text responses whose body reaches min_size bytes.
+    """
+
+    def __init__(self, min_size=DEFAULT_MIN_SIZE, level=DEFAULT_LEVEL):
+        self.min_size = min_size
+        self.level = level
+
+    def make_compressor(self, encoding):
+        if encoding == "br":
+            return brotli.Compressor(quality=min(self.level, 11))
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def __call__(self, response):
+        if response.status_code != 200 or "Content-Encoding" in response.headers:
+            return response
+        if response.mimetype not in COMPRESSIBLE_TYPES:
+            return response
+
+        response.vary.add("Accept-Encoding")
+        encoding = choose_encoding()
+        if encoding is None:
+            return response
+
+        if not response.is_streamed:
+            body = response.get_data()
+            if len(body) < self.min_size:
+                return response
+            compressor = self.make_compressor(encoding)
+            response.set_data(compress_chunk(compressor, body) + finish(compressor))
+            response.headers["Content-Encoding"] = encoding
+            return response
+
+        # Streamed: read ahead until the threshold is reached.  Short bodies are sent uncompressed after all.
+        chunks = iter(response.response)
+        head, size = [], 0
+        for chunk in chunks:
+            chunk = chunk.encode("utf8") if isinstance(chunk, str) else chunk
+            head.append(chunk)
+            size += len(chunk)
+            if size >= self.min_size:
+                break
+        else:
+            response.set_data(b"".join(head))
+            return response
+
+        compressor = self.make_compressor(encoding)
+        response.response = compress_stream(compressor, head, chunks)
+        response.headers["Content-Encoding"] = encoding
+        response.headers.pop("Content-Length", None)
+        return response
+
+
+def compress_chunk(compressor, data):
+    return compressor.process(data) if hasattr(compressor, "process") else compressor.compress(data)
+
+
+def finish(compressor):
+    return compressor.finish() if hasattr(compressor, "finish") else compressor.flush()
+
+
+def compress_stream(compressor, head, rest):
+    for chunk in head:
+        yield compress_chunk(compressor, chunk)
+    for chunk in rest:
+        chunk = chunk.encode("utf8") if isinstance(chunk, str) else chunk
+        data = compress_chunk(compressor, chunk)
+        if data:
+            yield data
+    yield finish(compressor)
+
+
+def init_app(app, config_section):
+    """
+    Turn on response compression for the app.
+    :param app: The Flask app.
+    :param config_section: The learningmachine section of config.ini.
+    :return: The Compressor that was registered.
+    """
+    compressor = Compressor(config_section.getint("compress_min_size", DEFAULT_MIN_SIZE),
+                            config_section.getint("compress_level", DEFAULT_LEVEL))
+    app.after_request(compressor)
+    return compressor
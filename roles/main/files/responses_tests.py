@@ -0,0 +1,74 @@
+import gzip
+import unittest
+from decimal import Decimal
+from flask import Flask, jsonify
+import responses
+from responses import json_response, json_list_response
+
+
+class ResponsesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.compressor = responses.Compressor(min_size=200)
+        self.app.after_request(self.compressor)
+        self.exercises = [dict(id=i, question="Quéstion {} / \"quoted\"".format(i), answer="a", difficulty=i * 0.5,
+                               tags=["t{}".format(i)], due_at=None) for i in range(responses.STREAM_SLICE * 2 + 3)]
+
+        @self.app.route("/small")
+        def small():
+            return json_response(dict(result="success"))
+
+        @self.app.route("/list")
+        def big_list():
+            return json_list_response("exercises", self.exercises, dict(next_after=12, abc=[1]))
+
+        @self.app.route("/short")
+        def short_list():
+            return json_list_response("exercises", self.exercises[:1])
+
+    def test_matches_jsonify(self):
+        payload = dict(exercises=self.exercises, next_after=None, z=" ")
+        with self.app.test_request_context():
+            self.assertEqual(jsonify(payload).get_data(), json_response(payload).get_data())
+            streamed = json_list_response("exercises", self.exercises, dict(next_after=None, z=" "))
+            self.assertEqual(jsonify(payload).get_data(), b"".join(chunk.encode("utf8")
+                                                                   for chunk in streamed.response))
+
+    def test_decimals_have_to_be_converted(self):
+        # What MySQL gives back for sum().  The model turns these into ints before they get here.
+        with self.assertRaises(TypeError):
+            responses.std_dumps(dict(score=Decimal(5)))
+        if responses.ujson is not None:
+            self.assertEqual('{"score":5.0}', responses.fast_dumps(dict(score=Decimal(5))))
+            self.assertEqual(responses.std_dumps(dict(score=int(Decimal(5)))),
+                             responses.fast_dumps(dict(score=int(Decimal(5)))))
+
+    def test_empty_list(self):
+        with self.app.test_request_context():
+            streamed = json_list_response("history", [])
+            self.assertEqual(jsonify(dict(history=[])).get_data(), "".join(streamed.response).encode("utf8"))
+
+    def test_compresses_large_streamed_response(self):
+        with self.app.test_client() as client:
+            plain = client.get("/list").data
+            res = client.get("/list", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual("gzip", res.headers["Content-Encoding"])
+            self.assertIn("Accept-Encoding", res.headers["Vary"])
+            self.assertEqual(plain, gzip.decompress(res.data))
+            self.assertLess(len(res.data), len(plain))
+
+    def test_leaves_small_responses_alone(self):
+        with self.app.test_client() as client:
+            res = client.get("/small", headers={"Accept-Encoding": "gzip"})
+            self.assertNotIn("Content-Encoding", res.headers)
+            self.assertEqual(b'{"result":"success"}\n', res.data)
+
+            res = client.get("/short", headers={"Accept-Encoding": "gzip"})
+            self.assertNotIn("Content-Encoding", res.headers)
+
+    def test_respects_accept_encoding(self):
+        with self.app.test_client() as client:
+            res = client.get("/list", headers={"Accept-Encoding": "identity"})
+            self.assertNotIn("Content-Encoding", res.headers)
+            res = client.get("/list", headers={"Accept-Encoding": "gzip;q=0"})
+            self.assertNotIn("Content-Encoding", res.headers)
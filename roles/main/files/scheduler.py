@@ -0,0 +1,51 @@
+"""
+scheduler.py
+
+SM-2 style spaced repetition scheduling for exercises.
+
+Each exercise carries an ease factor, the interval in days until it should be seen again, how many times in a row it
+has been recalled, and the time it next comes due.  Every self-rating moves those along.
+"""
+from collections import namedtuple
+from datetime import timedelta
+
+DEFAULT_EASE = 2.5
+MIN_EASE = 1.3
+
+# Self-ratings (BAD, OKAY, GOOD) mapped onto the 0 - 5 recall quality scale SM-2 works with.
+QUALITY_BY_SCORE = {1: 1, 2: 3, 3: 5}
+
+Schedule = namedtuple("Schedule", ["ease_factor", "interval_days", "repetitions", "due_at"])
+
+
+def next_schedule(score, ease_factor, interval_days, repetitions, attempted_at):
+    """
+    Work out when an exercise should come up again after an attempt.
+    :param score: The self-rating given for the attempt (1 = BAD, 2 = OKAY, 3 = GOOD).
+    :param ease_factor: Current ease factor.  None for an exercise that has never been scheduled.
+    :param interval_days: Current interval in days.  None for an exercise that has never been scheduled.
+    :param repetitions: Current count of successful recalls in a row.  None for an exercise that has never been scheduled.
+    :param attempted_at: When the attempt was made.
+    :return: The new Schedule for the exercise.
+    """
+    ease_factor = DEFAULT_EASE if ease_factor is None else ease_factor
+    interval_days = interval_days or 0
+    repetitions = repetitions or 0
+    quality = QUALITY_BY_SCORE[score]
+
+    if quality < 3:
+        repetitions = 0
+        interval_days = 1
+    else:
+        repetitions += 1
+        if repetitions == 1:
+            interval_days = 1
+        elif repetitions == 2:
+            interval_days = 6
+        else:
+            interval_days = int(round(interval_days * ease_factor))
+
+    ease_factor += 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02)
+    ease_factor = max(MIN_EASE, round(ease_factor, 2))
+
+    return Schedule(ease_factor, interval_days, repetitions, attempted_at + timedelta(days=interval_days))
@@ -0,0 +1,46 @@
+import unittest
+from datetime import datetime, timedelta
+import scheduler
+from scheduler import next_schedule, Schedule
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime(2024, 1, 1, 12, 0)
+
+    def test_quality_mapping(self):
+        self.assertEqual({1: 1, 2: 3, 3: 5}, scheduler.QUALITY_BY_SCORE)
+        self.assertEqual(2.6, next_schedule(3, None, None, None, self.now).ease_factor)
+        self.assertEqual(2.36, next_schedule(2, None, None, None, self.now).ease_factor)
+        self.assertEqual(1.96, next_schedule(1, None, None, None, self.now).ease_factor)
+        with self.assertRaises(KeyError):
+            next_schedule(4, None, None, None, self.now)
+
+    def test_interval_progression(self):
+        schedule = next_schedule(3, None, None, None, self.now)
+        self.assertEqual(Schedule(2.6, 1, 1, self.now + timedelta(days=1)), schedule)
+        schedule = next_schedule(3, *schedule[:3], attempted_at=self.now)
+        self.assertEqual(Schedule(2.7, 6, 2, self.now + timedelta(days=6)), schedule)
+        # From the third recall on, the interval grows by the ease factor the exercise had going in.
+        schedule = next_schedule(3, *schedule[:3], attempted_at=self.now)
+        self.assertEqual(Schedule(2.8, 16, 3, self.now + timedelta(days=16)), schedule)
+        schedule = next_schedule(3, *schedule[:3], attempted_at=self.now)
+        self.assertEqual((45, 4), (schedule.interval_days, schedule.repetitions))
+
+    def test_bad_score_resets(self):
+        schedule = next_schedule(1, 2.5, 16, 3, self.now)
+        self.assertEqual(Schedule(1.96, 1, 0, self.now + timedelta(days=1)), schedule)
+        # Starting over goes back through the 1 and 6 day steps.
+        schedule = next_schedule(3, *schedule[:3], attempted_at=self.now)
+        self.assertEqual((1, 1), (schedule.interval_days, schedule.repetitions))
+
+    def test_ease_factor_floor(self):
+        ease_factor = scheduler.DEFAULT_EASE
+        for _ in range(5):
+            ease_factor = next_schedule(1, ease_factor, 1, 0, self.now).ease_factor
+        self.assertEqual(scheduler.MIN_EASE, ease_factor)
+        self.assertEqual(scheduler.MIN_EASE, next_schedule(2, scheduler.MIN_EASE, 6, 2, self.now).ease_factor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+search.py
+
+Tokenizing for the search index.
+
+Every exercise and resource is broken down into terms, and each term is stored in the search_terms table against the
+document it came from, along with a weight.  Question words count for more than answer or caption words.  Queries are
+tokenized the same way and each query term matches any indexed term it is a prefix of, so results show up as the user
+types.  Terms are lower cased and stripped of accents, so "Résumé" is found by "resume".
+"""
+import re
+import unicodedata
+
+EXERCISE = "exercise"
+RESOURCE = "resource"
+
+QUESTION_WEIGHT = 3
+ANSWER_WEIGHT = 1
+CAPTION_WEIGHT = 2
+
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 8
+
+STOP_WORDS = frozenset("""
+a an and are as at be by for from has in is it its of on or that the this to was were what when where which who why
+will with
+""".split())
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def fold(text):
+    """
+    :param text: Some text.
+    :return: The text lower cased, with accents taken off of its letters.
+    """
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def tokenize(text):
+    """
+    Break text up into search terms.
+    :param text: The text to break up.
+    :return: List of folded terms in the order they appear, stop words and single letters left out.
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(fold(text or "")):
+        if len(token) < 2 and not token.isdigit():
+            continue
+        if token in STOP_WORDS:
+            continue
+        terms.append(token[:MAX_TERM_LENGTH])
+    return terms
+
+
+def document_terms(weighted_fields):
+    """
+    Work out the weight of every term in a document.
+    :param weighted_fields: List of (text, weight) tuples, one per field of the document.
+    :return: Dict of term to its total weight across the fields.
+    """
+    weights = {}
+    for text, weight in weighted_fields:
+        for term in tokenize(text):
+            weights[term] = weights.get(term, 0) + weight
+    return weights
+
+
+def exercise_rows(user_id, exercise_id, question, answer):
+    """
+    :return: search_terms rows for an exercise.
+    """
+    weights = document_terms([(question, QUESTION_WEIGHT), (answer, ANSWER_WEIGHT)])
+    return [dict(user_id=user_id, term=term, kind=EXERCISE, doc_id=exercise_id, weight=weight)
+            for term, weight in sorted(weights.items())]
+
+
+def resource_rows(user_id, resource_id, caption):
+    """
+    :return: search_terms rows for a resource.
+    """
+    weights = document_terms([(caption, CAPTION_WEIGHT)])
+    return [dict(user_id=user_id, term=term, kind=RESOURCE, doc_id=resource_id, weight=weight)
+            for term, weight in sorted(weights.items())]
+
+
+def query_terms(query):
+    """
+    Tokenize a search query.
+    :param query: What the user typed.
+    :return: Distinct query terms in the order they were typed, at most MAX_QUERY_TERMS of them.
+    """
+    terms = []
+    for term in tokenize(query):
+        if term not in terms:
+            terms.append(term)
+    return terms[:MAX_QUERY_TERMS]
+
+
+def prefix_range(term):
+    """
+    Turn a prefix into a range on the term column, so that prefix matches are an index range scan everywhere rather
+    than depending on how the database treats LIKE.
+    :param term: The prefix.
+    :return: A tuple of the lowest matching term and the first term past the end of the matches.
+    """
+    return term, term[:-1] + chr(ord(term[-1]) + 1)
@@ -0,0 +1,29 @@
+import unittest
+import search
+
+
+class SearchTestCase(unittest.TestCase):
+    def test_tokenize(self):
+        self.assertEqual(["python", "gil", "3"], search.tokenize("What is Python's GIL? A 3 x"))
+        self.assertEqual([], search.tokenize(None))
+
+    def test_exercise_rows_weigh_question_over_answer(self):
+        rows = search.exercise_rows("u@x", 7, "Python decorators", "Functions wrapping python functions")
+        weights = dict((row["term"], row["weight"]) for row in rows)
+        self.assertEqual(dict(python=4, decorators=3, functions=2, wrapping=1), weights)
+        self.assertTrue(all(row["kind"] == search.EXERCISE and row["doc_id"] == 7 for row in rows))
+
+    def test_accented_and_plain_forms_are_one_term(self):
+        rows = search.exercise_rows("u@x", 7, "Café résumé", "cafe RESUME naïve")
+        self.assertEqual([("cafe", 4), ("naive", 1), ("resume", 4)], [(row["term"], row["weight"]) for row in rows])
+        self.assertEqual(["resume"], search.query_terms("Résumé"))
+
+    def test_query_terms(self):
+        self.assertEqual(["py", "dec"], search.query_terms("py dec py"))
+        self.assertEqual(search.MAX_QUERY_TERMS, len(search.query_terms(" ".join("t{}".format(n) for n in range(20)))))
+
+    def test_prefix_range(self):
+        low, high = search.prefix_range("pyth")
+        self.assertTrue(low <= "python" < high)
+        self.assertFalse(low <= "pyt" < high)
+        self.assertFalse(low <= "pytz" < high)
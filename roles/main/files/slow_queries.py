@@ -0,0 +1,245 @@
+"""
+slow_queries.py
+
+A slow query log for Flashmark, kept in memory per worker.
+
+Statements that take longer than a threshold are recorded under a fingerprint: the statement with its literals and
+placeholders replaced by ? and its IN lists and VALUES rows folded down, so the same query with different arguments
+lands in one place.  Each fingerprint keeps its count, total and max time along with its most recent durations for
+working out a p99.  Optionally, the first slow run of each select is EXPLAINed and the plan kept alongside it.
+
+The slowest fingerprints are served at /admin/slowqueries and written to the log every so often.
+"""
+import logging
+import math
+import re
+import threading
+import time
+from collections import deque
+from sqlalchemy import event
+
+DEFAULT_THRESHOLD_MS = 100
+DEFAULT_TOP = 20
+DEFAULT_LOG_INTERVAL = 300
+MAX_FINGERPRINTS = 500
+SAMPLES_PER_FINGERPRINT = 500
+MAX_EXAMPLE_LENGTH = 2000
+ORDERS = ("total", "p99", "max", "count")
+
+COMMENTS = re.compile(r"/\*.*?\*/|--[^\n]*", re.DOTALL)
+STRINGS = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+PLACEHOLDERS = re.compile(r"%\(\w+\)s|%s|(?<!:):\w+|\?")
+NUMBERS = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", re.IGNORECASE)
+LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+ROWS = re.compile(r"\(\?\+\)(?:\s*,\s*\(\?\+\))+")
+SPACES = re.compile(r"\s+")
+
+
+def fingerprint(statement):
+    """
+    Reduce a statement to the shape it has whatever arguments it is run with.
+    :param statement: SQL text.
+    :return: The fingerprint, lowercased with its whitespace collapsed.
+    """
+    text = COMMENTS.sub(" ", statement)
+    text = STRINGS.sub("?", text)
+    text = PLACEHOLDERS.sub("?", text)
+    text = NUMBERS.sub("?", text)
+    text = LISTS.sub("(?+)", text)
+    text = ROWS.sub("(?+)...", text)
+    return SPACES.sub(" ", text).strip().lower()
+
+
+def percentile(values, percent):
+    """
+    :param values: List of numbers.
+    :param percent: Which percentile, from 0 to 100.
+    :return: The nearest-rank percentile, or 0 when there are no values.
+    """
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = max(int(math.ceil(percent / 100 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+class FingerprintStats(object):
+    def __init__(self, example):
+        self.example = example[:MAX_EXAMPLE_LENGTH]
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=SAMPLES_PER_FINGERPRINT)
+        self.last_seen = None
+        self.plan = None
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+        self.last_seen = time.time()
+
+    def describe(self, fingerprint_text):
+        return dict(fingerprint=fingerprint_text, example=self.example, count=self.count,
+                    total_ms=round(self.total * 1000, 2), mean_ms=round(self.total / self.count * 1000, 2),
+                    max_ms=round(self.max * 1000, 2), p99_ms=round(percentile(list(self.samples), 99) * 1000, 2),
+                    last_seen=self.last_seen, plan=self.plan)
+
+
+class SlowQueryLog(object):
+    """
+    Hooked onto an engine by init_engine.  Statements under the threshold cost two clock reads and nothing else.
+    """
+
+    def __init__(self, threshold_ms=DEFAULT_THRESHOLD_MS, top=DEFAULT_TOP, explain=False,
+                 log_interval=DEFAULT_LOG_INTERVAL, backend=None, logger=None, max_fingerprints=MAX_FINGERPRINTS):
+        """
+        :param threshold_ms: Statements that take at least this long are recorded.
+        :param top: How many fingerprints to report by default.
+        :param explain: Whether to EXPLAIN the first slow run of each select.  Needs a backend.
+        :param log_interval: Seconds between writing the report to the log.  0 turns that off.
+        :param backend: The storage backend, for running EXPLAIN.
+        :param logger: Where to write the report.
+        :param max_fingerprints: How many fingerprints to keep.  Past that, the one with the least total time goes.
+        """
+        self.threshold = threshold_ms / 1000
+        self.top = top
+        self.explain = explain and backend is not None
+        self.log_interval = log_interval
+        self.backend = backend
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_fingerprints = max_fingerprints
+
+        self.lock = threading.Lock()
+        self.fingerprints = {}
+        self.recorded = 0
+        self.last_dump = time.monotonic()
+        self.recorded_at_last_dump = 0
+
+    def init_engine(self, engine):
+        """
+        Start timing every statement sent through the engine.
+        :param engine: The SQLAlchemy engine.
+        :return: self.
+        """
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+        return self
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_started", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("slow_query_started")
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        if elapsed >= self.threshold:
+            dbapi_conn = None if executemany else conn.connection
+            self.record(statement, parameters, elapsed, dbapi_conn)
+        self.maybe_dump()
+
+    def record(self, statement, parameters, seconds, dbapi_conn=None):
+        """
+        Add a slow statement to the log.
+        :param statement: The statement as the driver was handed it.
+        :param parameters: The parameters it was handed with it.
+        :param seconds: How long it took.
+        :param dbapi_conn: DB-API connection to EXPLAIN it on, or None not to.
+        :return: Nothing.
+        """
+        key = fingerprint(statement)
+        with self.lock:
+            stats = self.fingerprints.get(key)
+            needs_plan = stats is None or stats.plan is None
+
+        plan = None
+        if self.explain and needs_plan and dbapi_conn is not None and key.startswith("select"):
+            try:
+                plan = self.backend.explain_statement(dbapi_conn, statement, parameters)
+            except Exception as e:
+                plan = "explain failed: {}".format(e)
+
+        with self.lock:
+            stats = self.fingerprints.get(key)
+            if stats is None:
+                if len(self.fingerprints) >= self.max_fingerprints:
+                    least = min(self.fingerprints, key=lambda other: self.fingerprints[other].total)
+                    del self.fingerprints[least]
+                stats = self.fingerprints[key] = FingerprintStats(statement)
+            stats.add(seconds)
+            if plan is not None and stats.plan is None:
+                stats.plan = plan
+            self.recorded += 1
+
+    def report(self, order="total", limit=None):
+        """
+        :param order: What to rank fingerprints by: total, p99, max or count.
+        :param limit: How many fingerprints to return.  Defaults to the configured top.
+        :return: List of dicts describing the slowest fingerprints, slowest first.
+        """
+        if order not in ORDERS:
+            raise Exception("order must be one of: {}".format(", ".join(ORDERS)))
+        with self.lock:
+            described = [stats.describe(key) for key, stats in self.fingerprints.items()]
+        field = order if order == "count" else order + "_ms"
+        described.sort(key=lambda entry: entry[field], reverse=True)
+        return described[:self.top if limit is None else limit]
+
+    def stats(self):
+        """
+        :return: Dict of the settings and how much has been recorded, to go with a report.
+        """
+        with self.lock:
+            return dict(threshold_ms=self.threshold * 1000, explain=self.explain, recorded=self.recorded,
+                        fingerprints=len(self.fingerprints))
+
+    def maybe_dump(self):
+        """
+        Write the report to the log if the interval has passed and anything new was recorded since last time.
+        Called after every statement, so there is no timer thread to run.
+        :return: Nothing.
+        """
+        if not self.log_interval or time.monotonic() - self.last_dump < self.log_interval:
+            return
+        with self.lock:
+            if time.monotonic() - self.last_dump < self.log_interval:
+                return
+            self.last_dump = time.monotonic()
+            if self.recorded == self.recorded_at_last_dump:
+                return
+            self.recorded_at_last_dump = self.recorded
+        self.dump()
+
+    def dump(self):
+        """
+        Write the slowest fingerprints by total time to the log.
+        :return: Nothing.
+        """
+        entries = self.report()
+        self.logger.warning("slow queries: {} recorded over {} fingerprints, top {} by total time".format(
+            self.recorded, len(self.fingerprints), len(entries)))
+        for entry in entries:
+            self.logger.warning("  total {total_ms}ms count {count} p99 {p99_ms}ms max {max_ms}ms: {fingerprint}"
+                                .format(**entry))
+            if entry["plan"]:
+                self.logger.warning("    plan: {}".format(entry["plan"]))
+
+
+def init_app(app, fm, config_section):
+    """
+    Turn on the slow query log for the model's engine.  Building the engine doesn't connect to the database.
+    :param app: The app.  Reports are written to its logger.
+    :param fm: The FlashmarkModel.
+    :param config_section: The learningmachine section of config.ini.
+    :return: The SlowQueryLog.
+    """
+    log = SlowQueryLog(threshold_ms=config_section.getfloat("slow_query_ms", DEFAULT_THRESHOLD_MS),
+                       top=config_section.getint("slow_query_top", DEFAULT_TOP),
+                       explain=config_section.getboolean("slow_query_explain", False),
+                       log_interval=config_section.getint("slow_query_log_interval", DEFAULT_LOG_INTERVAL),
+                       backend=fm.backend, logger=app.logger)
+    with fm.app.app_context():
+        engine = fm.db.engine
+    return log.init_engine(engine)
@@ -0,0 +1,57 @@
+import unittest
+from unittest.mock import MagicMock
+from sqlalchemy import create_engine
+import backends
+import slow_queries
+
+
+class SlowQueriesTestCase(unittest.TestCase):
+    def test_fingerprint(self):
+        self.assertEqual("select * from exercises where user_id = ? and id in (?+)",
+                         slow_queries.fingerprint("SELECT *\n  FROM exercises WHERE user_id = 'a@x' AND id IN (1, 2, 3)"))
+        self.assertEqual(slow_queries.fingerprint("select * from t where id in (%(id_1)s, %(id_2)s) limit 5"),
+                         slow_queries.fingerprint("select * from t where id in (?) limit 10 -- paging"))
+        self.assertEqual("insert into tags (user_id, name) values (?+)...",
+                         slow_queries.fingerprint("insert into tags (user_id, name) values (%s, %s), (%s, %s)"))
+        self.assertEqual("select t1.id from t1 where x = ?", slow_queries.fingerprint("select t1.id from t1 where x = -2.5"))
+
+    def test_records_only_slow_statements(self):
+        log = slow_queries.SlowQueryLog(threshold_ms=10, log_interval=0)
+        log.record("select * from t where id = 1", (), 0.02)
+        log.record("select * from t where id = 2", (), 0.5)
+        log.record("delete from t where id = 2", (), 0.1)
+
+        report = log.report()
+        self.assertEqual(["select * from t where id = ?", "delete from t where id = ?"],
+                         [entry["fingerprint"] for entry in report])
+        self.assertEqual(2, report[0]["count"])
+        self.assertEqual(520, report[0]["total_ms"])
+        self.assertEqual(500, report[0]["p99_ms"])
+        self.assertEqual(1, len(log.report(order="count", limit=1)))
+        with self.assertRaises(Exception):
+            log.report(order="name")
+
+        eng = create_engine("sqlite://")
+        log.init_engine(eng)
+        eng.execute("select 1")
+        self.assertEqual(3, log.stats()["recorded"])
+
+    def test_keeps_most_expensive_fingerprints(self):
+        log = slow_queries.SlowQueryLog(threshold_ms=0, log_interval=0, max_fingerprints=2)
+        log.record("select * from a", (), 3)
+        log.record("select * from b", (), 1)
+        log.record("select * from c", (), 2)
+        self.assertEqual(["select * from a", "select * from c"], [entry["fingerprint"] for entry in log.report()])
+
+    def test_explains_and_dumps(self):
+        eng = create_engine("sqlite://")
+        eng.execute("create table t (id integer primary key, name text)")
+        logger = MagicMock()
+        log = slow_queries.SlowQueryLog(threshold_ms=0, explain=True, log_interval=1,
+                                        backend=backends.SQLiteBackend(), logger=logger).init_engine(eng)
+        eng.execute("select name from t where id = ?", 3)
+        self.assertIn("USING INTEGER PRIMARY KEY", log.report()[0]["plan"])
+
+        log.last_dump -= 2
+        eng.execute("select name from t where id = ?", 4)
+        logger.warning.assert_any_call("    plan: " + log.report()[0]["plan"])
@@ -0,0 +1,120 @@
+#!/var/app/learningmachine/venv/bin/python3.4
+"""
+startup_benchmark.py
+
+Measures how long a fresh worker takes to get going: importing view.py, then its first request, then its first
+request that goes to the database.  Every sample runs in a new interpreter so nothing is already imported or connected.
+
+    startup_benchmark.py [samples] [output_file]
+
+Results are printed and written out as JSON (startup_benchmark.json by default) so runs can be compared over time.
+"""
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+DEFAULT_SAMPLES = 5
+DEFAULT_OUTPUT = "startup_benchmark.json"
+BENCHMARK_USER = "startup-benchmark@localhost"
+SLOWEST_IMPORTS = 15
+
+# Run in the child interpreter.  Prints one JSON object of timings in milliseconds.
+CHILD = """
+import json, sys, time
+sys.path.insert(0, {dir_path!r})
+timings = {{}}
+started = time.perf_counter()
+import view
+timings["import_ms"] = (time.perf_counter() - started) * 1000
+
+client = view.app.test_client()
+started = time.perf_counter()
+client.get("/")
+timings["first_request_ms"] = (time.perf_counter() - started) * 1000
+
+with client.session_transaction() as sess:
+    sess["email"] = {user!r}
+started = time.perf_counter()
+res = client.get("/exercises")
+timings["first_db_request_ms"] = (time.perf_counter() - started) * 1000
+timings["first_db_request_status"] = res.status_code
+print(json.dumps(timings))
+"""
+
+
+def run_sample(dir_path):
+    """
+    Start one fresh interpreter and time its startup.
+    :param dir_path: Directory holding view.py and config.ini.
+    :return: Dict of timings.
+    """
+    code = CHILD.format(dir_path=dir_path, user=BENCHMARK_USER)
+    out = subprocess.check_output([sys.executable, "-c", code], cwd=dir_path, stderr=subprocess.DEVNULL)
+    return json.loads(out.decode("utf8").strip().splitlines()[-1])
+
+
+def slowest_imports(dir_path, count=SLOWEST_IMPORTS):
+    """
+    Import view.py with -X importtime and total up the time spent in each top level package.
+    Pythons older than 3.7 don't have -X importtime, in which case nothing comes back.
+    :param dir_path: Directory holding view.py and config.ini.
+    :param count: How many packages to report.
+    :return: List of dicts of package name and import time in milliseconds, slowest first.
+    """
+    code = "import sys; sys.path.insert(0, {!r}); import view".format(dir_path)
+    proc = subprocess.Popen([sys.executable, "-X", "importtime", "-c", code], cwd=dir_path,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    packages = {}
+    for line in err.decode("utf8", "replace").splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        own, _, name = line[len("import time:"):].split("|")
+        if not own.strip().isdigit():
+            continue
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(own) / 1000
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:count]
+    return [dict(package=package, ms=round(ms, 2)) for package, ms in slowest]
+
+
+def summarize(values):
+    """
+    :param values: List of numbers.
+    :return: Dict of the min, median and max.
+    """
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    median = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+    return dict(min=round(ordered[0], 2), median=round(median, 2), max=round(ordered[-1], 2))
+
+
+def benchmark(dir_path, samples=DEFAULT_SAMPLES):
+    """
+    Time several fresh starts of the app.
+    :param dir_path: Directory holding view.py and config.ini.
+    :param samples: How many fresh interpreters to time.
+    :return: Dict of the raw samples, their summary and the slowest imports.
+    """
+    runs = [run_sample(dir_path) for _ in range(samples)]
+    summary = dict((key, summarize([run[key] for run in runs]))
+                   for key in ("import_ms", "first_request_ms", "first_db_request_ms"))
+    return dict(recorded_at=datetime.now().isoformat(), python=sys.version.split()[0], samples=runs,
+                summary=summary, slowest_imports=slowest_imports(dir_path))
+
+
+if __name__ == '__main__':
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SAMPLES
+    output = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_OUTPUT
+
+    results = benchmark(os.path.dirname(os.path.abspath(__file__)), samples)
+    for key, stats in sorted(results["summary"].items()):
+        print("{:<22} min {min:>8.1f}  median {median:>8.1f}  max {max:>8.1f}".format(key, **stats))
+    for module in results["slowest_imports"]:
+        print("  {:<30} {:>8.1f}ms".format(module["package"], module["ms"]))
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("wrote {}".format(output))
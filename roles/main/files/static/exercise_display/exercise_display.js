@@ -85,16 +85,21 @@ var ExerciseController = function(exerciseService){
     };
 
 
-    // Handle a user rating themselves.  Here, just send the rating to the server
-    // and make the question answer box go away.
+    // Handle a user rating themselves.  Here, just queue the rating up to go to the server
+    // with the next batch and make the question answer box go away.  The exercise list is
+    // refreshed once per batch rather than once per rating.
+    var pendingScoreFlush = null;
     ec.scoreClick = function(score){
-        var scoreSubmissionPromise = exerciseService.submitScore(ec.activeObject.exercise, score);
+        var scoreSubmissionPromise = exerciseService.bufferScore(ec.activeObject.exercise, score);
         $("#questionAnswerModal").modal("hide");
 
-        scoreSubmissionPromise.then(function(res){
-            var promise = exerciseService.getExercises();
-            promise.then(getExercisesSuccess);
-        });
+        if(scoreSubmissionPromise !== pendingScoreFlush){
+            pendingScoreFlush = scoreSubmissionPromise;
+            scoreSubmissionPromise.then(function(res){
+                var promise = exerciseService.getExercises();
+                promise.then(getExercisesSuccess);
+            });
+        }
 
     };
 
@@ -194,7 +199,7 @@ var ExerciseController = function(exerciseService){
             alert("failure in deleting the resource");
         };
 
-        var promise = exerciseService.deleteLearningResource(resource_id);
+        var promise = exerciseService.deleteLearningResource(resource_id, ec.activeObject.exercise.id);
         promise.then(success, failure);
     };
 
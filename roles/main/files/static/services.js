@@ -1,6 +1,15 @@
 // Exercise Service - Manages info concerning listing of exercises,
 // adding new ones, manage tag info, scoring attempts, and getting reports on those attempts.
-var ExerciseService = function($http){
+var ExerciseService = function($http, $q, $interval, $window){
+
+    var es = this;
+
+    // Scores waiting to go out with the next /addscores batch.
+    var SCORE_BATCH_SIZE = 20;
+    var SCORE_FLUSH_INTERVAL_MS = 10000;
+    var scoreBuffer = [];
+    var scoresInFlight = [];
+    var scoreFlush = $q.defer();
 
     // Get exercise information for the current user.
     this.getExercises = function(){
@@ -8,6 +17,40 @@ var ExerciseService = function($http){
         return promise;
     };
 
+    // Get a single page of exercises for the current user.  'after' is the next_after cursor
+    // handed back with the previous page (null for the first page), and 'fields' an optional list
+    // of the exercise fields wanted, such as ["id", "question", "tags"].
+    this.getExercisesPage = function(after, limit, fields){
+        var params = {"limit": limit};
+        if(after){
+            params.after = after;
+        }
+        if(fields){
+            params.fields = fields.join(",");
+        }
+        var promise = $http.get("/exercises", {"params": params});
+        return promise;
+    };
+
+    // Page through every exercise for the current user.  Resolves with the same
+    // shape of response as getExercises once the last page has come back.
+    this.getExercisesPaged = function(pageSize, fields){
+        var exercises = [];
+
+        var fetchPage = function(after){
+            return es.getExercisesPage(after, pageSize, fields).then(function(res){
+                exercises = exercises.concat(res.data.exercises);
+                if(res.data.next_after){
+                    return fetchPage(res.data.next_after);
+                }
+                return {"data": {"exercises": exercises}};
+            });
+        };
+
+        var promise = fetchPage(null);
+        return promise;
+    };
+
     // Get exercise information for current user that is connected to a specific tag.
     this.getExercisesByTag = function(tagName){
         var url = "/exercises?tag=" + tagName;
@@ -15,6 +58,35 @@ var ExerciseService = function($http){
         return promise;
     };
 
+    // Get exercises connected to several tags.  mode is "all" for exercises carrying every
+    // one of the tags or "any" (the default) for exercises carrying at least one of them.
+    this.getExercisesByTags = function(tagNames, mode){
+        var params = {tags: tagNames.join(","), mode: mode || "any"};
+        var promise = $http.get("/exercises", {"params": params});
+        return promise;
+    };
+
+    // Get each of the user's tags along with how many exercises carry it.
+    this.getTags = function(){
+        var promise = $http.get("/tags");
+        return promise;
+    };
+
+    // Search the current user's exercises and resources.  Words match anything starting with them,
+    // so this can be called as the user types.  Pass the next_offset from the previous response to
+    // get the following page.
+    this.search = function(query, offset, limit){
+        var params = {"q": query};
+        if(offset){
+            params.offset = offset;
+        }
+        if(limit){
+            params.limit = limit;
+        }
+        var promise = $http.get("/search", {"params": params});
+        return promise;
+    };
+
     // Send a new set of tags to the back end to be connected to a given exercise.
     this.changeTags = function(exerciseID, tagChanges){
 
@@ -51,6 +123,87 @@ var ExerciseService = function($http){
         return promise;
     };
 
+    // Hold onto a score so it can go out with others in a single /addscores request.  The buffer is sent
+    // once it fills up, on a timer, and when the page is closed.  Returns a promise that is fulfilled when the
+    // batch holding this score has been stored.
+    this.bufferScore = function(exercise, score){
+        scoreBuffer.push({
+            "exercise_id": exercise.id,
+            "score": score,
+            "client_timestamp": Date.now()
+        });
+
+        var promise = scoreFlush.promise;
+        if(scoreBuffer.length >= SCORE_BATCH_SIZE){
+            es.flushScores();
+        }
+        return promise;
+    };
+
+    // Send every buffered score to the server in one request.  Scores only leave the buffer once the server
+    // has answered for them, as applied or skipped.  If the request doesn't get through, or the server fails on
+    // it, they go back in to be sent with the next flush.  A batch the server turns down as malformed is dropped,
+    // since sending it again wouldn't help.  One batch is sent at a time.
+    this.flushScores = function(){
+        if(scoresInFlight.length > 0){
+            return scoreFlush.promise;
+        }
+
+        var flush = scoreFlush;
+        scoreFlush = $q.defer();
+
+        if(scoreBuffer.length === 0){
+            flush.resolve(null);
+            return flush.promise;
+        }
+
+        scoresInFlight = scoreBuffer;
+        scoreBuffer = [];
+        var req = {
+            url: "/addscores",
+            method: "post",
+            headers: {
+                "Content-type": "application/json"
+            },
+            data: {
+                "scores": scoresInFlight
+            }
+        };
+
+        var success = function(res){
+            var acknowledged = res.data.applied + res.data.skipped.length;
+            scoreBuffer = scoresInFlight.slice(acknowledged).concat(scoreBuffer);
+            scoresInFlight = [];
+            flush.resolve(res);
+        };
+
+        var failure = function(res){
+            if(res.status <= 0 || res.status >= 500){
+                scoreBuffer = scoresInFlight.concat(scoreBuffer);
+            }
+            scoresInFlight = [];
+            flush.reject(res);
+        };
+
+        $http(req).then(success, failure);
+        return flush.promise;
+    };
+
+    $interval(es.flushScores, SCORE_FLUSH_INTERVAL_MS);
+
+    // Last chance to get buffered scores out when the user leaves the page.  A batch still waiting on its
+    // answer goes too, since the page won't be around to put it back if that request is cut off.
+    $window.addEventListener("pagehide", function(){
+        var scores = scoresInFlight.concat(scoreBuffer);
+        if(scores.length > 0 && $window.navigator.sendBeacon){
+            var body = new Blob([JSON.stringify({"scores": scores})], {"type": "application/json"});
+            if($window.navigator.sendBeacon("/addscores", body)){
+                scoresInFlight = [];
+                scoreBuffer = [];
+            }
+        }
+    });
+
     // Take the new question and answer pertaining to some topic and store that in the system.
     this.addExercise = function(newQuestion, newAnswer){
         var MAX_CHARS = 140;
@@ -94,10 +247,28 @@ var ExerciseService = function($http){
         return promise;
     }
 
+    // Delete a batch of the user's exercises in one call.
+    this.deleteExercises = function(exercise_ids){
+        var req = {
+            url: "/deleteexercises",
+            method: "POST",
+            headers: {
+                "Content-Type": "application/json"
+            },
+            data: {
+                "exercise_ids": exercise_ids
+            }
+        };
+
+        var promise = $http(req);
+        return promise;
+    }
+
     // Pull the data concerning a user's exercise history into a local json structure
-    // that can be displayed in report form.  Also show it.
+    // that can be displayed in report form.  Also show it.  Attempts come back already
+    // totalled per day so that heavy users don't have to download every attempt.
     this.getAttemptsReport = function(){
-        var promise = $http.get("/exercisehistory");
+        var promise = $http.get("/exercisehistory", {params: {summary: "daily"}});
         return promise;
     };
 
@@ -144,8 +315,29 @@ var ExerciseService = function($http){
     };
 
 
-    // Delete a learning resource from the back end.
-    this.deleteLearningResource = function(resource_id){
+    // Link an existing learning resource to a batch of exercises, and unlink it
+    // from others, in one call.
+    this.linkResource = function(resource_id, link_ids, unlink_ids){
+        var req = {
+            url: "/linkresource",
+            method: "post",
+            headers: {
+                "Content-type": "application/json"
+            },
+            data: {
+                "resource_id": resource_id,
+                "link": link_ids || [],
+                "unlink": unlink_ids || []
+            }
+        };
+
+        var promise = $http(req);
+        return promise;
+    };
+
+    // Take a learning resource off of an exercise.  The back end deletes the
+    // resource once no exercise uses it any more.
+    this.deleteLearningResource = function(resource_id, exercise_id){
         var req = {
             url: "/deleteresource",
             method: "post",
@@ -153,7 +345,8 @@ var ExerciseService = function($http){
                 "Content-type": "application/json"
             },
             data: {
-                "resource_id": resource_id
+                "resource_id": resource_id,
+                "exercise_id": exercise_id
             }
         };
 
@@ -3,35 +3,79 @@ tabledefs.py
 
 Collection of SQLAlchemy table definitions for database tables supporting Flashmark.
 """
-from sqlalchemy import Column, Text, Integer, ForeignKey, TIMESTAMP, VARCHAR, Table, MetaData, ForeignKeyConstraint
+from sqlalchemy import Column, Text, Integer, ForeignKey, TIMESTAMP, VARCHAR, Table, MetaData, ForeignKeyConstraint, Float, DateTime, Date, Index, SmallInteger
+from sqlalchemy.dialects import mysql
 meta = MetaData()
 
 
 user_table = Table("users", meta,
                    Column("email", VARCHAR(255), primary_key=True),
-                   Column("display_name", Text))
+                   Column("display_name", Text),
+                   Column("data_version", Integer, default=0))
 
 
 exercise_table = Table("exercises", meta,
                        Column("id", Integer, primary_key=True, autoincrement=True),
-                       Column("question", Text),
-                       Column("answer", Text),
+                       Column("question", VARCHAR(140)),
+                       Column("answer", VARCHAR(140)),
                        Column("difficulty", Integer, default=0),
-                       Column("user_id", ForeignKey("users.email")))
+                       Column("user_id", ForeignKey("users.email")),
+                       Column("ease_factor", Float, default=2.5),
+                       Column("interval_days", Integer, default=0),
+                       Column("repetitions", Integer, default=0),
+                       Column("due_at", DateTime),
+                       Column("deleted_at", DateTime),
+                       Index("ix_exercises_user_due", "user_id", "due_at"),
+                       Index("ix_exercises_user_difficulty", "user_id", "difficulty"),
+                       Index("ix_exercises_deleted", "deleted_at"))
 
 
 attempt_table = Table("attempts", meta,
                       Column("id", Integer, primary_key=True, autoincrement=True),
                       Column("score", Integer),
                       Column("when_attempted", TIMESTAMP),
-                      Column("exercise_id", ForeignKey("exercises.id")))
+                      Column("exercise_id", ForeignKey("exercises.id")),
+                      Index("ix_attempts_exercise", "exercise_id"),
+                      Index("ix_attempts_when", "when_attempted"))
+
+
+attempt_archive_table = Table("attempts_archive", meta,
+                              Column("id", Integer, primary_key=True, autoincrement=False),
+                              Column("score", SmallInteger),
+                              Column("when_attempted", DateTime),
+                              Column("exercise_id", ForeignKey("exercises.id")),
+                              Index("ix_attempts_archive_exercise", "exercise_id"))
+
+
+search_term_table = Table("search_terms", meta,
+                          Column("user_id", VARCHAR(255), primary_key=True),
+                          # Compared byte for byte, as search.py compares them.  MySQL's default utf8 collation would
+                          # make two terms that differ only in accents or case the same key.
+                          Column("term", VARCHAR(64).with_variant(
+                              mysql.VARCHAR(64, charset="utf8", collation="utf8_bin"), "mysql"), primary_key=True),
+                          Column("kind", VARCHAR(16), primary_key=True),
+                          Column("doc_id", Integer, primary_key=True),
+                          Column("weight", Integer),
+                          Index("ix_search_terms_doc", "kind", "doc_id"))
+
+
+attempt_rollup_table = Table("attempt_rollups", meta,
+                             Column("exercise_id", ForeignKey("exercises.id"), primary_key=True),
+                             Column("day", Date, primary_key=True),
+                             Column("user_id", ForeignKey("users.email")),
+                             Column("bad", Integer, default=0),
+                             Column("okay", Integer, default=0),
+                             Column("good", Integer, default=0),
+                             Index("ix_attempt_rollups_user_day", "user_id", "day"))
 
 
 resource_table = Table("resources", meta,
                        Column("id", Integer, primary_key=True, autoincrement=True),
                        Column("caption", Text),
                        Column("url", Text),
-                       Column("user_id", ForeignKey("users.email")))
+                       Column("user_id", ForeignKey("users.email")),
+                       Column("url_key", VARCHAR(40)),
+                       Index("ux_resources_user_url", "user_id", "url_key", unique=True))
 
 
 resource_by_exercise_table = Table("resources_by_exercise", meta,
@@ -47,4 +91,11 @@ exercise_by_exercise_tags_table = Table("exercises_by_exercise_tags", meta,
                                         Column("exercise_id", ForeignKey("exercises.id"), primary_key=True),
                                         Column("tag_name", VARCHAR(255), primary_key=True),
                                         Column("user_id", VARCHAR(255), primary_key=True),
-                                        ForeignKeyConstraint(["tag_name", "user_id"], ["exercise_tags.name", "exercise_tags.user_id"]))
+                                        ForeignKeyConstraint(["tag_name", "user_id"], ["exercise_tags.name", "exercise_tags.user_id"]),
+                                        Index("ix_ebet_user_tag", "user_id", "tag_name", "exercise_id"))
+
+
+schema_version_table = Table("schema_version", meta,
+                             Column("version", Integer, primary_key=True, autoincrement=False),
+                             Column("description", Text),
+                             Column("applied_at", DateTime))
@@ -0,0 +1,202 @@
+"""
+title_fetcher.py
+
+Looks up the title of a web page for /suggestname without letting a slow or huge page hold a worker hostage.
+
+Pages are streamed through a pooled requests session with connect and read timeouts, an overall deadline and a cap on
+how many bytes get read.  The HTML is parsed as it arrives and reading stops as soon as </title> turns up.  Titles are
+kept in an LRU cache, and so are failures, for a shorter time, so that a dead site isn't hammered on every keystroke.
+
+requests is only imported, and the session only built, the first time a title is fetched, so that workers start
+quickly.
+"""
+import codecs
+import time
+from html.parser import HTMLParser
+from threading import Lock
+from cache import LocalCache
+
+CHUNK_SIZE = 8192
+USER_AGENT = "Flashmark title fetcher"
+
+
+class TitleParser(HTMLParser):
+    """
+    Incremental HTML parser that collects the text of the first title tag and then stops caring.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.in_title = False
+        self.done = False
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title" and not self.done:
+            self.in_title = True
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self.in_title:
+            self.in_title = False
+            self.done = True
+        elif tag in ("head", "body") and not self.in_title:
+            # No title in the head means there isn't going to be one.
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.parts.append(data)
+
+    @property
+    def title(self):
+        return " ".join("".join(self.parts).split())
+
+
+def read_available(res):
+    """
+    Yield a streamed response body as it arrives.  iter_content blocks until a whole chunk has come in, which would let
+    a server that trickles bytes out hold the read open, so read1 is used where urllib3 offers it.
+    :param res: A response fetched with stream=True.
+    :return: A generator of byte strings.
+    """
+    if not hasattr(res.raw, "read1"):
+        yield from res.iter_content(CHUNK_SIZE)
+        return
+
+    while True:
+        chunk = res.raw.read1(CHUNK_SIZE, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
+
+class TitleFetcher(object):
+    """
+    Fetches and caches page titles.  One of these is shared by every request a worker handles.
+    """
+
+    def __init__(self, connect_timeout=3.05, read_timeout=5, total_timeout=8, max_bytes=262144, cache_ttl=3600,
+                 negative_ttl=300, max_entries=1024, pool_size=10, session=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.max_bytes = max_bytes
+        self.negative_ttl = negative_ttl
+        self.titles = LocalCache(max_entries, cache_ttl)
+        self.pool_size = pool_size
+        self.__session = session
+
+        self.__lock = Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__failures = 0
+
+    @property
+    def session(self):
+        """
+        :return: The pooled requests session, built on first use.
+        """
+        if self.__session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            with self.__lock:
+                if self.__session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    session.headers["User-Agent"] = USER_AGENT
+                    self.__session = session
+        return self.__session
+
+    def get_title(self, url):
+        """
+        Look up the title of a page, from the cache if possible.
+        :param url: The URL of the page.
+        :return: The page's title with whitespace collapsed, or an empty string if it doesn't have one.
+        """
+        cached = self.titles.get(url)
+        if cached is not None:
+            self.__count(hit=True)
+            title, error = cached
+            if error:
+                raise Exception(error)
+            return title
+
+        from requests.exceptions import MissingSchema, InvalidSchema, InvalidURL, RequestException
+        self.__count(hit=False)
+        try:
+            title = self.__fetch(url)
+        except (MissingSchema, InvalidSchema, InvalidURL):
+            raise Exception("You need an http or https at the start of the URL you're passing.")
+        except RequestException:
+            error = "I can't get at the page you're trying to point me towards."
+            self.titles.set(url, (None, error), self.negative_ttl)
+            with self.__lock:
+                self.__failures += 1
+            raise Exception(error)
+
+        self.titles.set(url, (title, None))
+        return title
+
+    def __fetch(self, url):
+        """
+        Stream the start of a page until its title has been seen or one of the limits is hit.
+        :param url: The URL of the page.
+        :return: The title, or an empty string if none was found within the limits.
+        """
+        from requests.exceptions import Timeout
+        deadline = time.monotonic() + self.total_timeout
+        res = self.session.get(url, stream=True, timeout=(self.connect_timeout, self.read_timeout))
+        try:
+            content_type = res.headers.get("Content-Type", "text/html")
+            if "html" not in content_type.lower():
+                return ""
+
+            try:
+                decoder = codecs.getincrementaldecoder(res.encoding or "utf-8")(errors="replace")
+            except LookupError:
+                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            parser = TitleParser()
+            bytes_read = 0
+            for chunk in read_available(res):
+                chunk = chunk[:self.max_bytes - bytes_read]
+                bytes_read += len(chunk)
+                parser.feed(decoder.decode(chunk))
+                if parser.done or bytes_read >= self.max_bytes:
+                    break
+                if time.monotonic() > deadline:
+                    raise Timeout("Gave up reading {} after {}s".format(url, self.total_timeout))
+
+            return parser.title if parser.done else ""
+        finally:
+            res.close()
+
+    def __count(self, hit):
+        with self.__lock:
+            if hit:
+                self.__hits += 1
+            else:
+                self.__misses += 1
+
+    def stats(self):
+        """
+        :return: Dict of cache hit and miss counts, failed fetches and how many titles are cached.
+        """
+        with self.__lock:
+            return dict(hits=self.__hits, misses=self.__misses, failures=self.__failures, entries=len(self.titles))
+
+
+def make_fetcher(config_section):
+    """
+    Build the title fetcher described by the config file.
+    :param config_section: The learningmachine section of config.ini.
+    :return: A TitleFetcher.
+    """
+    return TitleFetcher(connect_timeout=config_section.getfloat("title_connect_timeout", 3.05),
+                        read_timeout=config_section.getfloat("title_read_timeout", 5),
+                        total_timeout=config_section.getfloat("title_total_timeout", 8),
+                        max_bytes=config_section.getint("title_max_bytes", 262144),
+                        cache_ttl=config_section.getint("title_cache_ttl", 3600),
+                        negative_ttl=config_section.getint("title_negative_ttl", 300),
+                        max_entries=config_section.getint("title_cache_max_entries", 1024))
@@ -0,0 +1,111 @@
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from title_fetcher import TitleFetcher
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Serves canned pages.  Every request path is counted so tests can tell whether the cache was used.
+    """
+    hits = {}
+
+    def do_GET(self):
+        StubHandler.hits[self.path] = StubHandler.hits.get(self.path, 0) + 1
+
+        if self.path == "/title":
+            self.send_page(b"<html><head><title>\n  A  Page </title></head><body>hello</body></html>")
+        elif self.path == "/notitle":
+            self.send_page(b"<html><head></head><body>no title here</body></html>")
+        elif self.path == "/late":
+            self.send_page(b"<html><head><!--" + b"x" * 4096 + b"--><title>Too far</title></head></html>")
+        elif self.path == "/endless":
+            # Sends the title straight away and then keeps the connection busy.  The fetcher must not wait it out.
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.end_headers()
+            self.wfile.write(b"<html><head><title>Quick</title>")
+            self.wfile.flush()
+            for _ in range(20):
+                time.sleep(0.1)
+                self.wfile.write(b"<p>filler</p>")
+                self.wfile.flush()
+        elif self.path == "/slow":
+            time.sleep(1)
+            self.send_page(b"<title>Slow</title>")
+        elif self.path == "/image":
+            self.send_page(b"\x89PNG....", content_type="image/png")
+        else:
+            self.send_error(404)
+
+    def send_page(self, body, content_type="text/html; charset=utf-8"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The fetcher hangs up as soon as it has what it needs, so broken pipes are expected.
+        pass
+
+
+class TitleFetcherTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StubServer(("127.0.0.1", 0), StubHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base_url = "http://127.0.0.1:{}".format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubHandler.hits = {}
+        self.fetcher = TitleFetcher(read_timeout=0.3, total_timeout=1, max_bytes=1024)
+
+    def test_gets_title_and_caches_it(self):
+        url = self.base_url + "/title"
+        self.assertEqual("A Page", self.fetcher.get_title(url))
+        self.assertEqual("A Page", self.fetcher.get_title(url))
+        self.assertEqual(1, StubHandler.hits["/title"])
+        self.assertEqual(dict(hits=1, misses=1, failures=0, entries=1), self.fetcher.stats())
+
+    def test_page_without_title(self):
+        self.assertEqual("", self.fetcher.get_title(self.base_url + "/notitle"))
+
+    def test_stops_reading_at_byte_cap(self):
+        self.assertEqual("", self.fetcher.get_title(self.base_url + "/late"))
+
+    def test_stops_reading_after_title(self):
+        started = time.monotonic()
+        self.assertEqual("Quick", self.fetcher.get_title(self.base_url + "/endless"))
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_skips_non_html(self):
+        self.assertEqual("", self.fetcher.get_title(self.base_url + "/image"))
+
+    def test_read_timeout_is_cached_as_failure(self):
+        url = self.base_url + "/slow"
+        with self.assertRaises(Exception):
+            self.fetcher.get_title(url)
+        with self.assertRaises(Exception):
+            self.fetcher.get_title(url)
+        self.assertEqual(1, StubHandler.hits["/slow"])
+        self.assertEqual(1, self.fetcher.stats()["failures"])
+
+    def test_url_without_scheme(self):
+        with self.assertRaises(Exception) as context:
+            self.fetcher.get_title("127.0.0.1/title")
+        self.assertIn("http or https", context.exception.args[0])
@@ -1,12 +1,18 @@
-from flask import Flask, session, request, redirect, jsonify, abort, make_response
+from flask import Flask, session, request, redirect, abort, make_response
 from configparser import ConfigParser
 import logging
-from login import LoginHandler
+from login import LoginHandler, make_client as make_oauth_client
 import model
+import exercise_import
+import metrics
+import responses
+import slow_queries
+from responses import json_response, json_list_response
 from functools import wraps
 import sys
+import io
 import re
-from pdb import set_trace
+import hashlib
 
 parser = ConfigParser()
 dir_path = __file__.rsplit("/", maxsplit=1)[0]
@@ -24,6 +30,11 @@ app.logger.setLevel(log_level)
 app.logger.addHandler(logging.StreamHandler(stream=sys.stdout))
 app.secret_key = parser["learningmachine"]["session_key"]
 fm = model.FlashmarkModel(app)
+# Ahead of responses so the compressed size is the one counted.
+app_metrics = metrics.init_app(app, fm, parser["learningmachine"])
+responses.init_app(app, parser["learningmachine"])
+slow_query_log = slow_queries.init_app(app, fm, parser["learningmachine"])
+oauth_client = make_oauth_client(parser["learningmachine"], "{}/{}".format(dir_path, "client_secret.json"))
 
 def validate_json(*expected_args):
     """
@@ -45,6 +56,37 @@ def validate_json(*expected_args):
     return decorator
 
 
+def conditional_get(func):
+    """
+    Decorator for read routes whose output only changes when the user's data does.  Responses carry an ETag made from
+    the user and their data version, and a request whose If-None-Match still matches gets a 304 without the route
+    running at all.
+    :param func: The view function to wrap.
+    :return: The wrapped view function.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        user_id = session.get("email")
+        if not user_id:
+            return func(*args, **kwargs)
+
+        # Read the version before the data, so a write that lands in between only makes the ETag too old, never too new.
+        user_hash = hashlib.sha1(user_id.encode("utf8")).hexdigest()[:16]
+        etag = "{}-{}".format(user_hash, fm.get_data_version(user_id))
+
+        if request.if_none_match.contains_weak(etag):
+            res = make_response("", 304)
+        else:
+            res = make_response(func(*args, **kwargs))
+            if res.status_code != 200:
+                return res
+
+        res.set_etag(etag, weak=True)
+        res.headers["Cache-Control"] = "private, no-cache"
+        return res
+    return wrapper
+
+
 @app.route("/")
 def welcome_page():
     """
@@ -64,31 +106,31 @@ def login():
     If we are COMING BACK from a Google login, use the code to get the email and display name set up for the user.
     :return: An appropriate redirect (depending on what step of the login process this is.
     """
-    domain = parser["learningmachine"]["domain"]
-    secrets_file = "{}/{}".format(dir_path, "client_secret.json")
-    scope = "https://www.googleapis.com/auth/userinfo.email"
-    redirect_uri = "http://{}/login".format(domain)
-    login_handler = LoginHandler(secrets_file, scope, redirect_uri)
+    login_handler = LoginHandler(oauth_client)
 
     if "code" in request.args:
         login_handler.setup_user_info(request.args["code"])
         session["email"] = login_handler.email
         session["display_name"] = login_handler.display_name
 
-        if not fm.user_exists(login_handler.email):
-            msg = "Adding user: {} with ID of {} to the database."\
-                .format(login_handler.email, login_handler.display_name)
-            fm.add_user(login_handler.email, login_handler.display_name)
+        with login_handler.timed("user"):
+            if fm.upsert_user(login_handler.email, login_handler.display_name):
+                app.logger.info("Added user: {} with display name {} to the database."
+                                .format(login_handler.email, login_handler.display_name))
 
         msg = "Sending user: {} to main page".format(login_handler.email)
         app.logger.info(msg)
+        app.logger.info("Login timings for {}: {}".format(login_handler.email, login_handler.describe_timings()))
         return redirect("/static/main.html")
 
     else:
+        with login_handler.timed("authorize_url"):
+            auth_url = login_handler.auth_url
         msg = "No login code yet.  Letting Google handle the login process at: {}"\
-                .format(login_handler.auth_url)
+                .format(auth_url)
         app.logger.info(msg)
-        return redirect(login_handler.auth_url)
+        app.logger.debug("Login timings: {}".format(login_handler.describe_timings()))
+        return redirect(auth_url)
 
 
 @app.route("/userinfo")
@@ -102,23 +144,99 @@ def get_user_info():
         display_name = session.get("display_name")
         data = dict(email=email, displayName=display_name)
         app.logger.debug("Success in getting log information on user: {} at email: {}".format(display_name, email))
-        return jsonify(data)
+        return json_response(data)
     else:
-        return jsonify(dict(email="error", display_name="Could not get info for this user"))
+        return json_response(dict(email="error", display_name="Could not get info for this user"))
 
 
 @app.route("/exercises")
+@conditional_get
 def get_exercises():
     """
     Get a list of exercises for a specific user.
+    Passing any of 'limit', 'after' or 'fields' switches to paged results, where 'after' is the next_after
+    cursor from the previous page and 'fields' is a comma separated list of the exercise fields wanted.
+    Filter by tag with either 'tag' for a single tag, or 'tags' as a comma separated list along with 'mode'
+    set to 'any' (the default) or 'all'.
     :return: A JSON list of the exercises for this user.
     """
     email = session.get("email")
-    tag_arg = request.args.get("tag")
-    exercises = fm.get_all_exercises(email, tag_arg)
-    msg = "Found {} exercises for {}".format(len(exercises), email)
+    tags = request.args["tags"].split(",") if request.args.get("tags") else request.args.get("tag")
+    mode = request.args.get("mode", "any")
+
+    if not any(arg in request.args for arg in ("limit", "after", "fields")):
+        try:
+            exercises = fm.get_all_exercises(email, tags, mode)
+        except Exception as e:
+            reason, *_ = e.args
+            return make_response("/exercises failed. reason: {}".format(reason), 400)
+        msg = "Found {} exercises for {}".format(len(exercises), email)
+        app.logger.info(msg)
+        return json_list_response("exercises", exercises)
+
+    try:
+        limit = int(request.args.get("limit", model.DEFAULT_PAGE_SIZE))
+        after = int(request.args["after"]) if request.args.get("after") else None
+        fields = request.args["fields"].split(",") if request.args.get("fields") else None
+        exercises, next_after = fm.get_exercise_page(email, tags, after, limit, fields, mode)
+    except Exception as e:
+        reason, *_ = e.args
+        return make_response("/exercises paging failed. reason: {}".format(reason), 400)
+
+    msg = "Found {} exercises for {} after exercise {}".format(len(exercises), email, after)
     app.logger.info(msg)
-    return jsonify(dict(exercises=exercises))
+    return json_response(dict(exercises=exercises, next_after=next_after))
+
+
+@app.route("/tags")
+@conditional_get
+def get_tags():
+    """
+    Get every tag the user has along with how many exercises carry it.
+    :return: A JSON list of tag names and counts.
+    """
+    user_id = session.get("email")
+    tags = fm.get_tag_counts(user_id)
+    return json_response(dict(tags=tags))
+
+
+@app.route("/search")
+@conditional_get
+def search_documents():
+    """
+    Search the user's exercises and resources.
+    Takes a 'q' argument holding the search text, plus optional 'offset' and 'limit' arguments for paging.
+    :return: A JSON list of matching exercises and resources, best matches first, and the offset of the next page.
+    """
+    user_id = session.get("email")
+    try:
+        offset = int(request.args.get("offset", 0))
+        limit = int(request.args.get("limit", model.DEFAULT_SEARCH_LIMIT))
+        results, next_offset = fm.search(user_id, request.args.get("q", ""), offset, limit)
+    except Exception as e:
+        reason, *_ = e.args
+        return make_response("/search failed. reason: {}".format(reason), 400)
+    return json_response(dict(results=results, next_offset=next_offset))
+
+
+@app.route("/nextexercises")
+def get_next_exercises():
+    """
+    Get the exercises the user should study next, soonest due first.
+    Takes an optional 'n' argument for how many exercises to send back.
+    :return: A JSON list of the next exercises due for this user.
+    """
+    email = session.get("email")
+    try:
+        count = int(request.args.get("n", model.DEFAULT_NEXT_EXERCISES))
+        exercises = fm.get_next_exercises(email, count)
+    except Exception as e:
+        reason, *_ = e.args
+        return make_response("/nextexercises failed. reason: {}".format(reason), 400)
+
+    msg = "Found {} due exercises for {}".format(len(exercises), email)
+    app.logger.info(msg)
+    return json_response(dict(exercises=exercises))
 
 
 @app.route("/addscore", methods=["POST"])
@@ -138,7 +256,35 @@ def add_score():
     msg = "Attempt added.  Exercise ID: {} Score: {}"\
             .format(exercise_id, score)
     app.logger.info(msg)
-    return jsonify(dict(result="success"))
+    return json_response(dict(result="success"))
+
+
+@app.route("/addscores", methods=["POST"])
+@validate_json("scores")
+def add_scores():
+    """
+    Add the scores for a batch of attempts, in the order given.
+    Expects a json structure with a scores list, each entry having an exercise_id, a score and optionally a
+    client_timestamp in milliseconds since the epoch for when the attempt was made.
+    :return: A json structure with the number of attempts recorded and any scores that were skipped.
+    """
+    from datetime import datetime
+    user_id = session.get("email")
+    try:
+        scores = []
+        for entry in request.get_json().get("scores"):
+            client_timestamp = entry.get("client_timestamp")
+            when_attempted = datetime.fromtimestamp(client_timestamp / 1000.0) if client_timestamp else None
+            scores.append((entry["exercise_id"], entry["score"], when_attempted))
+
+        applied, skipped = fm.add_attempts(user_id, scores)
+    except Exception as e:
+        reason, *_ = e.args
+        return make_response("/addscores failed. reason: {}".format(reason), 400)
+
+    msg = "{} attempts added for user: {}.  {} skipped.".format(applied, user_id, len(skipped))
+    app.logger.info(msg)
+    return json_response(dict(result="success", applied=applied, skipped=skipped))
 
 
 @app.route("/addexercise", methods=["POST"])
@@ -157,13 +303,42 @@ def add_exercise():
         fm.add_exercise(new_question, new_answer, user_id)
         msg = "Exercise added for user: {}".format(user_id)
         app.logger.info(msg)
-        return jsonify({"message": "add exercise call completed"})
+        return json_response({"message": "add exercise call completed"})
     except Exception as e:
         msg = "The question or the answer to be added has exceeded the max char limit"
         app.logger.error(msg)
         abort(400)
 
 
+@app.route("/importexercises", methods=["POST"])
+def import_exercises():
+    """
+    Bulk add exercises for the user for this session.
+    Expects the request body to be CSV (question,answer,tags) or JSON lines ({"question", "answer", "tags"}).  The
+    format comes from the 'format' query argument, or failing that, the Content-type header.
+    :return: A json structure with the number of exercises imported and the errors for any rows that were rejected.
+    """
+    user_id = session.get("email")
+    import_format = request.args.get("format")
+    if import_format is None:
+        import_format = "jsonl" if "json" in (request.content_type or "") else "csv"
+
+    reader = exercise_import.READERS.get(import_format)
+    if reader is None:
+        return make_response("Unknown import format: {}".format(import_format), 400)
+
+    lines = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+    try:
+        imported, errors = fm.import_exercises(user_id, reader(lines))
+    except Exception as e:
+        reason, *_ = e.args
+        return make_response("/importexercises failed. reason: {}".format(reason), 400)
+
+    msg = "Imported {} exercises for user: {}.  {} rows rejected.".format(imported, user_id, len(errors))
+    app.logger.info(msg)
+    return json_response(dict(imported=imported, errors=errors))
+
+
 @app.route("/deleteexercise", methods=["POST"])
 def delete_exercise():
     json_ob = request.get_json()
@@ -174,32 +349,99 @@ def delete_exercise():
     return ""
 
 
+@app.route("/deleteexercises", methods=["POST"])
+@validate_json("exercise_ids")
+def delete_exercises():
+    """
+    Delete a batch of the user's exercises.  They disappear from every read straight away and everything hanging off of
+    them is cleared out later by the purge job.
+    Expects a json structure with an exercise_ids list.
+    :return: A json structure with the number of exercises deleted.  Ids that weren't the user's are skipped.
+    """
+    user_id = session.get("email")
+    try:
+        exercise_ids = [int(exercise_id) for exercise_id in request.get_json().get("exercise_ids")]
+        deleted = fm.delete_exercises(user_id, exercise_ids)
+    except Exception as e:
+        reason, *_ = e.args
+        return make_response("/deleteexercises failed. reason: {}".format(reason), 400)
+
+    app.logger.info("Deleted {} exercises for user: {}".format(deleted, user_id))
+    return json_response(dict(deleted=deleted))
+
+
+@app.route("/linkresource", methods=["POST"])
+@validate_json("resource_id")
+def link_resource():
+    """
+    Link one of the user's resources to a batch of exercises and unlink it from others, in one call.
+    Expects a json structure with a resource_id and link and/or unlink lists of exercise ids.
+    :return: A json structure with the number of links made and removed.
+    """
+    user_id = session.get("email")
+    try:
+        json_ob = request.get_json()
+        link_ids = [int(exercise_id) for exercise_id in json_ob.get("link") or []]
+        unlink_ids = [int(exercise_id) for exercise_id in json_ob.get("unlink") or []]
+        linked, unlinked = fm.link_resource(user_id, int(json_ob.get("resource_id")), link_ids, unlink_ids)
+    except Exception as e:
+        reason, *_ = e.args
+        return make_response("/linkresource failed. reason: {}".format(reason), 400)
+
+    return json_response(dict(linked=linked, unlinked=unlinked))
+
+
 @app.route("/deleteresource", methods=["POST"])
 def delete_resource():
+    """
+    Take a resource off of an exercise.  The resource itself goes once no exercise uses it.
+    Expects a json structure with a resource_id and the exercise_id to take it off of.  Without an exercise_id the
+    resource is deleted from every exercise.
+    """
     json_ob = request.get_json()
     resource_id = json_ob.get("resource_id")
+    exercise_id = json_ob.get("exercise_id")
     user_id = session.get("email")
-    msg = fm.delete_resource(user_id, resource_id)
+    try:
+        exercise_id = int(exercise_id) if exercise_id is not None else None
+        msg = fm.delete_resource(user_id, resource_id, exercise_id)
+    except Exception as e:
+        reason, *_ = e.args
+        return make_response("/deleteresource failed. reason: {}".format(reason), 400)
     return ""
 
 
 @app.route("/exercisehistory")
+@conditional_get
 def get_exercise_history():
     """
     Get the user's history of attempts made on exercises
+    Pass summary=daily to get per day counts of each score instead of every attempt, and since=YYYY-MM-DD to leave
+    out anything older.  Without since the archived attempts are included too.
     :return: A JSON structure of the history of the user's attempts.
     """
+    from datetime import datetime
     user_id = session.get("email")
 
-    history = fm.full_attempt_history(user_id)
+    try:
+        since = request.args.get("since")
+        try:
+            since = datetime.strptime(since, "%Y-%m-%d") if since else None
+        except ValueError:
+            raise Exception("since has to be a date in YYYY-MM-DD form")
+        history = fm.full_attempt_history(user_id, request.args.get("summary"), since)
+    except Exception as e:
+        err_reason, *_ = e.args
+        return make_response("/exercisehistory failed. reason: {}".format(err_reason), 400)
 
     msg = "Attempt history found for user: {}.  {} records."\
             .format(user_id, len(history))
     app.logger.info(msg)
-    return jsonify({"history": history})
+    return json_list_response("history", history)
 
 
 @app.route("/resources")
+@conditional_get
 def get_resources():
     """
     Get the resources for this user.
@@ -208,10 +450,11 @@ def get_resources():
     user_id = session["email"]
     resources = fm.get_resources(user_id)
     returned_val = dict(resources=resources)
-    return jsonify(returned_val)
+    return json_response(returned_val)
 
 
 @app.route("/resourcesforexercise/<exercise_id>")
+@conditional_get
 def get_resources_for_exercise(exercise_id):
     """
     Get the resources associated with the specfied exercise
@@ -221,7 +464,7 @@ def get_resources_for_exercise(exercise_id):
     user_id = session.get("email")
     resources = fm.get_resources_for_exercise(exercise_id, user_id)
     returned_val = dict(resources=resources)
-    return jsonify(returned_val)
+    return json_response(returned_val)
 
 
 @app.route("/addresource", methods=["POST"])
@@ -232,11 +475,14 @@ def add_resource():
     new_url = json_data["new_url"]
     exercise_id = json_data["exercise_id"]
     try:
-        fm.add_resource(new_caption, new_url, user_id, exercise_id)
-        return "FINISHED"
+        resource_id, reused = fm.add_resource(new_caption, new_url, user_id, exercise_id)
     except Exception as e:
         abort(400)
 
+    if reused:
+        app.logger.info("Linked existing resource {} for user: {}".format(resource_id, user_id))
+    return json_response(dict(resource_id=resource_id, reused=reused))
+
 
 @app.route("/changetags", methods=["POST"])
 def change_tags():
@@ -260,11 +506,50 @@ def change_tags():
         return response_400
 
 
+@app.route("/stats")
+def get_stats():
+    """
+    Internal counters for this worker, such as cache hits and misses and connection pool usage.
+    Note: nginx does not pass this route through, so it can only be reached from the box itself.
+    :return: A json structure of the counters.
+    """
+    return json_response(dict(cache=fm.cache.stats(), pool=fm.pool_stats(), titles=fm.title_fetcher.stats()))
+
+
+@app.route("/metrics")
+def get_metrics():
+    """
+    Per route latency, status codes, response sizes and SQL counts for this worker, along with connection pool gauges,
+    in the Prometheus text format.
+    Note: nginx only passes this route through for requests from the box itself.
+    :return: The metrics as plain text.
+    """
+    return app_metrics.response()
+
+
+@app.route("/admin/slowqueries")
+def get_slow_queries():
+    """
+    The slowest statements this worker has run, grouped by fingerprint.
+    Query parameters: order is one of total (the default), p99, max or count.  limit is how many to return.
+    Note: nginx only passes this route through for requests from the box itself.
+    :return: A json structure of the slow query log settings and its top fingerprints.
+    """
+    try:
+        order = request.args.get("order", "total")
+        limit = request.args.get("limit")
+        limit = int(limit) if limit else None
+        return json_response(dict(slow_query_log.stats(), queries=slow_query_log.report(order, limit)))
+    except Exception as e:
+        reason, *_ = e.args
+        return make_response("/admin/slowqueries failed. reason: {}".format(reason), 400)
+
+
 @app.route("/suggestname", methods=["GET"])
 def suggest_name():
     try:
         learning_resource_url = request.args.get("url")
-        suggested_name = model.suggest_name(learning_resource_url)
+        suggested_name = model.suggest_name(learning_resource_url, fm.title_fetcher)
         return suggested_name
     except Exception as e:
         err_reason, *_ = e.args
@@ -1,13 +1,30 @@
 import unittest
-from unittest.mock import MagicMock
-from view import app
+from unittest.mock import MagicMock, patch
+from view import app, fm
 import json
+from datetime import datetime
 
 
 class ViewTestCase(unittest.TestCase):
     def setUp(self):
         self.test_user_id = "dummyuser@somewhere.com"
         self.test_display_name = "Dummy User"
+        self.app = app
+        self.fm = fm
+        # Routes behind conditional_get look up the user's data version before anything else.
+        self.mock_model("get_data_version", MagicMock(return_value=0))
+
+    def mock_model(self, name, mock):
+        """
+        Stand a mock in for one of the model's methods until the test is over.
+        :param name: Name of the FlashmarkModel method.
+        :param mock: The mock to use.
+        :return: The mock.
+        """
+        patcher = patch.object(self.fm, name, mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return mock
 
     def get_json(self, res):
         raw_data = res.data
@@ -21,13 +38,13 @@ class ViewTestCase(unittest.TestCase):
         return raw_data
 
     def test_welcome_page(self):
-        with app.test_client() as client:
+        with self.app.test_client() as client:
             res = client.get("/")
             self.assertTrue("302" in res.status)
 
     def test_user_info(self):
 
-        with app.test_client() as client:
+        with self.app.test_client() as client:
             with client.session_transaction() as sess:
                 sess["email"] = self.test_user_id
                 sess["display_name"] = self.test_display_name
@@ -45,9 +62,9 @@ class ViewTestCase(unittest.TestCase):
         test_score = 1
         test_dict = dict(exercise_id=test_exercise_id, score=test_score)
         mock = MagicMock(return_value=dict(result="success"))
-        self.fm.add_attempt = mock
+        self.mock_model("add_attempt", mock)
 
-        with app.test_client() as client:
+        with self.app.test_client() as client:
             with client.session_transaction() as sess:
                 sess["email"] = self.test_user_id
                 sess["display_name"] = self.test_display_name
@@ -57,15 +74,74 @@ class ViewTestCase(unittest.TestCase):
             client.post("/addscore", headers=headers, data=data)
             mock.assert_called_with(test_exercise_id, test_score, self.test_user_id)
 
+    def test_add_scores(self):
+        test_dict = dict(scores=[dict(exercise_id=1, score=1), dict(exercise_id=2, score=3)])
+        mock = MagicMock(return_value=(2, []))
+        self.mock_model("add_attempts", mock)
+
+        with self.app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["email"] = self.test_user_id
+
+            headers = {"Content-type": "application/json"}
+            data = self.make_json_text(test_dict)
+            result = client.post("/addscores", headers=headers, data=data)
+            json_data = self.get_json(result)
+            mock.assert_called_with(self.test_user_id, [(1, 1, None), (2, 3, None)])
+            self.assertEqual(2, json_data["applied"])
+
+    def test_daily_history(self):
+        history = [dict(id=1, question="q", answer="a", daily=[dict(day="2024-01-02", bad=1, okay=0, good=2)])]
+        mock = MagicMock(return_value=history)
+        self.mock_model("full_attempt_history", mock)
+
+        with self.app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["email"] = self.test_user_id
+
+            result = client.get("/exercisehistory?summary=daily")
+            json_data = self.get_json(result)
+            mock.assert_called_with(self.test_user_id, "daily", None)
+            self.assertEqual(history, json_data["history"])
+
+            client.get("/exercisehistory?since=2024-01-02")
+            mock.assert_called_with(self.test_user_id, None, datetime(2024, 1, 2))
+            result = client.get("/exercisehistory?since=yesterday")
+            self.assertEqual(400, result.status_code)
+
+    def test_conditional_get(self):
+        self.mock_model("get_data_version", MagicMock(return_value=7))
+        mock = MagicMock(return_value=[])
+        self.mock_model("get_resources", mock)
+
+        with self.app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["email"] = self.test_user_id
+
+            result = client.get("/resources")
+            etag = result.headers["ETag"]
+            self.assertEqual(200, result.status_code)
+            self.assertEqual("private, no-cache", result.headers["Cache-Control"])
+
+            mock.reset_mock()
+            result = client.get("/resources", headers={"If-None-Match": etag})
+            self.assertEqual(304, result.status_code)
+            mock.assert_not_called()
+
+            self.fm.get_data_version.return_value = 8
+            result = client.get("/resources", headers={"If-None-Match": etag})
+            self.assertEqual(200, result.status_code)
+            self.assertNotEqual(etag, result.headers["ETag"])
+
     def test_add_exercise(self):
         test_question = "Test Question?"
         test_answer = "Test Answer"
         test_dict = dict(new_question=test_question, new_answer=test_answer)
 
         mock = MagicMock()
-        self.fm.add_exercise = mock
+        self.mock_model("add_exercise", mock)
 
-        with app.test_client() as client:
+        with self.app.test_client() as client:
             with client.session_transaction() as sess:
                 sess["email"] = self.test_user_id
 
@@ -74,13 +150,40 @@ class ViewTestCase(unittest.TestCase):
             client.post("/addexercise", headers=headers, data=data)
             mock.assert_called_with(test_question, test_answer, self.test_user_id)
 
+    def test_import_exercises(self):
+        consumed = []
+
+        def import_exercises(user_id, rows):
+            consumed.extend(rows)
+            return len(consumed), []
+        mock = self.mock_model("import_exercises", MagicMock(side_effect=import_exercises))
+
+        with self.app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["email"] = self.test_user_id
+
+            headers = {"Content-type": "text/csv"}
+            data = "question,answer,tags\nTest Question?,Test Answer,python\nAnother?,Yes,\n".encode("utf8")
+            result = client.post("/importexercises", headers=headers, data=data)
+            json_data = self.get_json(result)
+            self.assertEqual(2, json_data["imported"])
+
+            user_id, rows = mock.call_args[0]
+            self.assertEqual(self.test_user_id, user_id)
+            self.assertEqual([(2, "Test Question?", "Test Answer", ["python"]), (3, "Another?", "Yes", [])],
+                             [(row.line, row.question, row.answer, row.tags) for row in consumed])
+
+            mock.side_effect = Exception("database went away")
+            result = client.post("/importexercises", headers=headers, data=data)
+            self.assertEqual(400, result.status_code)
+
     def test_delete_exercise(self):
         test_exercise_id = 1
         test_dict = dict(exercise_id=test_exercise_id)
         mock = MagicMock()
-        self.fm.delete_exercise = mock
+        self.mock_model("delete_exercise", mock)
 
-        with app.test_client() as client:
+        with self.app.test_client() as client:
             with client.session_transaction() as sess:
                 sess["email"] = self.test_user_id
 
@@ -89,23 +192,136 @@ class ViewTestCase(unittest.TestCase):
             client.post("/deleteexercise", headers=headers, data=data)
             mock.assert_called_with(self.test_user_id, test_exercise_id)
 
+    def test_delete_exercises(self):
+        mock = MagicMock(return_value=2)
+        self.mock_model("delete_exercises", mock)
+
+        with self.app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["email"] = self.test_user_id
+
+            headers = {"Content-type": "application/json"}
+            result = client.post("/deleteexercises", headers=headers, data=self.make_json_text(dict(exercise_ids=[1, "2"])))
+            mock.assert_called_with(self.test_user_id, [1, 2])
+            self.assertEqual(2, self.get_json(result)["deleted"])
+
+            result = client.post("/deleteexercises", headers=headers, data=self.make_json_text(dict(exercise_ids=["x"])))
+            self.assertEqual(400, result.status_code)
+
+    def test_link_resource(self):
+        mock = MagicMock(return_value=(2, 1))
+        self.mock_model("link_resource", mock)
+
+        with self.app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["email"] = self.test_user_id
+
+            headers = {"Content-type": "application/json"}
+            data = self.make_json_text(dict(resource_id="7", link=[1, "2"], unlink=[3]))
+            result = client.post("/linkresource", headers=headers, data=data)
+            mock.assert_called_with(self.test_user_id, 7, [1, 2], [3])
+            self.assertEqual(dict(linked=2, unlinked=1), self.get_json(result))
+
+            mock.side_effect = Exception("No resource 7 for this user")
+            result = client.post("/linkresource", headers=headers, data=self.make_json_text(dict(resource_id=7)))
+            self.assertEqual(400, result.status_code)
+
     def test_get_exercises(self):
         empty_list = []
         mock = MagicMock(return_value=empty_list)
-        self.fm.get_all_exercises = mock
+        self.mock_model("get_all_exercises", mock)
         tag_arg = None
 
-        with app.test_client() as client:
+        with self.app.test_client() as client:
             with client.session_transaction() as sess:
                 sess["email"] = self.test_user_id
 
             result = client.get("/exercises")
             json_data = self.get_json(result)
-            mock.assert_called_with(self.test_user_id, tag_arg)
+            mock.assert_called_with(self.test_user_id, tag_arg, "any")
+            self.assertTrue("exercises" in json_data)
+
+            client.get("/exercises?tags=python,async&mode=all")
+            mock.assert_called_with(self.test_user_id, ["python", "async"], "all")
+
+    def test_get_exercise_page(self):
+        mock = MagicMock(return_value=([], None))
+        self.mock_model("get_exercise_page", mock)
+
+        with self.app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["email"] = self.test_user_id
+
+            result = client.get("/exercises?limit=50&after=10&fields=id,question")
+            json_data = self.get_json(result)
+            mock.assert_called_with(self.test_user_id, None, 10, 50, ["id", "question"], "any")
+            self.assertTrue("exercises" in json_data)
+            self.assertTrue("next_after" in json_data)
+
+    def test_get_tags(self):
+        tags = [dict(name="async", count=2), dict(name="python", count=5)]
+        mock = MagicMock(return_value=tags)
+        self.mock_model("get_tag_counts", mock)
+
+        with self.app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["email"] = self.test_user_id
+
+            result = client.get("/tags")
+            json_data = self.get_json(result)
+            mock.assert_called_with(self.test_user_id)
+            self.assertEqual(tags, json_data["tags"])
+
+    def test_search(self):
+        results = [dict(type="exercise", id=3, question="What is python?", answer="A language", tags=[])]
+        mock = MagicMock(return_value=(results, 20))
+        self.mock_model("search", mock)
+
+        with self.app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["email"] = self.test_user_id
+
+            result = client.get("/search?q=pyth&limit=20")
+            json_data = self.get_json(result)
+            mock.assert_called_with(self.test_user_id, "pyth", 0, 20)
+            self.assertEqual(results, json_data["results"])
+            self.assertEqual(20, json_data["next_offset"])
+
+            result = client.get("/search?q=pyth&limit=lots")
+            self.assertEqual(400, result.status_code)
+
+    def test_metrics(self):
+        with self.app.test_client() as client:
+            client.get("/")
+            res = client.get("/metrics")
+            self.assertEqual(200, res.status_code)
+            self.assertTrue(res.content_type.startswith("text/plain; version=0.0.4"))
+            self.assertIn('flashmark_responses_total{method="GET",route="/",status="302"}', res.data.decode())
+
+    def test_slow_queries(self):
+        with self.app.test_client() as client:
+            res = client.get("/admin/slowqueries?order=p99&limit=5")
+            self.assertIn("queries", self.get_json(res))
+            res = client.get("/admin/slowqueries?order=name")
+            self.assertEqual(400, res.status_code)
+
+    def test_next_exercises(self):
+        mock = MagicMock(return_value=[])
+        self.mock_model("get_next_exercises", mock)
+
+        with self.app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["email"] = self.test_user_id
+
+            result = client.get("/nextexercises?n=5")
+            json_data = self.get_json(result)
+            mock.assert_called_with(self.test_user_id, 5)
             self.assertTrue("exercises" in json_data)
 
     def test_exercise_history(self):
-        with app.test_client() as client:
+        self.mock_model("full_attempt_history", MagicMock(return_value=[]))
+
+        with self.app.test_client() as client:
             with client.session_transaction() as sess:
                 sess["email"] = self.test_user_id
 
@@ -118,10 +334,10 @@ class ViewTestCase(unittest.TestCase):
     def test_get_resources(self):
         empty_list = []
         mock = MagicMock(return_value=empty_list)
-        self.fm.get_resources_for_exercise = mock
+        self.mock_model("get_resources_for_exercise", mock)
         test_exercise_id = "40"
 
-        with app.test_client() as client:
+        with self.app.test_client() as client:
             with client.session_transaction() as sess:
                 sess["email"] = self.test_user_id
 
@@ -135,41 +351,46 @@ class ViewTestCase(unittest.TestCase):
         test_caption = "Simeon Franklin Guide to Python Decorators (12 steps)"
         test_url = "http://simeonfranklin.com/blog/2012/jul/1/python-decorators-in-12-steps/"
         test_exercise_id = 11
-        mock = MagicMock()
-        self.fm.add_resource = mock
+        mock = MagicMock(return_value=(5, True))
+        self.mock_model("add_resource", mock)
 
-        with app.test_client() as client:
+        with self.app.test_client() as client:
             with client.session_transaction() as sess:
                 sess["email"] = self.test_user_id
 
             headers = {"Content-type": "application/json"}
             args_dict = dict(new_caption=test_caption, new_url=test_url, exercise_id=test_exercise_id)
             data = self.make_json_text(args_dict)
-            client.post("/addresource", headers=headers, data=data)
+            result = client.post("/addresource", headers=headers, data=data)
             mock.assert_called_with(test_caption, test_url, self.test_user_id, test_exercise_id)
+            self.assertEqual(dict(resource_id=5, reused=True), self.get_json(result))
 
     def test_delete_resource(self):
         test_resource_id = 1
         mock = MagicMock(return_value="FINISHED")
-        self.fm.delete_resource = mock
+        self.mock_model("delete_resource", mock)
 
-        with app.test_client() as client:
+        with self.app.test_client() as client:
             with client.session_transaction() as sess:
                 sess["email"] = self.test_user_id
 
-            test_dict = dict(resource_id=test_resource_id)
+            test_dict = dict(resource_id=test_resource_id, exercise_id="11")
             data = self.make_json_text(test_dict)
             headers = {"Content-type": "application/json"}
             res = client.post("/deleteresource", headers=headers, data=data)
-            mock.assert_called_with(self.test_user_id, test_resource_id)
+            mock.assert_called_with(self.test_user_id, test_resource_id, 11)
+
+            data = self.make_json_text(dict(resource_id=test_resource_id))
+            client.post("/deleteresource", headers=headers, data=data)
+            mock.assert_called_with(self.test_user_id, test_resource_id, None)
 
     def test_change_tags(self):
         mock = MagicMock(return_value=None)
-        self.fm.change_tags = mock
+        self.mock_model("change_tags", mock)
         test_tag_list = "python"
         test_exercise_id = 42
 
-        with app.test_client() as client:
+        with self.app.test_client() as client:
             with client.session_transaction() as sess:
                 sess["email"] = self.test_user_id
 